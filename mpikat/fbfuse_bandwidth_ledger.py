@@ -0,0 +1,175 @@
+"""
+Copyright (c) 2018 Ewan Barr <ebarr@mpifr-bonn.mpg.de>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import logging
+from threading import Lock
+
+log = logging.getLogger("mpikat.fbfuse_bandwidth_ledger")
+
+class BandwidthAllocationError(Exception):
+    pass
+
+class FbfBandwidthLedger(object):
+    """Ledger of the network bandwidth committed by all products of an FBFUSE instance.
+
+    Each product commits its total output and ingest rates along with the
+    rates of each worker and output multicast group it uses. The total output
+    rate of all products is limited to a fixed budget for the shared output
+    network; ingest rates are recorded for monitoring only.
+    """
+    def __init__(self, max_output_rate, callback=None):
+        """
+        @brief  Create a new ledger
+
+        @param  max_output_rate  The output rate budget shared by all products in bits/s
+
+        @param  callback         (optional) A callable taking no arguments that is called
+                                 whenever a commitment is made or released
+        """
+        self._max_output_rate = max_output_rate
+        self._callback = callback
+        self._commitments = {}
+        self._lock = Lock()
+
+    def _notify(self):
+        if self._callback is not None:
+            self._callback()
+
+    @property
+    def max_output_rate(self):
+        return self._max_output_rate
+
+    def commit(self, product_id, output_rate, ingest_rate, worker_rates=None, group_rates=None):
+        """
+        @brief  Commit the rates used by a product, replacing any previous commitment
+
+        @param  product_id    The product identifier
+
+        @param  output_rate   The total output rate of the product in bits/s
+
+        @param  ingest_rate   The total ingest rate of the product in bits/s
+
+        @param  worker_rates  (optional) A dictionary mapping worker names to
+                              dictionaries with 'ingest' and 'output' rates in bits/s
+
+        @param  group_rates   (optional) A dictionary mapping output multicast groups
+                              to rates in bits/s
+
+        @note   Raises a BandwidthAllocationError if the output rate exceeds the
+                budget remaining after all other products' commitments.
+        """
+        with self._lock:
+            available = self._remaining_output_rate(exclude=product_id)
+            if output_rate > available:
+                raise BandwidthAllocationError("Cannot commit {:.2f} Gb/s of output for {}, "
+                    "only {:.2f} Gb/s remaining".format(output_rate/1e9, product_id, available/1e9))
+            log.debug("Committing {:.2f} Gb/s output and {:.2f} Gb/s ingest for {}".format(
+                output_rate/1e9, ingest_rate/1e9, product_id))
+            self._commitments[product_id] = {
+                "output": output_rate,
+                "ingest": ingest_rate,
+                "workers": dict(worker_rates or {}),
+                "groups": dict(group_rates or {})
+                }
+        self._notify()
+
+    def release(self, product_id):
+        """
+        @brief  Release all rates committed by a product
+
+        @note   Releasing a product with no commitment is a no-op
+        """
+        with self._lock:
+            released = self._commitments.pop(product_id, None) is not None
+        if released:
+            log.debug("Released bandwidth commitment for {}".format(product_id))
+            self._notify()
+
+    def _remaining_output_rate(self, exclude=None):
+        committed = sum(commitment["output"] for product_id, commitment
+            in self._commitments.items() if product_id != exclude)
+        return max(self._max_output_rate - committed, 0.0)
+
+    def remaining_output_rate(self, exclude=None):
+        """
+        @brief  Get the uncommitted output rate in bits/s
+
+        @param  exclude  (optional) A product whose commitment should be treated as free,
+                         e.g. when that product is being reconfigured
+        """
+        with self._lock:
+            return self._remaining_output_rate(exclude)
+
+    def committed_output_rate(self):
+        """
+        @brief  Get the total committed output rate in bits/s
+        """
+        with self._lock:
+            return sum(commitment["output"] for commitment in self._commitments.values())
+
+    def committed_ingest_rate(self):
+        """
+        @brief  Get the total committed ingest rate in bits/s
+        """
+        with self._lock:
+            return sum(commitment["ingest"] for commitment in self._commitments.values())
+
+    def worker_rates(self, worker):
+        """
+        @brief  Get the committed rates of a worker
+
+        @return A dictionary with 'ingest' and 'output' rates in bits/s
+        """
+        with self._lock:
+            rates = {"ingest": 0.0, "output": 0.0}
+            for commitment in self._commitments.values():
+                for key, value in commitment["workers"].get(worker, {}).items():
+                    rates[key] += value
+            return rates
+
+    def group_rate(self, group):
+        """
+        @brief  Get the committed rate of an output multicast group in bits/s
+        """
+        with self._lock:
+            return sum(commitment["groups"].get(group, 0.0) for commitment in self._commitments.values())
+
+    def product_commitment(self, product_id):
+        """
+        @brief  Get a copy of the commitment of a product (or None if it has no commitment)
+        """
+        with self._lock:
+            commitment = self._commitments.get(product_id)
+            if commitment is None:
+                return None
+            return {
+                "output": commitment["output"],
+                "ingest": commitment["ingest"],
+                "workers": {key: dict(value) for key, value in commitment["workers"].items()},
+                "groups": dict(commitment["groups"])
+                }
+
+    def products(self):
+        """
+        @brief  Get the IDs of all products with a commitment
+        """
+        with self._lock:
+            return list(self._commitments.keys())
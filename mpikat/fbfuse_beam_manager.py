@@ -20,14 +20,29 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import logging
+import time
 import mosaic
-from katpoint import Target
+import numpy as np
+from collections import namedtuple
+from katpoint import Target, lightspeed
+from mpikat.utils import angular_separation
 
 log = logging.getLogger("mpikat.fbfuse_ca_server")
 
 DEFAULT_KATPOINT_TARGET = "unset, radec, 0, 0"
-
-class BeamAllocationError(object):
+UNSET_TARGET_NAME = "unset"
+DEFAULT_COVERAGE_THRESHOLD = 0.9
+MOSAIC_TILING = "mosaic"
+HEXAGONAL_TILING = "hexagonal"
+TILING_METHODS = [MOSAIC_TILING, HEXAGONAL_TILING]
+DEFAULT_INDEX_CELL_SIZE = 0.05
+EPOCH_AUTO = "auto"
+DEFAULT_AUTO_EPOCH_DURATION = 3600.0
+DEFAULT_EPOCH_SAMPLES = 32
+
+BeamShapeEstimate = namedtuple("BeamShapeEstimate", ["axisH", "axisV", "angle"])
+
+class BeamAllocationError(Exception):
     pass
 
 class Beam(object):
@@ -91,7 +106,7 @@ class Beam(object):
 class Tiling(object):
     """Wrapper class for a collection of beams in a tiling pattern
     """
-    def __init__(self, target, reference_frequency, overlap):
+    def __init__(self, target, reference_frequency, overlap, method=MOSAIC_TILING):
         """
         @brief   Create a new tiling object
 
@@ -108,17 +123,30 @@ class Tiling(object):
                                     at their half-power points. [Note: This is currently a tricky parameter to use
                                     when values are close to zero. In future this may be define in sigma units or
                                     in multiples of the FWHM of the beam.]
+
+        @param      method          The tiling generator to use, either "mosaic" (mosaic.generate_nbeams_tiling)
+                                    or "hexagonal" (generate_hexagonal_tiling).
         """
+        if method not in TILING_METHODS:
+            raise ValueError("Unknown tiling method '{}', valid methods are {}".format(
+                method, TILING_METHODS))
         self._beams = []
         self.target = target
         self.reference_frequency = reference_frequency
         self.overlap = overlap
+        self.method = method
         self.tiling = None
+        self.beam_shape = None
+        self.epoch = None
 
     @property
     def nbeams(self):
         return len(self._beams)
 
+    @property
+    def beams(self):
+        return list(self._beams)
+
     def add_beam(self, beam):
         """
         @brief   Add a beam to the tiling pattern
@@ -127,6 +155,44 @@ class Tiling(object):
         """
         self._beams.append(beam)
 
+    def compute(self, antennas, epoch):
+        """
+        @brief   Calculate the beam shape and beam positions of the tiling
+                 without updating any beams.
+
+        @param      epoch     The epoch of tiling (unix time)
+
+        @param      antennas  The antennas to use when calculating the beam shape.
+                              Note these are the antennas in katpoint CSV format.
+
+        @return     A tuple of the beam shape and a list of (ra, dec) beam positions.
+
+        @note       This method does not modify the tiling and so may safely be
+                    called from outside of the IOLoop thread.
+        """
+        beam_shape = get_beam_shape(antennas, self.reference_frequency, self.target, epoch)
+        if self.method == HEXAGONAL_TILING:
+            coordinates = list(generate_hexagonal_tiling(beam_shape, self.target, self.nbeams, self.overlap))
+        else:
+            tiling = mosaic.generate_nbeams_tiling(beam_shape, self.nbeams, self.overlap)
+            coordinates = [tiling.coordinates[ii] for ii in range(tiling.beam_num)]
+        return beam_shape, coordinates
+
+    def apply(self, beam_shape, coordinates, epoch):
+        """
+        @brief   Update the RA and Dec positions of all beams in the tiling object
+
+        @param      beam_shape   The beam shape used to generate the coordinates
+
+        @param      coordinates  A list of (ra, dec) beam positions as returned by compute
+
+        @param      epoch        The epoch of tiling (unix time)
+        """
+        for ii, (ra, dec) in enumerate(coordinates):
+            self._beams[ii].target = Target('{},radec,{},{}'.format(self.target.name, ra, dec))
+        self.beam_shape = beam_shape
+        self.epoch = epoch
+
     def generate(self, antennas, epoch):
         """
         @brief   Calculate and update RA and Dec positions of all
@@ -137,12 +203,8 @@ class Tiling(object):
         @param      antennas  The antennas to use when calculating the beam shape.
                               Note these are the antennas in katpoint CSV format.
         """
-        psfsim = mosaic.PsfSim(antennas, self.reference_frequency)
-        beam_shape = psfsim.get_beam_shape(self.target, epoch)
-        tiling = mosaic.generate_nbeams_tiling(beam_shape, self.nbeams, self.overlap)
-        for ii in range(tiling.beam_num):
-            ra, dec = tiling.coordinates[ii]
-            self._beams[ii].target = Target('{},radec,{},{}'.format(self.target.name, ra, dec))
+        beam_shape, coordinates = self.compute(antennas, epoch)
+        self.apply(beam_shape, coordinates, epoch)
 
     def __repr__(self):
         return ", ".join([repr(beam) for beam in self._beams])
@@ -151,6 +213,470 @@ class Tiling(object):
         return ",".join([beam.idx for beam in self._beams])
 
 
+class DynamicTiling(Tiling):
+    """Wrapper class for a tiling that is periodically regenerated
+    to track changes in the synthesised beam shape
+    """
+    def __init__(self, target, reference_frequency, overlap, update_period=None,
+                 coverage_threshold=DEFAULT_COVERAGE_THRESHOLD, method=MOSAIC_TILING):
+        """
+        @brief   Create a new dynamic tiling object
+
+        @param      target                  A KATPOINT target object
+
+        @param      reference_frequency     The reference frequency at which to calculate the synthesised beam shape.
+
+        @param      overlap                 The desired overlap point between beams in the pattern (see Tiling).
+
+        @param      update_period           The maximum time in seconds between regenerations of the tiling.
+                                            If None the tiling is only regenerated on coverage loss.
+
+        @param      coverage_threshold      The fractional overlap between the beam shape that the tiling was
+                                            generated with and the current beam shape below which the tiling will
+                                            be regenerated. If None the tiling is only regenerated periodically.
+
+        @param      method                  The tiling generator to use (see Tiling).
+        """
+        super(DynamicTiling, self).__init__(target, reference_frequency, overlap, method)
+        self.update_period = update_period
+        self.coverage_threshold = coverage_threshold
+
+    def coverage(self, beam_shape):
+        """
+        @brief   Return the fractional coverage retained by the current tiling given
+                 the current beam shape
+
+        @param   beam_shape  The current synthesised beam shape
+        """
+        if self.beam_shape is None:
+            return 0.0
+        return beam_shape_overlap(self.beam_shape, beam_shape)
+
+    def needs_update(self, beam_shape, now=None):
+        """
+        @brief   Determine whether the tiling should be regenerated
+
+        @param   beam_shape  The current synthesised beam shape
+
+        @param   now         The current unix time (defaults to time.time())
+        """
+        if self.epoch is None:
+            return True
+        now = time.time() if now is None else now
+        if self.update_period is not None and (now - self.epoch) >= self.update_period:
+            return True
+        if self.coverage_threshold is not None and self.coverage(beam_shape) < self.coverage_threshold:
+            return True
+        return False
+
+
+def _overlap_scale(overlap):
+    # Ratio of the radius of the overlap-power contour of a Gaussian
+    # beam to the radius of its half-power contour
+    return np.sqrt(np.log(1.0 / overlap) / np.log(2.0))
+
+
+def _beam_axes(beam_shape, overlap):
+    scale = _overlap_scale(overlap)
+    return beam_shape.axisH * scale, beam_shape.axisV * scale, np.deg2rad(beam_shape.angle)
+
+
+def _hexagonal_grid(nbeams):
+    # Centres of unit circles packed on a hexagonal lattice such that
+    # neighbouring circles touch, ordered by distance from the origin
+    nrings = 0
+    while 1 + 3 * nrings * (nrings + 1) < nbeams:
+        nrings += 1
+    q, r = np.meshgrid(np.arange(-nrings, nrings + 1), np.arange(-nrings, nrings + 1))
+    q, r = q.ravel(), r.ravel()
+    valid = np.abs(q + r) <= nrings
+    q, r = q[valid], r[valid]
+    u = 2.0 * (q + r / 2.0)
+    v = 2.0 * (r * np.sqrt(3) / 2.0)
+    order = np.lexsort((np.arctan2(v, u), np.round(np.hypot(u, v), 9)))
+    return u[order][:nbeams], v[order][:nbeams]
+
+
+def _radec_degrees(target):
+    ra, dec = target.radec()
+    return np.rad2deg(float(ra)), np.rad2deg(float(dec))
+
+
+def _offsets_to_radec(ra0, dec0, x, y):
+    # Inverse gnomonic projection of tangent plane offsets (degrees)
+    # about (ra0, dec0) (degrees) to RA and Dec (degrees)
+    ra0, dec0 = np.deg2rad(ra0), np.deg2rad(dec0)
+    x, y = np.deg2rad(x), np.deg2rad(y)
+    rho = np.hypot(x, y)
+    c = np.arctan(rho)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dec = np.where(rho == 0, dec0, np.arcsin(np.cos(c) * np.sin(dec0) +
+            y * np.sin(c) * np.cos(dec0) / rho))
+    ra = ra0 + np.arctan2(x * np.sin(c), rho * np.cos(dec0) * np.cos(c) - y * np.sin(dec0) * np.sin(c))
+    return np.rad2deg(ra) % 360.0, np.rad2deg(dec)
+
+
+def _radec_to_offsets(ra0, dec0, ra, dec):
+    # Gnomonic projection of RA and Dec (degrees) to tangent plane
+    # offsets (degrees) about (ra0, dec0) (degrees)
+    ra0, dec0 = np.deg2rad(ra0), np.deg2rad(dec0)
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    x = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    y = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c
+    return np.rad2deg(x), np.rad2deg(y)
+
+
+def generate_hexagonal_tiling(beam_shape, target, nbeams, overlap):
+    """
+    @brief   Generate a hexagonal tiling of elliptical beams around a target
+
+    @param   beam_shape  The synthesised beam shape, an object with axisH and axisV (semi-axes of the
+                         half-power contour in degrees) and angle (rotation of axisH from the RA axis
+                         towards the Dec axis in degrees) attributes, e.g. as returned by get_beam_shape
+
+    @param   target      A KATPOINT target object at the centre of the tiling
+
+    @param   nbeams      The number of beams in the tiling
+
+    @param   overlap     The power point at which neighbouring beams will meet
+
+    @return  An array of shape (nbeams, 2) containing RA and Dec (degrees) for each beam
+
+    @detail  Beam centres are placed on a hexagonal lattice in a frame in which the beam is circular
+             and are then mapped onto the sky with the beam's axes and orientation. The pattern is
+             calculated directly without any iterative search so the cost scales linearly with nbeams.
+    """
+    axis_h, axis_v, angle = _beam_axes(beam_shape, overlap)
+    u, v = _hexagonal_grid(nbeams)
+    x = u * axis_h * np.cos(angle) - v * axis_v * np.sin(angle)
+    y = u * axis_h * np.sin(angle) + v * axis_v * np.cos(angle)
+    ra0, dec0 = _radec_degrees(target)
+    ra, dec = _offsets_to_radec(ra0, dec0, x, y)
+    return np.column_stack((ra, dec))
+
+
+def tiling_coverage(beam_shape, target, coordinates, overlap, npoints=128):
+    """
+    @brief   Calculate the fraction of a tiling's footprint covered by its beams
+
+    @param   beam_shape   The synthesised beam shape used to generate the tiling
+
+    @param   target       A KATPOINT target object at the centre of the tiling
+
+    @param   coordinates  A sequence of (RA, Dec) beam positions in degrees
+
+    @param   overlap      The power point at which coverage is evaluated
+
+    @param   npoints      The number of sample points per axis used to evaluate the coverage
+
+    @return  The fraction of the area within the outermost beam centre that lies within the
+             overlap-power contour of at least one beam
+    """
+    coordinates = np.asarray(coordinates, dtype="float64")
+    axis_h, axis_v, angle = _beam_axes(beam_shape, overlap)
+    ra0, dec0 = _radec_degrees(target)
+    x, y = _radec_to_offsets(ra0, dec0, coordinates[:, 0], coordinates[:, 1])
+    # Transform beam centres to the frame in which the beams are unit circles
+    u = (x * np.cos(angle) + y * np.sin(angle)) / axis_h
+    v = (-x * np.sin(angle) + y * np.cos(angle)) / axis_v
+    radius = np.hypot(u, v).max()
+    if radius == 0:
+        return 1.0
+    gu, gv = np.meshgrid(np.linspace(-radius, radius, npoints), np.linspace(-radius, radius, npoints))
+    inside = np.hypot(gu, gv) <= radius
+    gu, gv = gu[inside], gv[inside]
+    covered = np.zeros(gu.size, dtype="bool")
+    chunk = 64
+    for start in range(0, u.size, chunk):
+        du = gu[:, None] - u[None, start:start+chunk]
+        dv = gv[:, None] - v[None, start:start+chunk]
+        covered |= ((du**2 + dv**2) <= 1.0).any(axis=1)
+    return np.count_nonzero(covered) / float(covered.size)
+
+
+def get_beam_shape(antennas, reference_frequency, target, epoch):
+    """
+    @brief   Calculate the synthesised beam shape for a target
+
+    @param   antennas             The antennas to use when calculating the beam shape.
+
+    @param   reference_frequency  The frequency at which to calculate the beam shape
+
+    @param   target               A KATPOINT target object
+
+    @param   epoch                The epoch (unix time) at which to calculate the beam shape
+    """
+    psfsim = mosaic.PsfSim(antennas, reference_frequency)
+    return psfsim.get_beam_shape(target, epoch)
+
+
+def beam_shape_overlap(shape_a, shape_b, npoints=128):
+    """
+    @brief   Calculate the fractional overlap of two synthesised beam shapes
+
+    @param   shape_a   A beam shape (as returned by mosaic) with axisH, axisV and angle attributes
+
+    @param   shape_b   A beam shape (as returned by mosaic) with axisH, axisV and angle attributes
+
+    @param   npoints   The number of sample points per axis used to evaluate the overlap
+
+    @return  The area of the intersection of the two beam ellipses divided by the area of their union
+    """
+    shapes = [(shape.axisH, shape.axisV, np.deg2rad(shape.angle)) for shape in (shape_a, shape_b)]
+    extent = max(max(axis_h, axis_v) for axis_h, axis_v, _ in shapes)
+    x, y = np.meshgrid(np.linspace(-extent, extent, npoints), np.linspace(-extent, extent, npoints))
+    inside = []
+    for axis_h, axis_v, angle in shapes:
+        xr = x * np.cos(angle) + y * np.sin(angle)
+        yr = -x * np.sin(angle) + y * np.cos(angle)
+        inside.append((xr / axis_h)**2 + (yr / axis_v)**2 <= 1.0)
+    union = np.count_nonzero(inside[0] | inside[1])
+    if union == 0:
+        return 0.0
+    return np.count_nonzero(inside[0] & inside[1]) / float(union)
+
+
+def beam_shape_evolution(antennas, reference_frequency, target, epochs):
+    """
+    @brief   Estimate the synthesised beam shape of a target over a set of epochs
+
+    @param   antennas             A list of KATPOINT Antenna objects
+
+    @param   reference_frequency  The frequency (Hz) at which to calculate the beam shape
+
+    @param   target               A KATPOINT target object
+
+    @param   epochs               An array of unix times at which to calculate the beam shape
+
+    @return  A tuple of (shapes, elevations) where shapes is a list of BeamShapeEstimate
+             objects (axes in degrees, angle in degrees from east through north) and
+             elevations is an array of target elevations in degrees.
+
+    @detail  The projected baselines for all epochs are calculated in a single
+             vectorised step. The beam at each epoch is approximated as the Gaussian
+             whose covariance is the inverse of the second moments of the uv coverage
+             (uniform baseline weighting). This is much cheaper than a full PSF
+             simulation and is intended for comparing beam shapes between epochs
+             rather than for generating the tiling itself.
+    """
+    epochs = np.atleast_1d(np.asarray(epochs, dtype="float64"))
+    enu = np.array([antenna.position_enu for antenna in antennas], dtype="float64")
+    first, second = np.triu_indices(len(antennas), k=1)
+    east, north, up = ((enu[second] - enu[first]) * reference_frequency / lightspeed).T
+    lat = float(antennas[0].ref_observer.lat)
+    # Baselines in equatorial coordinates
+    x = -np.sin(lat) * north + np.cos(lat) * up
+    y = east
+    z = np.cos(lat) * north + np.sin(lat) * up
+    ra, dec = [float(value) for value in target.radec()]
+    lst = np.asarray(antennas[0].local_sidereal_time(epochs), dtype="float64")
+    ha = (lst - ra)[:, np.newaxis]
+    u = np.sin(ha) * x + np.cos(ha) * y
+    v = -np.sin(dec) * np.cos(ha) * x + np.sin(dec) * np.sin(ha) * y + np.cos(dec) * z
+    cuu = np.mean(u**2, axis=1)
+    cvv = np.mean(v**2, axis=1)
+    cuv = np.mean(u * v, axis=1)
+    # Beam covariance (radians^2) is the inverse of the uv covariance / (2 pi)^2
+    det = (cuu * cvv - cuv**2) * (2 * np.pi)**2
+    sll, smm, slm = cvv / det, cuu / det, -cuv / det
+    mean = (sll + smm) / 2.0
+    diff = np.sqrt(((sll - smm) / 2.0)**2 + slm**2)
+    # Convert standard deviations to half widths at half maximum
+    hwhm = np.sqrt(2 * np.log(2))
+    axis_h = np.rad2deg(np.sqrt(mean + diff) * hwhm)
+    axis_v = np.rad2deg(np.sqrt(np.clip(mean - diff, 0.0, None)) * hwhm)
+    angle = np.rad2deg(0.5 * np.arctan2(2 * slm, sll - smm))
+    elevation = np.rad2deg(np.arcsin(np.sin(lat) * np.sin(dec)
+        + np.cos(lat) * np.cos(dec) * np.cos(ha[:, 0])))
+    shapes = [BeamShapeEstimate(*values) for values in zip(axis_h, axis_v, angle)]
+    return shapes, elevation
+
+
+def pairwise_beam_shape_overlap(shapes, npoints=64):
+    """
+    @brief   Calculate the fractional overlap between all pairs of a set of beam shapes
+
+    @param   shapes    A list of beam shapes with axisH, axisV and angle attributes
+
+    @param   npoints   The number of sample points per axis used to evaluate the overlap
+
+    @return  An (N, N) array of overlaps, as defined for beam_shape_overlap
+    """
+    axis_h = np.array([shape.axisH for shape in shapes], dtype="float64")[:, np.newaxis]
+    axis_v = np.array([shape.axisV for shape in shapes], dtype="float64")[:, np.newaxis]
+    angle = np.deg2rad([shape.angle for shape in shapes])[:, np.newaxis]
+    extent = max(axis_h.max(), axis_v.max())
+    x, y = np.meshgrid(np.linspace(-extent, extent, npoints), np.linspace(-extent, extent, npoints))
+    x, y = x.ravel()[np.newaxis, :], y.ravel()[np.newaxis, :]
+    xr = x * np.cos(angle) + y * np.sin(angle)
+    yr = -x * np.sin(angle) + y * np.cos(angle)
+    inside = ((xr / axis_h)**2 + (yr / axis_v)**2 <= 1.0).astype("float32")
+    intersection = inside.dot(inside.T)
+    counts = np.diag(intersection)
+    union = counts[:, np.newaxis] + counts[np.newaxis, :] - intersection
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(union > 0, intersection / union, 0.0)
+
+
+def optimal_tiling_epoch(antennas, reference_frequency, target, start, end,
+                         nsamples=DEFAULT_EPOCH_SAMPLES):
+    """
+    @brief   Find the tiling epoch that maximises the time-averaged tiling coverage
+
+    @param   antennas             A list of KATPOINT Antenna objects
+
+    @param   reference_frequency  The frequency (Hz) at which to calculate the beam shape
+
+    @param   target               A KATPOINT target object
+
+    @param   start                The start of the observation as a unix time
+
+    @param   end                  The end of the observation as a unix time
+
+    @param   nsamples             The number of epochs to sample across the observation
+
+    @return  The epoch (unix time) at which the tiling should be generated
+
+    @detail  The beam shape is evaluated at nsamples epochs across the observation. For each
+             candidate epoch the coverage at every other epoch is taken to be the overlap
+             between the two beam shapes, and the candidate with the highest mean coverage
+             over the epochs where the target is above the horizon is chosen.
+    """
+    epochs = np.linspace(start, end, max(int(nsamples), 1))
+    shapes, elevation = beam_shape_evolution(antennas, reference_frequency, target, epochs)
+    visible = np.nonzero(elevation > 0.0)[0]
+    if visible.size == 0:
+        log.warning("Target {} is below the horizon for the full observation, "
+            "using the observation midpoint as the tiling epoch".format(target.name))
+        return (start + end) / 2.0
+    overlap = pairwise_beam_shape_overlap([shapes[ii] for ii in visible])
+    coverage = overlap.mean(axis=1)
+    best = np.argmax(coverage)
+    log.debug("Optimal tiling epoch for {} is {} with mean coverage {:.3f}".format(
+        target.name, epochs[visible[best]], coverage[best]))
+    return float(epochs[visible[best]])
+
+
+class BeamIndex(object):
+    """Spatial index of beam positions on the sky
+
+    Positions are hashed into cells of a fixed size grid of declination bands,
+    each band being split into as many right ascension cells as fit at its
+    highest declination (so cells are approximately equal area as in HEALPix).
+    A cone search then only has to test the beams in the few cells that
+    intersect the cone, making lookups independent of the total number of beams.
+    """
+    def __init__(self, cell_size=DEFAULT_INDEX_CELL_SIZE):
+        """
+        @brief   Create a new beam index
+
+        @param   cell_size   The size of the index cells in degrees
+        """
+        self._cell_size = float(cell_size)
+        self._nbands = int(np.ceil(180.0 / self._cell_size))
+        dec_edges = np.abs(np.linspace(-90.0, -90.0 + self._nbands * self._cell_size, self._nbands + 1))
+        max_dec = np.minimum(np.maximum(dec_edges[:-1], dec_edges[1:]), 90.0)
+        self._ncells = np.maximum(1, np.floor(
+            360.0 * np.cos(np.deg2rad(max_dec)) / self._cell_size)).astype("int64")
+        self._cells = {}
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def _cell(self, ra, dec):
+        band = min(int((dec + 90.0) // self._cell_size), self._nbands - 1)
+        ncells = self._ncells[band]
+        return (band, int(((ra % 360.0) / 360.0) * ncells) % ncells)
+
+    def update(self, key, ra, dec):
+        """
+        @brief   Add or move an entry in the index
+
+        @param   key   A unique identifier for the entry (e.g. a beam ID)
+
+        @param   ra    The right ascension of the entry in degrees
+
+        @param   dec   The declination of the entry in degrees
+        """
+        self.remove(key)
+        cell = self._cell(ra, dec)
+        self._positions[key] = (ra, dec, cell)
+        self._cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        """
+        @brief   Remove an entry from the index (no-op if not present)
+
+        @param   key   The identifier of the entry
+        """
+        if key not in self._positions:
+            return
+        _, _, cell = self._positions.pop(key)
+        members = self._cells[cell]
+        members.discard(key)
+        if not members:
+            del self._cells[cell]
+
+    def clear(self):
+        """
+        @brief   Remove all entries from the index
+        """
+        self._cells = {}
+        self._positions = {}
+
+    def _candidate_cells(self, ra, dec, radius):
+        dec_min = max(dec - radius, -90.0)
+        dec_max = min(dec + radius, 90.0)
+        first_band = min(int((dec_min + 90.0) // self._cell_size), self._nbands - 1)
+        last_band = min(int((dec_max + 90.0) // self._cell_size), self._nbands - 1)
+        if dec_min <= -90.0 or dec_max >= 90.0:
+            # The cone contains a pole and so spans all right ascensions
+            half_width = 180.0
+        else:
+            half_width = np.rad2deg(np.arcsin(min(1.0,
+                np.sin(np.deg2rad(radius)) / np.cos(np.deg2rad(dec)))))
+        for band in range(first_band, last_band + 1):
+            ncells = self._ncells[band]
+            if half_width >= 180.0:
+                cells = range(ncells)
+            else:
+                width = 360.0 / ncells
+                first = int(np.floor((ra - half_width) / width))
+                last = int(np.floor((ra + half_width) / width))
+                cells = set(idx % ncells for idx in range(first, min(last, first + ncells - 1) + 1))
+            for idx in cells:
+                if (band, idx) in self._cells:
+                    yield (band, idx)
+
+    def lookup(self, ra, dec, radius):
+        """
+        @brief   Find all entries within a given radius of a sky position
+
+        @param   ra       The right ascension of the search position in degrees
+
+        @param   dec      The declination of the search position in degrees
+
+        @param   radius   The search radius in degrees
+
+        @return  A list of the keys of all matching entries sorted by distance
+                 from the search position
+        """
+        keys = []
+        for cell in self._candidate_cells(ra, dec, radius):
+            keys.extend(self._cells[cell])
+        if not keys:
+            return []
+        positions = np.array([self._positions[key][:2] for key in keys])
+        separation = angular_separation(ra, dec, positions[:, 0], positions[:, 1])
+        order = np.argsort(separation, kind="mergesort")
+        return [keys[ii] for ii in order if separation[ii] <= radius]
+
+
 class BeamManager(object):
     """Manager class for allocation, deallocation and tracking of
     individual beams and static tilings.
@@ -169,6 +695,10 @@ class BeamManager(object):
         self._beams = [Beam("cfbf%05d"%(i)) for i in range(self._nbeams)]
         self._free_beams = [beam for beam in self._beams]
         self._allocated_beams = []
+        self._beams_by_idx = {beam.idx: beam for beam in self._beams}
+        self._index = BeamIndex()
+        for beam in self._beams:
+            beam.register_observer(self._update_index)
         self.reset()
 
     @property
@@ -179,6 +709,10 @@ class BeamManager(object):
     def antennas(self):
         return self._antennas
 
+    @property
+    def dynamic_tilings(self):
+        return list(self._dynamic_tilings)
+
     def reset(self):
         """
         @brief  reset and deallocate all beams and tilings managed by this instance
@@ -208,7 +742,9 @@ class BeamManager(object):
         self._allocated_beams.append(beam)
         return beam
 
-    def add_tiling(self, target, nbeams, reference_frequency, overlap):
+    def add_tiling(self, target, nbeams, reference_frequency, overlap, dynamic=False,
+                   update_period=None, coverage_threshold=DEFAULT_COVERAGE_THRESHOLD,
+                   method=MOSAIC_TILING):
         """
         @brief   Add a tiling to be managed
 
@@ -226,18 +762,98 @@ class BeamManager(object):
                                     when values are close to zero. In future this may be define in sigma units or
                                     in multiples of the FWHM of the beam.]
 
+        @param      dynamic         Flag indicating if the tiling should be regenerated as the beam shape
+                                    evolves (see DynamicTiling).
+
+        @param      update_period   For dynamic tilings, the maximum time in seconds between regenerations
+
+        @param      coverage_threshold  For dynamic tilings, the fractional beam shape overlap below
+                                        which the tiling will be regenerated
+
+        @param      method          The tiling generator to use, either "mosaic" or "hexagonal"
+
         @returns    The created Tiling object
         """
         if len(self._free_beams) < nbeams:
             raise BeamAllocationError("Requested more beams than are available.")
-        tiling = Tiling(target, reference_frequency, overlap)
+        if dynamic:
+            tiling = DynamicTiling(target, reference_frequency, overlap,
+                update_period, coverage_threshold, method)
+        else:
+            tiling = Tiling(target, reference_frequency, overlap, method)
         for _ in range(nbeams):
             beam = self._free_beams.pop(0)
             tiling.add_beam(beam)
             self._allocated_beams.append(beam)
         self._tilings.append(tiling)
+        if dynamic:
+            self._dynamic_tilings.append(tiling)
         return tiling
 
+    def remove_beam(self, beam):
+        """
+        @brief   Deallocate a single beam and return it to the free pool
+
+        @param   beam   A Beam object previously returned by add_beam
+
+        @note    Only the removed beam is reset, all other beams keep their
+                 current targets.
+        """
+        if beam not in self._allocated_beams:
+            raise BeamAllocationError("Beam {} is not allocated".format(beam.idx))
+        self._allocated_beams.remove(beam)
+        self._release_beam(beam)
+
+    def remove_tiling(self, tiling):
+        """
+        @brief   Deallocate a tiling and return all of its beams to the free pool
+
+        @param   tiling   A Tiling object previously returned by add_tiling
+        """
+        if tiling not in self._tilings:
+            raise BeamAllocationError("Tiling is not managed by this instance")
+        self._tilings.remove(tiling)
+        if tiling in self._dynamic_tilings:
+            self._dynamic_tilings.remove(tiling)
+        for beam in tiling.beams:
+            self._allocated_beams.remove(beam)
+            self._release_beam(beam)
+
+    def _release_beam(self, beam):
+        beam.reset()
+        self._free_beams.append(beam)
+        # Keep free beams in index order so that the lowest free
+        # beam IDs are always handed out first
+        self._free_beams.sort(key=lambda beam: beam.idx)
+
+    def _update_index(self, beam):
+        # Called on every change of a beam target to keep the
+        # spatial index in step with the beam positions
+        if beam.target.name == UNSET_TARGET_NAME:
+            self._index.remove(beam.idx)
+            return
+        try:
+            ra, dec = _radec_degrees(beam.target)
+        except Exception as error:
+            log.warning("Unable to index beam {}: {}".format(beam.idx, str(error)))
+            self._index.remove(beam.idx)
+        else:
+            self._index.update(beam.idx, ra, dec)
+
+    def lookup(self, ra, dec, radius):
+        """
+        @brief  Find the allocated beams within a radius of a sky position
+
+        @param  ra       The right ascension of the search position in degrees
+
+        @param  dec      The declination of the search position in degrees
+
+        @param  radius   The search radius in degrees
+
+        @return A list of Beam objects sorted by distance from the search position
+        """
+        return [self._beams_by_idx[idx] for idx in self._index.lookup(ra, dec, radius)]
+
     def get_beams(self):
         """
         @brief  Return all managed beams
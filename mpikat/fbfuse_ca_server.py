@@ -23,15 +23,20 @@ import logging
 import json
 import tornado
 import signal
+import numpy as np
 from tornado.gen import Return
 from optparse import OptionParser
 from katcp import Sensor, Message, AsyncDeviceServer
-from katcp.kattypes import request, return_reply, Str
+from katcp.kattypes import request, return_reply, Str, Int
 from katportalclient import KATPortalClient
 from katpoint import Antenna, Target
+from mpikat.fbfuse_source_catalogue import load_catalogue, primary_beam_radius
 
 log = logging.getLogger("mpikat.fbfuse_ca_server")
 
+DEFAULT_REFERENCE_FREQUENCY = 1.284e9
+DEFAULT_MAX_CATALOGUE_SOURCES = 100
+
 class BaseFbfConfigurationAuthority(AsyncDeviceServer):
     """This is an example/template for how users
     may develop an fbf configuration authority server
@@ -39,10 +44,53 @@ class BaseFbfConfigurationAuthority(AsyncDeviceServer):
     VERSION_INFO = ("mpikat-fbf-ca-api", 0, 1)
     BUILD_INFO = ("mpikat-fbf-ca-implementation", 0, 1, "rc1")
     DEVICE_STATUSES = ["ok", "degraded", "fail"]
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, catalogue=None):
         super(BaseFbfConfigurationAuthority, self).__init__(ip, port)
         self._configuration_sensors = {}
         self._configuration_callbacks = {}
+        self._catalogue = catalogue
+        self.catalogue_search_radius = primary_beam_radius(DEFAULT_REFERENCE_FREQUENCY)
+        self.max_catalogue_sources = DEFAULT_MAX_CATALOGUE_SOURCES
+
+    @property
+    def catalogue(self):
+        return self._catalogue
+
+    def set_catalogue(self, catalogue):
+        """
+        @brief  Set the source catalogue used for beam placement
+
+        @param  catalogue  A SourceCatalogue instance (or None to disable catalogue lookups)
+        """
+        self._catalogue = catalogue
+
+    def get_catalogue_targets(self, target_string, radius=None, max_sources=None):
+        """
+        @brief  Find the catalogue sources within the primary beam of a pointing
+
+        @param  target_string  A KATPOINT target string (boresight pointing position)
+
+        @param  radius         (optional) The search radius in degrees. Defaults to
+                               catalogue_search_radius.
+
+        @param  max_sources    (optional) The maximum number of sources to return.
+                               Defaults to max_catalogue_sources.
+
+        @return A list of KATPOINT target strings, closest to boresight first, suitable
+                for use in the 'beams' list of a target configuration. The boresight
+                source itself is excluded.
+        """
+        if self._catalogue is None:
+            return []
+        if radius is None:
+            radius = self.catalogue_search_radius
+        if max_sources is None:
+            max_sources = self.max_catalogue_sources
+        target = Target(target_string)
+        ra, dec = [np.rad2deg(float(value)) for value in target.radec()]
+        targets = self._catalogue.targets_within(ra, dec, radius, max_sources + 1)
+        targets = [t for t in targets if Target(t).name != target.name]
+        return targets[:max_sources]
 
     def start(self):
         """
@@ -124,10 +172,30 @@ class BaseFbfConfigurationAuthority(AsyncDeviceServer):
     def update_target_config(self, product_id, config):
         self._configuration_sensors[product_id].set_value(json.dumps(config))
 
+    @request(Str())
+    @return_reply(Int())
+    def request_load_source_catalogue(self, req, filename):
+        """
+        @brief      Load a source catalogue to be used for beam placement
+
+        @param      filename    The path to either a catalogue store written by
+                                SourceCatalogue.save (.npy, memory mapped) or a
+                                CSV file of "name, ra, dec" lines (degrees)
+
+        @return     katcp reply object [[[ !load-source-catalogue ok <number of sources> | (fail [error description]) ]]]
+        """
+        try:
+            catalogue = load_catalogue(filename)
+        except Exception as error:
+            log.exception("Failed to load source catalogue {}".format(filename))
+            return ("fail", str(error))
+        self.set_catalogue(catalogue)
+        return ("ok", len(catalogue))
+
 
 class DefaultConfigurationAuthority(BaseFbfConfigurationAuthority):
-    def __init__(self, host, port):
-        super(DefaultConfigurationAuthority, self).__init__(host, port)
+    def __init__(self, host, port, catalogue=None):
+        super(DefaultConfigurationAuthority, self).__init__(host, port, catalogue)
         self.default_config = {
             u'coherent-beams-nbeams':100,
             u'coherent-beams-tscrunch':16,
@@ -139,8 +207,9 @@ class DefaultConfigurationAuthority(BaseFbfConfigurationAuthority):
 
     @tornado.gen.coroutine
     def get_target_config(self, product_id, target):
-        # Return just a boresight beam
-        raise Return({"beams":[target],})
+        # Return a boresight beam followed by a beam on each
+        # catalogue source within the primary beam
+        raise Return({"beams":[target] + self.get_catalogue_targets(target),})
 
     @tornado.gen.coroutine
     def get_sb_config(self, product_id, sb_id):
@@ -172,6 +241,8 @@ def main():
         help='Port number to bind to')
     parser.add_option('', '--log_level',dest='log_level',type=str,
         help='Port number of status server instance',default="INFO")
+    parser.add_option('', '--catalogue', dest='catalogue', type=str,
+        help='Source catalogue store (.npy) or CSV file used for beam placement', default=None)
     (opts, args) = parser.parse_args()
     FORMAT = "[ %(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s"
     log.setLevel(opts.log_level.upper())
@@ -179,7 +250,10 @@ def main():
         handler.setFormatter(logging.Formatter(FORMAT))
     ioloop = tornado.ioloop.IOLoop.current()
     log.info("Starting DefaultConfigurationAuthority instance")
-    server = DefaultConfigurationAuthority(opts.host, opts.port)
+    catalogue = None
+    if opts.catalogue is not None:
+        catalogue = load_catalogue(opts.catalogue)
+    server = DefaultConfigurationAuthority(opts.host, opts.port, catalogue)
     signal.signal(signal.SIGINT, lambda sig, frame: ioloop.add_callback_from_signal(
         on_shutdown, ioloop, server))
     def start_and_display():
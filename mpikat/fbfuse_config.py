@@ -20,39 +20,345 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import logging
+import json
+import os
+import itertools
+import numpy as np
 from math import floor, ceil
-from mpikat.utils import next_power_of_two
+from mpikat.utils import next_power_of_two, memoize
 
 log = logging.getLogger('mpikat.fbfuse_config_manager')
 
 FBF_BEAM_NBITS = 8
+VALID_BEAM_NBITS = [8, 4, 2]
+NBITS_AUTO = "auto" # Use the highest bit depth that delivers the most beams
 MAX_OUTPUT_RATE = 300.0e9 # bits/s -- This is an artifical limit based on the original FBF design
 MAX_OUTPUT_RATE_PER_WORKER = 30.0e9 # bits/s
 MAX_OUTPUT_RATE_PER_MCAST_GROUP = 7.0e9 # bits/s
+MAX_INPUT_RATE_PER_WORKER = 28.0e9 # bits/s -- F-engine ingest limit of a reference worker
+FENG_NBITS_PER_SAMPLE = 2 * 2 * 8 # dual polarisation, complex, 8 bit
 MIN_MCAST_GROUPS = 16
 MIN_NBEAMS = 16
 MIN_ANTENNAS = 4
+DEFAULT_NALTERNATIVES = 3
+CONFIGURATION_CACHE_SIZE = 4096
+OBJECTIVE_NBEAMS = "nbeams"
+OBJECTIVE_NWORKERS = "nworkers"
+OBJECTIVE_NGROUPS = "ngroups"
+OBJECTIVE_RESOLUTION = "resolution"
+CONFIGURATION_OBJECTIVES = [OBJECTIVE_NBEAMS, OBJECTIVE_NWORKERS, OBJECTIVE_NGROUPS, OBJECTIVE_RESOLUTION]
+PERFORMANCE_TABLE_VERSION = 1
+PERFORMANCE_TABLE_AXES = ["nantennas", "nchans", "tscrunch", "fscrunch"]
+DEFAULT_PERFORMANCE_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "data", "fbfuse_performance_table.json")
+PERFORMANCE_TABLE_REFERENCE_NCHANS = 4096 # The F-engine mode the performance table was measured in
+N_FENG_GROUPS_PER_ANTENNA = 4 # F-engine multicast groups per antenna of the (power of two) CBF layout
+
+# Parameters of the supported F-engine channelisation modes keyed on the total
+# number of channels. Each F-engine heap holds spectra_per_heap spectra of
+# 2*nchans ADC samples. As the time resolution of the channelised data differs
+# between modes the beamformer capacity is looked up at the 4k mode equivalent
+# load (see FbfConfigurationManager.effective_nchans_per_worker). No per-mode
+# performance measurements exist, so capacity depends only on that load.
+FENG_CHANNEL_MODES = {
+    1024: {"spectra_per_heap": 256},
+    4096: {"spectra_per_heap": 256},
+    32768: {"spectra_per_heap": 256}
+}
 
 class FbfConfigurationError(Exception):
     pass
 
+class FbfPerformanceTable(object):
+    """Lookup table of the maximum number of coherent beams a single
+    worker can form in real time.
+
+    The table is defined on a grid of antenna counts, channels per worker
+    (in 4k mode, see PERFORMANCE_TABLE_REFERENCE_NCHANS), tscrunch and
+    fscrunch factors. Lookups between grid points are
+    interpolated multilinearly in log-log space (so capacities that scale as
+    powers of the axis values are reproduced exactly). Lookups outside of the
+    grid are clamped to the nearest edge of the grid.
+    """
+    def __init__(self, axes, max_nbeams, metadata=None):
+        """
+        @brief  Create a new performance table
+
+        @param  axes        A dictionary mapping each of PERFORMANCE_TABLE_AXES to a
+                            sorted list of grid values
+
+        @param  max_nbeams  A nested list or array with one dimension per axis (in the
+                            order of PERFORMANCE_TABLE_AXES) giving the maximum number of
+                            beams per worker at each grid point
+
+        @param  metadata    (optional) A dictionary of information on the table origin
+        """
+        self.axes = [np.asarray(axes[name], dtype="float64") for name in PERFORMANCE_TABLE_AXES]
+        self.max_nbeams = np.asarray(max_nbeams, dtype="float64")
+        self.metadata = metadata if metadata is not None else {}
+        expected_shape = tuple(axis.size for axis in self.axes)
+        if self.max_nbeams.shape != expected_shape:
+            raise FbfConfigurationError("Performance table has shape {}, expected {}".format(
+                self.max_nbeams.shape, expected_shape))
+        for name, axis in zip(PERFORMANCE_TABLE_AXES, self.axes):
+            if np.any(axis <= 0) or np.any(np.diff(axis) <= 0):
+                raise FbfConfigurationError("Performance table axis '{}' must be positive "
+                    "and strictly increasing".format(name))
+        self._log_axes = [np.log2(axis) for axis in self.axes]
+        self._log_values = np.log2(np.clip(self.max_nbeams, 1.0, None))
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        @brief  Load a performance table from a JSON file as written by the save method
+        """
+        with open(filename) as f:
+            table = json.load(f)
+        version = table.get("version")
+        if version != PERFORMANCE_TABLE_VERSION:
+            raise FbfConfigurationError("Unsupported performance table version {} in {} "
+                "(expected {})".format(version, filename, PERFORMANCE_TABLE_VERSION))
+        return cls(table["axes"], table["max_nbeams"], table.get("metadata"))
+
+    def save(self, filename):
+        """
+        @brief  Write the performance table to a JSON file
+        """
+        table = {
+            "version": PERFORMANCE_TABLE_VERSION,
+            "metadata": self.metadata,
+            "axes": {name: [int(value) if value == int(value) else value for value in axis.tolist()]
+                for name, axis in zip(PERFORMANCE_TABLE_AXES, self.axes)},
+            "max_nbeams": self.max_nbeams.tolist()
+        }
+        with open(filename, "w") as f:
+            json.dump(table, f, indent=1, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+
+    def lookup(self, nantennas, nchans, tscrunch, fscrunch):
+        """
+        @brief  Get the (interpolated) maximum number of beams per worker
+
+        @param  nantennas  The number of antennas beamformed
+
+        @param  nchans     The number of channels processed per worker
+
+        @param  tscrunch   The time scrunch factor
+
+        @param  fscrunch   The frequency scrunch factor
+
+        @return The maximum number of beams as a float
+        """
+        lower = []
+        weights = []
+        for value, log_axis in zip((nantennas, nchans, tscrunch, fscrunch), self._log_axes):
+            position = np.clip(np.log2(float(value)), log_axis[0], log_axis[-1])
+            if log_axis.size == 1:
+                lower.append(0)
+                weights.append(0.0)
+                continue
+            idx = int(np.clip(np.searchsorted(log_axis, position, side="right") - 1,
+                0, log_axis.size - 2))
+            lower.append(idx)
+            weights.append((position - log_axis[idx]) / (log_axis[idx+1] - log_axis[idx]))
+        log_value = 0.0
+        for corner in itertools.product((0, 1), repeat=len(lower)):
+            weight = np.prod([w if offset else 1.0 - w for offset, w in zip(corner, weights)])
+            if weight > 0.0:
+                index = tuple(idx + offset for idx, offset in zip(lower, corner))
+                log_value += weight * self._log_values[index]
+        return float(2**log_value)
+
+def get_channel_mode(total_nchans):
+    """
+    @brief  Get the parameters of an F-engine channelisation mode
+
+    @param  total_nchans  The total number of F-engine channels (e.g. 4096)
+
+    @return A dictionary of mode parameters from FENG_CHANNEL_MODES
+    """
+    try:
+        return FENG_CHANNEL_MODES[total_nchans]
+    except KeyError:
+        raise FbfConfigurationError("Unsupported F-engine mode with {} channels, supported "
+            "modes are {}".format(total_nchans, sorted(FENG_CHANNEL_MODES.keys())))
+
+def feng_timestamp_step(total_nchans, spectra_per_heap=None):
+    """
+    @brief  Get the difference between the timestamps of successive F-engine heaps
+
+    @param  total_nchans      The total number of F-engine channels
+
+    @param  spectra_per_heap  (optional) The number of spectra per heap. Defaults to the
+                              value for the channelisation mode.
+
+    @return The timestamp step in ADC samples
+    """
+    if spectra_per_heap is None:
+        spectra_per_heap = get_channel_mode(total_nchans)["spectra_per_heap"]
+    return int(total_nchans * 2 * spectra_per_heap)
+
+def apportion(total, weights):
+    """
+    @brief  Split an integer quantity into integer shares proportional to a set of weights
+
+    @param  total    The quantity to split
+
+    @param  weights  A sequence of non-negative weights
+
+    @return A list of integer shares (one per weight) that sum to total
+
+    @detail Shares are allocated with the largest remainder method. Ties are broken
+            in favour of the earlier weights.
+    """
+    weights = np.asarray(weights, dtype="float64")
+    if weights.size == 0 or np.any(weights < 0) or weights.sum() <= 0:
+        raise FbfConfigurationError("Cannot apportion {} between weights {}".format(
+            total, weights.tolist()))
+    quotas = total * weights / weights.sum()
+    shares = np.floor(quotas).astype("int64")
+    remainder = int(total - shares.sum())
+    order = np.argsort(-(quotas - shares), kind="mergesort")
+    shares[order[:remainder]] += 1
+    return shares.tolist()
+
+def balanced_worker_sets(weights, nsets, nworkers_per_set):
+    """
+    @brief  Group the highest capacity workers into sets of similar total capacity
+
+    @param  weights           A sequence of worker capacity weights
+
+    @param  nsets             The number of worker sets to form
+
+    @param  nworkers_per_set  The number of workers in each set
+
+    @return A list of nsets lists of indices into weights
+
+    @detail Workers are taken in order of decreasing weight and each is placed in the
+            set with the lowest total weight that still has room.
+    """
+    needed = nsets * nworkers_per_set
+    if needed > len(weights):
+        raise FbfConfigurationError("Cannot form {} sets of {} workers from {} workers".format(
+            nsets, nworkers_per_set, len(weights)))
+    order = sorted(range(len(weights)), key=lambda idx: -weights[idx])[:needed]
+    sets = [[] for _ in range(nsets)]
+    totals = [0.0 for _ in range(nsets)]
+    for idx in order:
+        candidates = [ii for ii in range(nsets) if len(sets[ii]) < nworkers_per_set]
+        target = min(candidates, key=lambda ii: totals[ii])
+        sets[target].append(idx)
+        totals[target] += weights[idx]
+    return sets
+
+def split_beams_between_sets(mcast_to_beam_map, nworker_sets):
+    """
+    @brief  Split the beams of each multicast group between worker sets
+
+    @param  mcast_to_beam_map  A dictionary mapping multicast group addresses to lists
+                               of beam IDs
+
+    @param  nworker_sets       The number of worker sets
+
+    @return A list with one dictionary per worker set, mapping each multicast group
+            to the list of beam IDs that the worker set forms for that group
+
+    @detail Each set forms a contiguous, (as near as possible) equal share of the beams
+            of every group, so the number of beams scales linearly with the number of
+            worker sets. Groups that a set contributes no beams to are omitted.
+    """
+    maps = [{} for _ in range(nworker_sets)]
+    for group, beams in mcast_to_beam_map.items():
+        offset = 0
+        for worker_set, share in enumerate(apportion(len(beams), [1] * nworker_sets)):
+            if share > 0:
+                maps[worker_set][group] = list(beams[offset:offset+share])
+            offset += share
+    return maps
+
+_default_performance_table = None
+
+def load_default_performance_table():
+    """
+    @brief  Return the performance table shipped with mpikat (loaded once and cached)
+    """
+    global _default_performance_table
+    if _default_performance_table is None:
+        log.debug("Loading performance table from {}".format(DEFAULT_PERFORMANCE_TABLE))
+        _default_performance_table = FbfPerformanceTable.from_file(DEFAULT_PERFORMANCE_TABLE)
+    return _default_performance_table
+
 class FbfConfigurationManager(object):
-    def __init__(self, total_nantennas, total_bandwidth, total_nchans, nworkers, nips):
-        if total_nchans != 4096:
-            raise NotImplemented("Currently only 4k channel mode supported")
+    def __init__(self, total_nantennas, total_bandwidth, total_nchans, nworkers, nips,
+                 performance_table=None, worker_weights=None, max_output_rate=MAX_OUTPUT_RATE):
+        """
+        @brief  Create a new configuration manager
+
+        @param  total_nantennas    The number of antennas in the subarray
+
+        @param  total_bandwidth    The F-engine bandwidth in Hz
+
+        @param  total_nchans       The number of F-engine channels (see FENG_CHANNEL_MODES)
+
+        @param  nworkers           The number of available workers
+
+        @param  nips               The number of available (contiguous) multicast groups
+
+        @param  performance_table  (optional) An FbfPerformanceTable. Defaults to the table
+                                   shipped with mpikat.
+
+        @param  worker_weights     (optional) The capacity weight of each available worker
+                                   (see WorkerCapacity.weight). Defaults to reference workers.
+
+        @param  max_output_rate    (optional) The output rate budget in bits/s, e.g. the share of
+                                   the output network not committed to other products
+        """
+        if worker_weights is None:
+            worker_weights = [1.0] * nworkers
+        if len(worker_weights) != nworkers:
+            raise FbfConfigurationError("Expected {} worker weights, got {}".format(
+                nworkers, len(worker_weights)))
+        self.worker_weights = [float(weight) for weight in worker_weights]
+        self.max_output_rate = max_output_rate
+        self.channel_mode = get_channel_mode(total_nchans)
         self.total_nantennas = total_nantennas
         self.total_bandwidth = total_bandwidth
         self.total_nchans = total_nchans
         self.nworkers = nworkers
         self.nips = nips
+        # The F-engine streams are laid out for the next power of two antenna count,
+        # this sets the granularity with which channels can be assigned to workers
         self.effective_nantennas = next_power_of_two(self.total_nantennas)
         if self.effective_nantennas < MIN_ANTENNAS:
             self.effective_nantennas = MIN_ANTENNAS
-        self.nchans_per_worker = self.total_nchans / self.effective_nantennas
-        self.nchans_per_group = self.nchans_per_worker // 4
-        self.bandwidth_per_group = self.nchans_per_group * self.total_bandwidth / self.total_nchans
-        self.bandwidth_per_worker = self.bandwidth_per_group * 4
+        self.nchans_per_group = self.total_nchans // (self.effective_nantennas * N_FENG_GROUPS_PER_ANTENNA)
+        if self.nchans_per_group < 1:
+            raise FbfConfigurationError("Cannot partition {} channels between {} antennas".format(
+                self.total_nchans, self.effective_nantennas))
         self.channel_bandwidth = self.total_bandwidth / self.total_nchans
+        self.nchans_per_worker = self._max_nchans_per_worker()
+        self.bandwidth_per_group = self.nchans_per_group * self.channel_bandwidth
+        self.bandwidth_per_worker = self.nchans_per_worker * self.channel_bandwidth
+        self.effective_nchans_per_worker = (self.nchans_per_worker
+            * PERFORMANCE_TABLE_REFERENCE_NCHANS / float(self.total_nchans))
+        if performance_table is None:
+            performance_table = load_default_performance_table()
+        self.performance_table = performance_table
+
+    def _max_nchans_per_worker(self):
+        # The widest block of whole F-engine groups whose ingest rate fits on a
+        # reference worker. For power of two antenna counts this is the classic
+        # total_nchans / nantennas split, for other antenna counts it is wider.
+        rate_per_group = (self.nchans_per_group * self.channel_bandwidth
+            * self.total_nantennas * FENG_NBITS_PER_SAMPLE)
+        ngroups = min(int(MAX_INPUT_RATE_PER_WORKER / rate_per_group),
+            self.total_nchans // self.nchans_per_group)
+        if ngroups < 1:
+            raise FbfConfigurationError("A single F-engine group ({} Gb/s) exceeds the worker "
+                "ingest limit of {} Gb/s".format(rate_per_group/1e9, MAX_INPUT_RATE_PER_WORKER/1e9))
+        log.debug("Assigning up to {} F-engine groups ({} Gb/s) per worker".format(
+            ngroups, ngroups * rate_per_group/1e9))
+        return ngroups * self.nchans_per_group
 
     def _get_minimum_required_workers(self, nchans):
         return int(ceil(nchans / float(self.nchans_per_worker)))
@@ -66,54 +372,83 @@ class FbfConfigurationManager(object):
             nchans = self.nchans_per_worker * int(ceil(nchans / float(self.nchans_per_worker)))
         return nchans
 
-    def _max_nbeam_per_worker_by_performance(self, tscrunch, fscrunch, nantennas):
-        #TODO replace with look up table
-        scrunch = tscrunch * fscrunch
-        if (scrunch) < 8:
-            scale = 1.0/scrunch
-        else:
-            scale = 1.0
-        nbeams = int(700*(self.nchans_per_worker/float(nantennas)) * scale)
+    def _max_nbeam_per_worker_by_performance(self, tscrunch, fscrunch, nantennas, scale=1.0):
+        nbeams = int(self.performance_table.lookup(nantennas, self.effective_nchans_per_worker,
+            tscrunch, fscrunch) * scale)
         nbeams -= nbeams%32
         return nbeams
 
-    def _max_nbeam_per_worker_by_data_rate(self, rate_per_beam):
-        scale = self.total_nchans/self.nchans_per_worker
-        return int(MAX_OUTPUT_RATE_PER_WORKER / rate_per_beam) * scale
-
-    def _valid_nbeams_per_group(self, max_nbeams_per_group, granularity, nworker_sets=1):
-        valid = []
-        for ii in range(1, max_nbeams_per_group+1):
-            if ((ii%granularity == 0) or (granularity%ii == 0)) and (ii%nworker_sets == 0):
-                valid.append(ii)
-        if not valid:
-            raise Exception("No valid beam counts for the selected granularity "
-                "(max per group: {}, granularity: {}, nworker_sets: {})".format(
-                    max_nbeams_per_group, granularity, nworker_sets))
-        else:
-            return valid
-
-    def _max_nbeam_by_mcast_and_granularity(self, rate_per_beam, granularity):
-        max_beams_per_mcast = int(MAX_OUTPUT_RATE_PER_MCAST_GROUP / rate_per_beam)
-        valid_nbeam_per_mcast = self._valid_nbeams_per_group(max_beams_per_mcast, granularity)
-        max_beams_per_mcast = max(valid_nbeam_per_mcast)
-        max_nbeams = self.nips * max_beams_per_mcast
-        return max_nbeams
-
-    def get_configuration(self, tscrunch, fscrunch, requested_nbeams, nantennas=None, bandwidth=None, granularity=1):
-        log.info("Generating FBFUSE configuration")
-
+    def _max_nbeam_per_worker_by_data_rate(self, rate_per_beam, scale=1.0):
+        nsplits = self.total_nchans / float(self.nchans_per_worker)
+        return int(int(MAX_OUTPUT_RATE_PER_WORKER / rate_per_beam) * nsplits * scale)
+
+    def _channel_shares(self, weights, nchans):
+        # The number of F-engine multicast groups processed by each worker
+        return apportion(nchans // self.nchans_per_group, weights)
+
+    def _worker_set_scale(self, weights, nchans):
+        # The beam capacity of a worker set relative to a set of reference workers
+        # given the capacity-weighted channel split. The set is limited by the
+        # worker with the highest load relative to its capacity.
+        shares = self._channel_shares(weights, nchans)
+        ngroups = sum(shares)
+        return min(weight * ngroups / float(len(weights) * share)
+            for weight, share in zip(weights, shares) if share > 0)
+
+    def _worker_set_scales(self, nworker_sets, nworkers_per_set, nchans):
+        # Capacity scale of the weakest set when the strongest workers are split
+        # into 1, 2, ..., nworker_sets worker sets
+        if len(set(self.worker_weights)) == 1:
+            return np.full(nworker_sets, self.worker_weights[0])
+        scales = []
+        for nsets in range(1, nworker_sets + 1):
+            sets = balanced_worker_sets(self.worker_weights, nsets, nworkers_per_set)
+            scales.append(min(self._worker_set_scale([self.worker_weights[idx] for idx in workers],
+                nchans) for workers in sets))
+        return np.array(scales)
+
+    def partition_workers(self, worker_weights, nworker_sets, nchans):
+        """
+        @brief  Split a set of allocated workers into worker sets and assign channels
+
+        @param  worker_weights  The capacity weight of each allocated worker
+
+        @param  nworker_sets    The number of worker sets (see num_worker_sets)
+
+        @param  nchans          The number of channels processed by each set (see num_chans)
+
+        @return A list with one entry per worker set, each a list of
+                (worker index, first channel index, number of channels) tuples
+
+        @detail Every set processes the same channels. Within a set, channels are
+                assigned in contiguous blocks of whole F-engine multicast groups in
+                proportion to the worker capacity weights, so that higher capacity
+                workers carry more of the load. Workers may receive no channels if
+                their capacity is very small compared to the rest of their set.
+                Channel blocks follow the order of the workers in worker_weights, so
+                adjacent blocks go to neighbouring workers (WorkerPool.allocate orders
+                workers by switch and host).
+        """
+        nworkers_per_set = self._get_minimum_required_workers(nchans)
+        partition = []
+        for workers in balanced_worker_sets(worker_weights, nworker_sets, nworkers_per_set):
+            workers = sorted(workers)
+            shares = self._channel_shares([worker_weights[idx] for idx in workers], nchans)
+            offset = 0
+            assignments = []
+            for idx, share in zip(workers, shares):
+                assignments.append((idx, offset * self.nchans_per_group, share * self.nchans_per_group))
+                offset += share
+            partition.append(assignments)
+        return partition
+
+    def _valid_nbeams_per_group(self, max_nbeams_per_group, granularity):
+        nbeams = np.arange(1, max(max_nbeams_per_group, 0) + 1)
+        return nbeams[((nbeams % granularity) == 0) | ((granularity % nbeams) == 0)]
+
+    def _sanitise_request(self, nantennas, bandwidth):
         # Sanitise the user inputs with bandwidth and nantennas
         # defaulting to the full subarray and complete band
-        if granularity <= 0:
-            raise FbfConfigurationError("granularity must have a positive value")
-
-        if tscrunch <= 0:
-            raise FbfConfigurationError("tscrunch must have a positive value")
-
-        if fscrunch <= 0:
-            raise FbfConfigurationError("fscrunch must have a positive value")
-
         if not bandwidth or (bandwidth > self.total_bandwidth):
             bandwidth = self.total_bandwidth
             nchans = self.total_nchans
@@ -122,121 +457,232 @@ class FbfConfigurationManager(object):
             bandwidth = self.total_bandwidth * nchans/float(self.total_nchans)
         if not nantennas or nantennas > self.total_nantennas:
             nantennas = self.total_nantennas
-        if not nchans or nchans > self.total_nchans:
-            nchans = self.total_nchans
-        else:
-            nchans = self._sanitise_user_nchans(nchans)
-        requested_nbeams = max(MIN_NBEAMS, requested_nbeams)
         log.info("Sanitised number of antennas {}".format(nantennas))
         log.info("Sanitised bandwidth to {} MHz".format(bandwidth/1e6))
         log.info("Corresponing number of channels sanitised to {}".format(nchans))
-        rate_per_beam = bandwidth / tscrunch / fscrunch * FBF_BEAM_NBITS # bits/s
-        log.info("Data rate per beam: {} Gb/s".format(rate_per_beam/1e9))
-        total_output_rate = rate_per_beam * requested_nbeams
-        log.info("Total data rate across all requested beams: {} Gb/s".format(
-            total_output_rate/1e9))
-
-        if total_output_rate > MAX_OUTPUT_RATE:
-            nbeams_after_total_rate_limit = int(MAX_OUTPUT_RATE/rate_per_beam)
-            log.info("The requested configuration exceeds the maximum FBFUSE "
-                "output rate, limiting nbeams to {}".format(nbeams_after_total_rate_limit))
-        else:
-            nbeams_after_total_rate_limit = requested_nbeams
-
+        return nantennas, bandwidth, nchans
+
+    def _enumerate_candidates(self, tscrunch, fscrunch, nbits, max_nbeams, nantennas, bandwidth,
+                              granularity, set_scales, min_mcast_groups):
+        # Returns arrays of (nworker_sets, nbeams_per_group, nmcast_groups) for
+        # all configurations that satisfy the output rate, multicast, granularity
+        # and worker performance limits for the given scrunch factors and bit depth.
+        empty = [np.array([], dtype="int64")] * 3
+        if self.nchans_per_group % fscrunch != 0:
+            log.debug("fscrunch={} does not divide the {} channels per group".format(
+                fscrunch, self.nchans_per_group))
+            return empty
+        rate_per_beam = bandwidth / tscrunch / fscrunch * nbits # bits/s
+        log.debug("Data rate per beam for tscrunch={}, fscrunch={}, nbits={}: {} Gb/s".format(
+            tscrunch, fscrunch, nbits, rate_per_beam/1e9))
         if rate_per_beam > MAX_OUTPUT_RATE_PER_MCAST_GROUP:
-            raise FbfConfigurationError("Data rate per beam is greater than"
-                " the data rate per multicast group")
-
+            log.debug("Data rate per beam is greater than the data rate per multicast group")
+            return empty
+        max_nbeams = min(max_nbeams, int(self.max_output_rate / rate_per_beam))
+        # Beams are evenly split between worker sets, so the weakest set limits the
+        # number of beams per set for each number of sets
+        nworker_sets = len(set_scales)
+        max_nbeams_per_worker_set = np.array([min(
+            self._max_nbeam_per_worker_by_performance(tscrunch, fscrunch, nantennas, scale),
+            self._max_nbeam_per_worker_by_data_rate(rate_per_beam, scale)) for scale in set_scales])
+        log.debug("Maximum nbeams per worker set: {}".format(max_nbeams_per_worker_set.tolist()))
+        max_nbeams = min(max_nbeams, int(np.max(max_nbeams_per_worker_set
+            * np.arange(1, nworker_sets + 1))))
+        # No group can hold more than max_nbeams / min_mcast_groups beams
+        max_nbeams_per_group = min(int(MAX_OUTPUT_RATE_PER_MCAST_GROUP / rate_per_beam),
+            max_nbeams // max(min_mcast_groups, 1))
+        nbeams_per_group = self._valid_nbeams_per_group(max_nbeams_per_group, granularity)
+        # Beams in each group are evenly split between the worker sets
+        sets, groups = np.meshgrid(np.arange(1, nworker_sets + 1), nbeams_per_group, indexing="ij")
+        valid = (groups % sets) == 0
+        sets, groups = sets[valid], groups[valid]
+        if sets.size == 0:
+            return empty
+        ngroups = np.arange(1, self.nips + 1)
+        nbeams = groups[:, np.newaxis] * ngroups[np.newaxis, :]
+        feasible = ((nbeams <= max_nbeams)
+            & (nbeams >= MIN_NBEAMS)
+            & (nbeams <= (sets * max_nbeams_per_worker_set[sets - 1])[:, np.newaxis])
+            & (ngroups[np.newaxis, :] >= min_mcast_groups))
+        pair_idx, group_idx = np.nonzero(feasible)
+        return sets[pair_idx], groups[pair_idx], ngroups[group_idx]
+
+    def search_configurations(self, tscrunch, fscrunch, requested_nbeams, nantennas=None,
+                              bandwidth=None, granularity=1, objective=OBJECTIVE_NBEAMS,
+                              scrunch_options=None, nresults=DEFAULT_NALTERNATIVES+1,
+                              nbits=FBF_BEAM_NBITS):
+        """
+        @brief   Search all valid FBFUSE configurations and rank them by an objective
+
+        @param   tscrunch          The requested time scrunch factor
+
+        @param   fscrunch          The requested frequency scrunch factor
+
+        @param   requested_nbeams  The requested number of coherent beams
+
+        @param   nantennas         (optional) The number of antennas to beamform (defaults to all)
+
+        @param   bandwidth         (optional) The bandwidth to process in Hz (defaults to the full band)
+
+        @param   granularity       The number of beams per multicast group must be a multiple
+                                   or a factor of this value
+
+        @param   objective         The ranking objective, one of:
+                                   "nbeams"     - maximise the number of beams delivered (default)
+                                   "nworkers"   - minimise the number of workers used
+                                   "ngroups"    - minimise the number of multicast groups used
+                                   "resolution" - maximise the time/frequency resolution (only
+                                                  meaningful with scrunch_options)
+
+        @param   scrunch_options   (optional) A list of (tscrunch, fscrunch) pairs that may be used
+                                   instead of the requested scrunch factors
+
+        @param   nresults          The maximum number of configurations to return
+
+        @param   nbits             The number of bits per output sample (one of VALID_BEAM_NBITS)
+                                   or NBITS_AUTO to use the highest bit depth that delivers the
+                                   most beams
+
+        @return  A list of configuration dictionaries, best first. The first entry is the
+                 chosen configuration, the others are the runner-up options.
+
+        @detail  Every combination of worker set count, beams per multicast group, multicast
+                 group count, scrunch factor and bit depth is checked against the worker
+                 performance, output rate, multicast and granularity limits in a single
+                 vectorised pass.
+        """
+        log.info("Searching FBFUSE configurations")
+        if granularity <= 0:
+            raise FbfConfigurationError("granularity must have a positive value")
+        if tscrunch <= 0:
+            raise FbfConfigurationError("tscrunch must have a positive value")
+        if fscrunch <= 0:
+            raise FbfConfigurationError("fscrunch must have a positive value")
+        if objective not in CONFIGURATION_OBJECTIVES:
+            raise FbfConfigurationError("Unknown objective '{}', valid objectives are {}".format(
+                objective, CONFIGURATION_OBJECTIVES))
+        if nbits == NBITS_AUTO:
+            nbits_options = VALID_BEAM_NBITS
+        elif nbits in VALID_BEAM_NBITS:
+            nbits_options = [nbits]
+        else:
+            raise FbfConfigurationError("Invalid output bit depth '{}', valid options are {} or '{}'".format(
+                nbits, VALID_BEAM_NBITS, NBITS_AUTO))
+        if scrunch_options is None:
+            scrunch_options = [(tscrunch, fscrunch)]
+        for t, f in scrunch_options:
+            if t <= 0 or f <= 0:
+                raise FbfConfigurationError("Scrunch factors must have positive values")
+        nantennas, bandwidth, nchans = self._sanitise_request(nantennas, bandwidth)
+        requested_nbeams = max(MIN_NBEAMS, requested_nbeams)
+        if self.nips < 1:
+            raise FbfConfigurationError("No multicast groups available")
         min_num_workers = self._get_minimum_required_workers(nchans)
         log.info("Minimum number of workers required to support "
             "the input data rate: {}".format(min_num_workers))
-
-        num_workers_available = self.nworkers
-        if min_num_workers > num_workers_available:
+        if min_num_workers > self.nworkers:
             raise FbfConfigurationError("Requested configuration requires at minimum {} "
                 "workers, but only {} available".format(
-                min_num_workers, num_workers_available))
-        num_worker_sets_available = num_workers_available // min_num_workers
+                min_num_workers, self.nworkers))
+        num_worker_sets_available = self.nworkers // min_num_workers
         log.info("Number of available worker sets: {}".format(num_worker_sets_available))
+        set_scales = self._worker_set_scales(num_worker_sets_available, min_num_workers, nchans)
+        min_mcast_groups = min(MIN_MCAST_GROUPS, self.nips)
+        candidates = [[] for _ in range(6)]
+        for (t, f), b in itertools.product(scrunch_options, nbits_options):
+            sets, groups, ngroups = self._enumerate_candidates(t, f, b, requested_nbeams, nantennas,
+                bandwidth, granularity, set_scales, min_mcast_groups)
+            for idx, values in enumerate((sets, groups, ngroups,
+                    np.full(sets.size, t), np.full(sets.size, f), np.full(sets.size, b))):
+                candidates[idx].append(values)
+        sets, groups, ngroups, tscrunches, fscrunches, nbitses = [
+            np.concatenate(values) for values in candidates]
+        if sets.size == 0:
+            raise FbfConfigurationError("No valid configurations for {} beams with scrunch "
+                "options {} (granularity: {}, available workers: {}, available groups: {})".format(
+                    requested_nbeams, scrunch_options, granularity, self.nworkers, self.nips))
+        log.info("Found {} valid configurations".format(sets.size))
+        nbeams = groups * ngroups
+        if len(nbits_options) > 1:
+            # Only drop to a lower bit depth if that delivers more beams
+            best_nbits = nbitses[nbeams == nbeams.max()].max()
+            log.info("Selected {}-bit output".format(best_nbits))
+            keep = nbitses == best_nbits
+            sets, groups, ngroups, tscrunches, fscrunches, nbitses, nbeams = [
+                values[keep] for values in (sets, groups, ngroups, tscrunches, fscrunches, nbitses, nbeams)]
+        resolution = tscrunches * fscrunches
+        # np.lexsort uses the last key as the primary sort key
+        keys = {
+            OBJECTIVE_NBEAMS: (resolution, ngroups, sets, -nbeams),
+            OBJECTIVE_NWORKERS: (resolution, ngroups, -nbeams, sets),
+            OBJECTIVE_NGROUPS: (resolution, sets, -nbeams, ngroups),
+            OBJECTIVE_RESOLUTION: (ngroups, sets, -nbeams, resolution)
+        }[objective]
+        order = np.lexsort(keys)[:nresults]
+        configs = []
+        for idx in order:
+            config = {
+                "num_beams":int(nbeams[idx]),
+                "num_chans":nchans,
+                "num_mcast_groups":int(ngroups[idx]),
+                "num_beams_per_mcast_group":int(groups[idx]),
+                "num_workers_per_set":min_num_workers,
+                "num_worker_sets":int(sets[idx]),
+                "num_workers_total":int(sets[idx])*min_num_workers,
+                "num_beams_per_worker_set":int(nbeams[idx] // sets[idx]),
+                "tscrunch":tscrunches[idx].item(),
+                "fscrunch":fscrunches[idx].item(),
+                "nbits":int(nbitses[idx])
+            }
+            configs.append(config)
+        return configs
+
+    def get_configuration(self, tscrunch, fscrunch, requested_nbeams, nantennas=None, bandwidth=None,
+                          granularity=1, objective=OBJECTIVE_NBEAMS, scrunch_options=None,
+                          nbits=FBF_BEAM_NBITS):
+        """
+        @brief   Get the best FBFUSE configuration for the given request
+
+        @note    Arguments are as for search_configurations
+
+        @return  A configuration dictionary
+        """
+        log.info("Generating FBFUSE configuration")
+        configs = self.search_configurations(tscrunch, fscrunch, requested_nbeams, nantennas,
+            bandwidth, granularity, objective, scrunch_options, nbits=nbits)
+        for ii, config in enumerate(configs[1:]):
+            log.info("Runner-up configuration {}: {}".format(ii+1, config))
+        log.info("Final configuration: {}".format(configs[0]))
+        return configs[0]
 
-        a = self._max_nbeam_per_worker_by_performance(tscrunch, fscrunch, nantennas)
-        log.info("Maximum possible nbeams per worker by performance limit: {}".format(a))
-        b = self._max_nbeam_per_worker_by_data_rate(rate_per_beam)
-
-        log.info("Maximum possible nbeams per worker by data rate limit: {}".format(b))
-        max_nbeams_per_worker_set = min(a, b)
-
-        log.info("Maximum nbeams per worker: {}".format(max_nbeams_per_worker_set))
-        max_nbeams_over_all_worker_sets = max_nbeams_per_worker_set * num_worker_sets_available
-
-        mcast_beam_limit = self._max_nbeam_by_mcast_and_granularity(rate_per_beam, granularity)
-        log.info("Maximum number of beams from multicast groups and granularity: {}".format(
-            mcast_beam_limit))
-        if mcast_beam_limit < MIN_NBEAMS:
-            raise FbfConfigurationError("Multicast beam limit ({}) less than minimum generatable beams ({})".format(
-                mcast_beam_limit, MIN_NBEAMS))
-
-        nbeams_after_mcast_limit = min(nbeams_after_total_rate_limit, mcast_beam_limit, max_nbeams_over_all_worker_sets)
-        log.info("Maximum number of beams after accounting for multicast limit: {}".format(
-            nbeams_after_mcast_limit))
-
-        num_required_worker_sets = int(ceil(nbeams_after_mcast_limit / float(max_nbeams_per_worker_set)))
-        log.info("Number of required worker sets: {}".format(
-            num_required_worker_sets))
-
-        num_worker_sets_to_be_used = min(num_required_worker_sets, num_required_worker_sets, num_worker_sets_available)
-        log.info("Number of worker sets to be used: {}".format(
-            num_worker_sets_to_be_used))
-
-        num_beams_per_worker_set = nbeams_after_mcast_limit//num_worker_sets_to_be_used
-        log.info("Updated number of beams per worker set: {}".format(
-            num_beams_per_worker_set))
-
-        nbeams_after_mcast_limit = num_worker_sets_to_be_used * num_beams_per_worker_set
-        log.info("Updated total output number of beams to: {}".format(
-            nbeams_after_mcast_limit))
-
-        max_nbeams_per_group = int(MAX_OUTPUT_RATE_PER_MCAST_GROUP / rate_per_beam)
-        valid_nbeam_per_mcast = self._valid_nbeams_per_group(max_nbeams_per_group, granularity,
-            nworker_sets=num_worker_sets_to_be_used)
-        log.info("Valid numbers of beams per multicast group: {}".format(valid_nbeam_per_mcast))
-
-        max_valid_nbeam_per_mcast = max(valid_nbeam_per_mcast)
-        max_valid_nbeam_per_mcast_idx = len(valid_nbeam_per_mcast)-1
-        log.info("Max valid numbers of beams per multicast group: {}".format(max_valid_nbeam_per_mcast))
-
-        num_mcast_required_per_worker_set = int(floor(num_beams_per_worker_set / float(max_valid_nbeam_per_mcast)))
-        log.info("Number of multicast groups required per worker set: {}".format(num_mcast_required_per_worker_set))
-
-        num_mcast_required = num_mcast_required_per_worker_set * num_worker_sets_to_be_used
-        log.info("Total number of multicast groups required: {}".format(num_mcast_required))
-
-        while (num_mcast_required < MIN_MCAST_GROUPS):
-            log.debug("Too few multicast groups used, trying fewer beams per group")
-            max_valid_nbeam_per_mcast_idx -= 1
-            max_valid_nbeam_per_mcast = valid_nbeam_per_mcast[max_valid_nbeam_per_mcast_idx]
-            log.debug("Testing {} beams per group".format(max_valid_nbeam_per_mcast))
-            num_mcast_required = int(ceil(nbeams_after_mcast_limit / max_valid_nbeam_per_mcast))
-            log.debug("{} groups required".format(num_mcast_required))
-        # Final check should be over the number of beams
-        final_nbeams = num_mcast_required * max_valid_nbeam_per_mcast
-        if final_nbeams % num_worker_sets_to_be_used !=0:
-            raise Exception("Error during configuration, expected number of "
-                "beams ({}) to be a multiple of number of worker sets ({})".format(
-                    final_nbeams, num_worker_sets_to_be_used))
-        num_beams_per_worker_set = final_nbeams / num_worker_sets_to_be_used
-        config = {
-            "num_beams":final_nbeams,
-            "num_chans":nchans,
-            "num_mcast_groups":num_mcast_required,
-            "num_beams_per_mcast_group":max_valid_nbeam_per_mcast,
-            "num_workers_per_set":min_num_workers,
-            "num_worker_sets":num_worker_sets_to_be_used,
-            "num_workers_total":num_worker_sets_to_be_used*min_num_workers,
-            "num_beams_per_worker_set": num_beams_per_worker_set
-        }
-        log.info("Final coniguration: {}".format(config))
-        return config
 
+@memoize(CONFIGURATION_CACHE_SIZE)
+def estimate_configurations(total_nantennas, total_bandwidth, total_nchans, nworkers, nips,
+                            tscrunch, fscrunch, requested_nbeams, nantennas=None, bandwidth=None,
+                            granularity=1, objective=OBJECTIVE_NBEAMS, scrunch_options=None,
+                            nresults=DEFAULT_NALTERNATIVES+1, worker_weights=None,
+                            nbits=FBF_BEAM_NBITS, max_output_rate=MAX_OUTPUT_RATE):
+    """
+    @brief   Memoised search of FBFUSE configurations for planning purposes
+
+    @param   total_nantennas, total_bandwidth, total_nchans, nworkers, nips
+                 As for FbfConfigurationManager.__init__
+
+    @param   scrunch_options  (optional) A tuple of (tscrunch, fscrunch) tuples
+
+    @param   worker_weights   (optional) A tuple of worker capacity weights
+
+    @param   nbits            The output bit depth or NBITS_AUTO
+
+    @param   max_output_rate  The output rate budget in bits/s
 
+    @note    All other arguments are as for FbfConfigurationManager.search_configurations.
+             The default performance table is always used.
 
+    @return  A tuple of configuration dictionaries, best first. These are shared between
+             calls and must not be modified.
+    """
+    cm = FbfConfigurationManager(total_nantennas, total_bandwidth, total_nchans, nworkers, nips,
+        worker_weights=worker_weights, max_output_rate=max_output_rate)
+    return tuple(cm.search_configurations(tscrunch, fscrunch, requested_nbeams, nantennas,
+        bandwidth, granularity, objective, scrunch_options, nresults, nbits))
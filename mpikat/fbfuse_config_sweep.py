@@ -0,0 +1,132 @@
+"""
+Copyright (c) 2018 Ewan Barr <ebarr@mpifr-bonn.mpg.de>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import logging
+import itertools
+from optparse import OptionParser
+from mpikat.fbfuse_config import (estimate_configurations, FbfConfigurationError,
+    OBJECTIVE_NBEAMS, CONFIGURATION_OBJECTIVES, FBF_BEAM_NBITS, NBITS_AUTO)
+
+log = logging.getLogger("mpikat.fbfuse_config_sweep")
+
+SWEEP_COLUMNS = ["tscrunch", "fscrunch", "requested_nbeams", "nantennas", "bandwidth",
+    "num_beams", "num_mcast_groups", "num_beams_per_mcast_group", "num_worker_sets",
+    "num_workers_total", "nbits"]
+
+def sweep_configurations(total_nantennas, total_bandwidth, total_nchans, nworkers, nips,
+                         tscrunches, fscrunches, nbeams, nantennas, bandwidths,
+                         granularity=1, objective=OBJECTIVE_NBEAMS, nbits=FBF_BEAM_NBITS):
+    """
+    @brief   Find the best configuration at every point of a parameter grid
+
+    @param   total_nantennas, total_bandwidth, total_nchans, nworkers, nips
+                 As for FbfConfigurationManager.__init__
+
+    @param   tscrunches, fscrunches, nbeams, nantennas, bandwidths
+                 Lists of values to sweep over
+
+    @param   granularity, objective, nbits
+                 As for FbfConfigurationManager.search_configurations
+
+    @return  A list of dictionaries with keys SWEEP_COLUMNS. Configurations that
+             cannot be satisfied have None for all configuration values.
+    """
+    rows = []
+    for tscrunch, fscrunch, nbeam, nantenna, bandwidth in itertools.product(
+            tscrunches, fscrunches, nbeams, nantennas, bandwidths):
+        row = {
+            "tscrunch": tscrunch,
+            "fscrunch": fscrunch,
+            "requested_nbeams": nbeam,
+            "nantennas": nantenna,
+            "bandwidth": bandwidth
+            }
+        try:
+            config = estimate_configurations(total_nantennas, total_bandwidth, total_nchans,
+                nworkers, nips, tscrunch, fscrunch, nbeam, nantenna, bandwidth,
+                granularity, objective, nbits=nbits)[0]
+        except FbfConfigurationError as error:
+            log.debug("No configuration for {}: {}".format(row, str(error)))
+            config = {}
+        for column in SWEEP_COLUMNS[5:]:
+            row[column] = config.get(column)
+        rows.append(row)
+    return rows
+
+def _parse_list(value, dtype):
+    return [dtype(item) for item in value.split(",")]
+
+def main():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('', '--total_nantennas', dest='total_nantennas', type=int, default=64,
+        help='Number of antennas in the subarray')
+    parser.add_option('', '--total_bandwidth', dest='total_bandwidth', type=float, default=856e6,
+        help='Total bandwidth of the F-engine output in Hz')
+    parser.add_option('', '--total_nchans', dest='total_nchans', type=int, default=4096,
+        help='Total number of F-engine channels')
+    parser.add_option('', '--nworkers', dest='nworkers', type=int, default=64,
+        help='Number of available workers')
+    parser.add_option('', '--nips', dest='nips', type=int, default=127,
+        help='Number of available multicast groups')
+    parser.add_option('-t', '--tscrunch', dest='tscrunch', type=str, default="1,2,4,8,16",
+        help='Comma separated list of tscrunch factors')
+    parser.add_option('-f', '--fscrunch', dest='fscrunch', type=str, default="1,2,4",
+        help='Comma separated list of fscrunch factors')
+    parser.add_option('-n', '--nbeams', dest='nbeams', type=str, default="100,400,1000",
+        help='Comma separated list of requested beam counts')
+    parser.add_option('-a', '--nantennas', dest='nantennas', type=str, default="16,32,64",
+        help='Comma separated list of antenna counts')
+    parser.add_option('-b', '--bandwidth', dest='bandwidth', type=str, default="856e6",
+        help='Comma separated list of bandwidths in Hz')
+    parser.add_option('-g', '--granularity', dest='granularity', type=int, default=1,
+        help='Beam granularity of the multicast groups')
+    parser.add_option('', '--objective', dest='objective', type=str, default=OBJECTIVE_NBEAMS,
+        help='Configuration objective, one of {}'.format(CONFIGURATION_OBJECTIVES))
+    parser.add_option('', '--nbits', dest='nbits', type=str, default=str(FBF_BEAM_NBITS),
+        help='Output bits per sample (8, 4 or 2) or "{}"'.format(NBITS_AUTO))
+    parser.add_option('', '--csv', dest='csv', action='store_true', default=False,
+        help='Output as CSV rather than a table')
+    parser.add_option('', '--log_level',dest='log_level',type=str,
+        help='Logging level',default="WARN")
+    (opts, args) = parser.parse_args()
+    logging.basicConfig(format="[ %(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s")
+    logging.getLogger("mpikat").setLevel(opts.log_level.upper())
+    rows = sweep_configurations(opts.total_nantennas, opts.total_bandwidth, opts.total_nchans,
+        opts.nworkers, opts.nips,
+        _parse_list(opts.tscrunch, int), _parse_list(opts.fscrunch, int),
+        _parse_list(opts.nbeams, int), _parse_list(opts.nantennas, int),
+        _parse_list(opts.bandwidth, float), opts.granularity, opts.objective,
+        opts.nbits if opts.nbits == NBITS_AUTO else int(opts.nbits))
+    if opts.csv:
+        print(",".join(SWEEP_COLUMNS))
+        for row in rows:
+            print(",".join(["" if row[column] is None else str(row[column]) for column in SWEEP_COLUMNS]))
+    else:
+        header = ["tsc", "fsc", "req", "nant", "bw (MHz)", "nbeams", "ngroups", "per group", "sets", "workers", "nbits"]
+        print(" ".join(["{:>9}".format(name) for name in header]))
+        for row in rows:
+            values = [row[column] for column in SWEEP_COLUMNS]
+            values[4] = "{:.1f}".format(values[4]/1e6)
+            print(" ".join(["{:>9}".format("-" if value is None else value) for value in values]))
+
+if __name__ == "__main__":
+    main()
@@ -27,10 +27,10 @@ import numpy as np
 from collections import OrderedDict
 from mmap import mmap
 from tornado.gen import coroutine
-from tornado.ioloop import PeriodicCallback
+from tornado.ioloop import IOLoop, PeriodicCallback
 from katpoint import Antenna, Target
 from mosaic import DelayPolynomial
-from mpikat.utils import Timer
+from mpikat.utils import Timer, next_epoch_boundary
 
 log = logging.getLogger("mpikat.fbfuse_delay_buffer_controller")
 
@@ -68,6 +68,7 @@ class DelayBufferController(object):
         self._update_rate = DEFAULT_UPDATE_RATE
         self._delay_span = DEFAULT_DELAY_SPAN
         self._update_callback = None
+        self._update_start_handle = None
         self._beam_callbacks = {}
 
     def unlink_all(self):
@@ -152,7 +153,13 @@ class DelayBufferController(object):
 
         self._shared_buffer_mmap = mmap(self._shared_buffer.fd, self._shared_buffer.size)
         self._update_callback = PeriodicCallback(self._safe_update_delays, self._update_rate*1000)
-        self._update_callback.start()
+        # Delay model updates are aligned to multiples of the update rate in unix time so
+        # that beam position changes made away from a boundary (the product controller
+        # swaps dynamic tilings mid-interval) have arrived at every worker before the next
+        # update
+        self._update_start_handle = IOLoop.current().call_at(
+            next_epoch_boundary(time.time(), self._update_rate),
+            self._update_callback.start)
 
     def stop(self):
         """
@@ -162,6 +169,7 @@ class DelayBufferController(object):
                  any sensor callbacks and trigger the closing and unlinking of
                  posix IPC objects.
         """
+        IOLoop.current().remove_timeout(self._update_start_handle)
         self._update_callback.stop()
         self.deregister_callbacks()
         log.debug("Closing shared memory mmap and file descriptor")
@@ -32,15 +32,19 @@ from threading import Lock
 from optparse import OptionParser
 from tornado.gen import Return, coroutine
 from katcp import Sensor, Message, AsyncDeviceServer, KATCPClientResource, AsyncReply
-from katcp.kattypes import request, return_reply, Int, Str, Discrete, Float
+from katcp.kattypes import request, return_reply, Int, Str, Discrete, Float, Bool
 from katportalclient import KATPortalClient
 from katpoint import Antenna, Target
-from mpikat.master_controller import MasterController, ProductLookupError, ProductExistsError
-from mpikat.ip_manager import IpRangeManager, ip_range_from_stream
+from mpikat.master_controller import (MasterController, ProductLookupError, ProductExistsError,
+    load_node_file)
+from mpikat.ip_manager import IpPoolManager, ip_ranges_from_streams
 from mpikat.katportalclient_wrapper import KatportalClientWrapper
 from mpikat.fbfuse_worker_wrapper import FbfWorkerPool
-from mpikat.fbfuse_beam_manager import BeamManager
+from mpikat.fbfuse_beam_manager import (BeamManager, MOSAIC_TILING, TILING_METHODS,
+    EPOCH_AUTO, DEFAULT_AUTO_EPOCH_DURATION)
 from mpikat.fbfuse_product_controller import FbfProductController
+from mpikat.fbfuse_config import FENG_CHANNEL_MODES, MAX_OUTPUT_RATE
+from mpikat.fbfuse_bandwidth_ledger import FbfBandwidthLedger
 from mpikat.utils import parse_csv_antennas, is_power_of_two, next_power_of_two, AntennaValidationError
 
 # ?halt message means shutdown everything and power off all machines
@@ -64,22 +68,33 @@ class FbfMasterController(MasterController):
     BUILD_INFO = ("mpikat-fbf-implementation", 0, 1, "rc1")
     DEVICE_STATUSES = ["ok", "degraded", "fail"]
     def __init__(self, ip, port, dummy=True,
-        ip_range = FBF_IP_RANGE):
+        ip_range = FBF_IP_RANGE, ip_policy="best-fit", auto_compact=False):
         """
         @brief       Construct new FbfMasterController instance
 
-        @params  ip       The IP address on which the server should listen
-        @params  port     The port that the server should bind to
-        @params  dummy    Specifies if the instance is running in a dummy mode
+        @params  ip         The IP address on which the server should listen
+        @params  port       The port that the server should bind to
+        @params  dummy      Specifies if the instance is running in a dummy mode
+        @params  ip_range   A comma separated list of multicast ranges (in stream notation,
+                            e.g. spead://239.11.1.0+127:7147) available for beam output
+        @params  ip_policy  The placement policy used to allocate from the output ranges
+                            (see mpikat.ip_manager.PLACEMENT_POLICIES)
+        @params  auto_compact  Relocate the output groups of idle products to coalesce free
+                               addresses whenever a product stops capturing or is deconfigured
 
         @note   In dummy mode, the controller will act as a mock interface only, sending no requests to nodes.
                 A valid node pool must still be provided to the instance, but this may point to non-existent nodes.
 
         """
-        self._ip_pool = IpRangeManager(ip_range_from_stream(ip_range))
+        self._ip_pool = IpPoolManager(ip_ranges_from_streams(ip_range), ip_policy,
+            self._update_ip_pool_sensors)
+        self._auto_compact = auto_compact
+        self._bandwidth_ledger = FbfBandwidthLedger(MAX_OUTPUT_RATE, self._update_bandwidth_sensors)
         super(FbfMasterController, self).__init__(ip, port, FbfWorkerPool())
         self._dummy = dummy
         if self._dummy:
+            # Dummy workers do not exist so cannot be health probed
+            self._health_probe_period = None
             for ii in range(64):
                 self._server_pool.add("127.0.0.1", 50000+ii)
 
@@ -96,6 +111,89 @@ class FbfMasterController(MasterController):
             initial_status=Sensor.NOMINAL)
         self.add_sensor(self._ip_pool_sensor)
 
+        self._output_rate_sensor = Sensor.float(
+            "output-rate-committed",
+            description="The total output data rate committed to all products",
+            unit="bits/s",
+            default=0.0,
+            initial_status=Sensor.NOMINAL)
+        self.add_sensor(self._output_rate_sensor)
+
+        self._ingest_rate_sensor = Sensor.float(
+            "ingest-rate-committed",
+            description="The total F-engine ingest data rate committed to all products",
+            unit="bits/s",
+            default=0.0,
+            initial_status=Sensor.NOMINAL)
+        self.add_sensor(self._ingest_rate_sensor)
+
+        self._ip_free_sensor = Sensor.integer(
+            "output-ip-free",
+            description="The number of free output multicast addresses",
+            default=self._ip_pool.nfree(),
+            initial_status=Sensor.NOMINAL)
+        self.add_sensor(self._ip_free_sensor)
+
+        self._ip_largest_free_sensor = Sensor.integer(
+            "output-ip-largest-free-run",
+            description="The number of addresses in the largest contiguous run of free output multicast addresses",
+            default=self._ip_pool.largest_free_range(),
+            initial_status=Sensor.NOMINAL)
+        self.add_sensor(self._ip_largest_free_sensor)
+
+        self._ip_fragmentation_sensor = Sensor.float(
+            "output-ip-fragmentation",
+            description="Fragmentation index of the free output multicast addresses "
+                        "(1 - largest free run / free addresses)",
+            default=self._ip_pool.fragmentation(),
+            initial_status=Sensor.NOMINAL)
+        self.add_sensor(self._ip_fragmentation_sensor)
+
+    def _update_ip_pool_sensors(self):
+        self._ip_free_sensor.set_value(self._ip_pool.nfree())
+        self._ip_largest_free_sensor.set_value(self._ip_pool.largest_free_range())
+        self._ip_fragmentation_sensor.set_value(self._ip_pool.fragmentation())
+
+    def compact_ip_pool(self, apply_plan=False):
+        """
+        @brief      Plan (and optionally apply) the relocation of the output multicast
+                    groups of idle products to coalesce free addresses
+
+        @param      apply_plan   If True, move the allocations and update the products
+
+        @return     A list of (product ID, old allocation, new allocation) tuples
+        """
+        owners = []
+        for product_id, product in self._products.items():
+            if product.idle:
+                owners.extend((product, allocation) for allocation in product.mcast_allocations())
+        plan = self._ip_pool.plan_compaction([allocation for _, allocation in owners])
+        moves = []
+        for old, new in plan:
+            product = [owner for owner, allocation in owners if allocation is old][0]
+            moves.append((product, old, new))
+        if apply_plan and moves:
+            self._ip_pool.apply_compaction(plan)
+            for product in set(product for product, _, _ in moves):
+                product.relocate_mcast_groups([(old, new) for owner, old, new in moves
+                    if owner is product])
+        return [(product._product_id, old, new) for product, old, new in moves]
+
+    def _auto_compact_ip_pool(self):
+        if not self._auto_compact:
+            return
+        try:
+            moves = self.compact_ip_pool(apply_plan=True)
+        except Exception:
+            log.exception("Failed to compact output multicast pool")
+            return
+        if moves:
+            log.info("Compacted output multicast pool with {} relocations".format(len(moves)))
+
+    def _update_bandwidth_sensors(self):
+        self._output_rate_sensor.set_value(self._bandwidth_ledger.committed_output_rate())
+        self._ingest_rate_sensor.set_value(self._bandwidth_ledger.committed_ingest_rate())
+
     @request(Str(), Str(), Int(), Str(), Str())
     @return_reply()
     def request_configure(self, req, product_id, antennas_csv, n_channels, streams_json, proxy_name):
@@ -187,7 +285,7 @@ class FbfMasterController(MasterController):
         except AntennaValidationError as error:
             return ("fail", str(error))
 
-        valid_n_channels = [1024, 4096, 32768]
+        valid_n_channels = sorted(FENG_CHANNEL_MODES.keys())
         if not n_channels in valid_n_channels:
             return ("fail", "The provided number of channels ({}) is not valid. Valid options are {}".format(n_channels, valid_n_channels))
 
@@ -294,6 +392,7 @@ class FbfMasterController(MasterController):
             return ("fail", str(error))
         del self._products[product_id]
         self._update_products_sensor()
+        self._auto_compact_ip_pool()
         return ("ok",)
 
 
@@ -448,6 +547,7 @@ class FbfMasterController(MasterController):
         @coroutine
         def stop():
             product.capture_stop()
+            self._auto_compact_ip_pool()
             req.reply("ok",)
         self.ioloop.add_callback(stop)
         raise AsyncReply
@@ -523,9 +623,11 @@ class FbfMasterController(MasterController):
         beam = product.add_beam(target)
         return ("ok", beam.idx)
 
-    @request(Str(), Str(), Int(), Float(), Float(), Float())
+    @request(Str(), Str(), Int(), Float(), Float(), Str(), Str(default=MOSAIC_TILING),
+        Float(default=DEFAULT_AUTO_EPOCH_DURATION))
     @return_reply(Str())
-    def request_add_tiling(self, req, product_id, target, nbeams, reference_frequency, overlap, epoch):
+    def request_add_tiling(self, req, product_id, target, nbeams, reference_frequency, overlap, epoch,
+                           method, duration):
         """
         @brief      Configure the parameters of a static beam tiling
 
@@ -560,7 +662,16 @@ class FbfMasterController(MasterController):
                                     be to set the epoch to half way into the coming observation in order to minimise
                                     the effect of parallactic angle and array projection changes altering the shape
                                     and position of the beams and thus changing the efficiency of the tiling pattern.
+                                    Alternatively, if set to "auto" the epoch that maximises the time-averaged tiling
+                                    coverage over the next 'duration' seconds will be used.
+
+        @param      method          (optional) The tiling generator to use. Valid options are "mosaic" (default)
+                                    and "hexagonal". The hexagonal generator places beams directly on a rotated
+                                    hexagonal grid matched to the beam shape and is significantly faster for
+                                    large numbers of beams.
 
+        @param      duration        (optional) The expected duration of the observation in seconds. This is only
+                                    used when the epoch is "auto". Defaults to one hour.
 
         @return     katcp reply object [[[ !add-tiling ok | (fail [error description]) ]]]
         """
@@ -572,9 +683,138 @@ class FbfMasterController(MasterController):
             target = Target(target)
         except Exception as error:
             return ("fail", str(error))
-        tiling = product.add_tiling(target, nbeams, reference_frequency, overlap, epoch)
+        if method not in TILING_METHODS:
+            return ("fail", "Unknown tiling method '{}', valid methods are {}".format(method, TILING_METHODS))
+        if epoch != EPOCH_AUTO:
+            try:
+                epoch = float(epoch)
+            except ValueError:
+                return ("fail", "Epoch must be either a unix time or '{}'".format(EPOCH_AUTO))
+        tiling = product.add_tiling(target, nbeams, reference_frequency, overlap, epoch,
+            method=method, duration=duration)
         return ("ok", tiling.idxs())
 
+    @request(Str(), Float(), Float(), Float())
+    @return_reply(Str())
+    def request_beam_lookup(self, req, product_id, ra, dec, radius):
+        """
+        @brief      Find the coherent beams covering a given sky position
+
+        @note       This call may only be made AFTER a successful call to start-beams. Before this point no beams are
+                    allocated to the instance.
+
+        @param      req             A katcp request object
+
+        @param      product_id      This is a name for the data product, used to track which subarray is being deconfigured.
+                                    For example "array_1_bc856M4k".
+
+        @param      ra              The right ascension of the search position in degrees
+
+        @param      dec             The declination of the search position in degrees
+
+        @param      radius          The search radius in degrees
+
+        @return     katcp reply object [[[ !beam-lookup ok <comma separated beam IDs> | (fail [error description]) ]]]
+
+        @note       Beam IDs are sorted by distance from the search position, closest first.
+        """
+        try:
+            product = self._get_product(product_id)
+        except ProductLookupError as error:
+            return ("fail", str(error))
+        if radius < 0.0:
+            return ("fail", "Search radius must be non-negative")
+        try:
+            beams = product.lookup_beams(ra, dec, radius)
+        except Exception as error:
+            return ("fail", str(error))
+        return ("ok", ",".join([beam.idx for beam in beams]))
+
+    @request(Str(), Str())
+    @return_reply(Str())
+    def request_estimate_configuration(self, req, product_id, config_json):
+        """
+        @brief      Estimate the FBFUSE configuration a schedule block configuration would receive
+
+        @note       This is a dry run, no workers or multicast groups are allocated. The estimate is
+                    made against the currently free worker and multicast group pools.
+
+        @param      req             A katcp request object
+
+        @param      product_id      This is a name for the data product, used to track which subarray is being deconfigured.
+                                    For example "array_1_bc856M4k".
+
+        @param      config_json     A JSON dictionary of schedule block configuration parameters, e.g.
+                                    {"coherent-beams-nbeams":400, "coherent-beams-tscrunch":16}. Parameters not
+                                    specified take their default values.
+
+        @note       The best configuration is returned in the reply and each runner-up configuration is
+                    provided as an #inform as a JSON string.
+
+        @return     katcp reply object [[[ !estimate-configuration ok <configuration JSON> | (fail [error description]) ]]]
+        """
+        try:
+            product = self._get_product(product_id)
+        except ProductLookupError as error:
+            return ("fail", str(error))
+        try:
+            config_dict = json.loads(config_json)
+            configs = product.estimate_sb_configuration(config_dict)
+        except Exception as error:
+            return ("fail", str(error))
+        for config in configs[1:]:
+            req.inform(json.dumps(config))
+        return ("ok", json.dumps(configs[0]))
+
+    @request()
+    @return_reply(Int())
+    def request_bandwidth_ledger(self, req):
+        """
+        @brief      List the network bandwidth committed by each product
+
+        @param      req               A katcp request object
+
+        @note       The commitment of each product is provided via an #inform as a JSON
+                    string containing the total output and ingest rates and the rates of
+                    each worker and output multicast group (all in bits/s). A final #inform
+                    gives the remaining output rate budget.
+
+        @return     katcp reply object [[[ !bandwidth-ledger ok | (fail [error description]) <number of products with commitments> ]]],
+        """
+        products = self._bandwidth_ledger.products()
+        for product_id in products:
+            req.inform(json.dumps({product_id: self._bandwidth_ledger.product_commitment(product_id)}))
+        req.inform(json.dumps({"remaining-output-rate": self._bandwidth_ledger.remaining_output_rate()}))
+        return ("ok", len(products))
+
+    @request(Bool(default=False))
+    @return_reply(Int())
+    def request_compact_ip_pool(self, req, apply_plan):
+        """
+        @brief      Plan the relocation of idle products' output multicast groups to
+                    coalesce free addresses
+
+        @param      req               A katcp request object
+
+        @param      apply_plan        (optional) If true, apply the plan (default: false)
+
+        @note       Each planned relocation is provided via an #inform as a JSON string
+                    containing the product ID and the old and new allocations. Only
+                    products in the idle state are relocated, and a plan is only made if
+                    it would increase the largest free run.
+
+        @return     katcp reply object [[[ !compact-ip-pool ok | (fail [error description]) <number of relocations> ]]],
+        """
+        try:
+            moves = self.compact_ip_pool(apply_plan)
+        except Exception as error:
+            log.exception("Failed to compact output multicast pool")
+            return ("fail", str(error))
+        for product_id, old, new in moves:
+            req.inform(json.dumps({"product": product_id, "old": old.format_katcp(),
+                "new": new.format_katcp()}))
+        return ("ok", len(moves))
+
     @request()
     @return_reply(Int())
     def request_product_list(self, req):
@@ -661,6 +901,21 @@ def on_shutdown(ioloop, server):
     yield server.stop()
     ioloop.stop()
 
+@coroutine
+def register_nodes(server, filename):
+    log.info("Registering worker servers from {}".format(filename))
+    try:
+        specs = load_node_file(filename)
+        results = yield server.register_workers(specs)
+    except Exception:
+        log.exception("Failed to register worker servers from {}".format(filename))
+        return
+    for result in results:
+        if result["status"] != "ok":
+            log.warning("Worker registration {}: {}".format(result["status"], json.dumps(result)))
+    log.info("Registered {} of {} worker servers".format(
+        len([result for result in results if result["status"] != "fail"]), len(results)))
+
 def main():
     usage = "usage: %prog [options]"
     parser = OptionParser(usage=usage)
@@ -672,6 +927,14 @@ def main():
         help='Port number of status server instance',default="INFO")
     parser.add_option('', '--dummy',action="store_true", dest='dummy',
         help='Set status server to dummy')
+    parser.add_option('', '--ip_range', dest='ip_range', type=str,
+        help='Comma separated list of multicast ranges for beam output', default=FBF_IP_RANGE)
+    parser.add_option('', '--ip_policy', dest='ip_policy', type=str,
+        help='Placement policy for output multicast ranges', default="best-fit")
+    parser.add_option('', '--auto_compact', action="store_true", dest='auto_compact',
+        help='Relocate idle products to coalesce output multicast ranges', default=False)
+    parser.add_option('-n', '--nodes', dest='nodes', type=str, default=None,
+        help='Path to a node file listing the worker servers to register')
     (opts, args) = parser.parse_args()
     logger = logging.getLogger('mpikat')
     coloredlogs.install(
@@ -681,12 +944,15 @@ def main():
     logging.getLogger('katcp').setLevel('INFO')
     ioloop = tornado.ioloop.IOLoop.current()
     log.info("Starting FbfMasterController instance")
-    server = FbfMasterController(opts.host, opts.port, dummy=opts.dummy)
+    server = FbfMasterController(opts.host, opts.port, dummy=opts.dummy,
+        ip_range=opts.ip_range, ip_policy=opts.ip_policy, auto_compact=opts.auto_compact)
     signal.signal(signal.SIGINT, lambda sig, frame: ioloop.add_callback_from_signal(
         on_shutdown, ioloop, server))
     def start_and_display():
         server.start()
         log.info("Listening at {0}, Ctrl-C to terminate server".format(server.bind_address))
+        if opts.nodes:
+            server.ioloop.add_callback(register_nodes, server, opts.nodes)
 
     ioloop.add_callback(start_and_display)
     ioloop.start()
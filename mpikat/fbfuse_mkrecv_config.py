@@ -85,6 +85,6 @@ IDX3_LIST   {{frequency_partition_ids_csv}}
 def make_mkrecv_header(params, outfile=None):
     rendered = jinja2.Template(HEADER_TEMPLATE).render(params)
     if outfile:
-        with open(outfile) as f:
+        with open(outfile, "w") as f:
             f.write(rendered)
     return rendered
\ No newline at end of file
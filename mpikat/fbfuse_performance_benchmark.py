@@ -0,0 +1,172 @@
+"""
+Copyright (c) 2018 Ewan Barr <ebarr@mpifr-bonn.mpg.de>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import logging
+import shlex
+import socket
+import time
+import numpy as np
+from subprocess import check_output
+from optparse import OptionParser
+from mpikat.fbfuse_config import (FbfPerformanceTable, PERFORMANCE_TABLE_AXES,
+    DEFAULT_PERFORMANCE_TABLE)
+
+log = logging.getLogger("mpikat.fbfuse_performance_benchmark")
+
+DEFAULT_AXES = {
+    "nantennas": [4, 8, 16, 32, 64],
+    "nchans": [16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192],
+    "tscrunch": [1, 2, 4, 8, 16, 32],
+    "fscrunch": [1, 2, 4, 8, 16]
+}
+NBEAM_GRANULARITY = 32
+DEFAULT_MAX_NBEAMS = 8192
+DEFAULT_HEADROOM = 0.8
+
+
+def legacy_capacity(nantennas, nchans, tscrunch, fscrunch):
+    """
+    @brief  The heuristic capacity model that was used before measured tables were available
+
+    @note   This is used to seed the default performance table and should be replaced by
+            measurements made with measure_capacity on the target hardware.
+    """
+    scrunch = tscrunch * fscrunch
+    if scrunch < 8:
+        scale = 1.0/scrunch
+    else:
+        scale = 1.0
+    return 700*(nchans/float(nantennas)) * scale
+
+
+def run_benchmark(command, nantennas, nchans, tscrunch, fscrunch, nbeams):
+    """
+    @brief  Run one beamformer benchmark
+
+    @param  command   A command template with {nantennas}, {nchans}, {tscrunch}, {fscrunch}
+                      and {nbeams} fields. The command must print the ratio of processing
+                      time to observing time (i.e. < 1 for faster than real time) as the
+                      last line of its output.
+
+    @return The real time ratio reported by the benchmark
+    """
+    cmd = shlex.split(command.format(nantennas=nantennas, nchans=nchans,
+        tscrunch=tscrunch, fscrunch=fscrunch, nbeams=nbeams))
+    log.debug("Running benchmark: '{}'".format(" ".join(cmd)))
+    output = check_output(cmd)
+    ratio = float(output.strip().splitlines()[-1])
+    log.debug("Real time ratio: {}".format(ratio))
+    return ratio
+
+
+def measure_capacity(command, nantennas, nchans, tscrunch, fscrunch,
+                     headroom=DEFAULT_HEADROOM, max_nbeams=DEFAULT_MAX_NBEAMS):
+    """
+    @brief  Find the largest number of beams (in multiples of NBEAM_GRANULARITY) that can be
+            processed within the given fraction of real time
+
+    @note   Uses a bisection search so only log2(max_nbeams/NBEAM_GRANULARITY) benchmarks
+            are run per grid point. Processing time is assumed to increase with nbeams.
+    """
+    low, high = 0, max_nbeams // NBEAM_GRANULARITY
+    while low < high:
+        mid = (low + high + 1) // 2
+        if run_benchmark(command, nantennas, nchans, tscrunch, fscrunch,
+                         mid * NBEAM_GRANULARITY) <= headroom:
+            low = mid
+        else:
+            high = mid - 1
+    return low * NBEAM_GRANULARITY
+
+
+def generate_table(axes, capacity, metadata=None):
+    """
+    @brief  Evaluate a capacity function at every point of a grid
+
+    @param  axes      A dictionary mapping each of PERFORMANCE_TABLE_AXES to a list of values
+
+    @param  capacity  A function taking (nantennas, nchans, tscrunch, fscrunch) and returning
+                      the maximum number of beams per worker
+
+    @param  metadata  (optional) A dictionary of information on the table origin
+
+    @return A FbfPerformanceTable instance
+    """
+    shape = [len(axes[name]) for name in PERFORMANCE_TABLE_AXES]
+    max_nbeams = np.zeros(shape)
+    for index in np.ndindex(*shape):
+        args = [axes[name][ii] for name, ii in zip(PERFORMANCE_TABLE_AXES, index)]
+        max_nbeams[index] = capacity(*args)
+        log.info("{}: {}".format(dict(zip(PERFORMANCE_TABLE_AXES, args)), max_nbeams[index]))
+    return FbfPerformanceTable(axes, max_nbeams, metadata)
+
+
+def main():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--command', dest='command', type=str, default=None,
+        help=('Benchmark command template with {nantennas}, {nchans}, {tscrunch}, {fscrunch} '
+              'and {nbeams} fields that prints the real time ratio as its last line of output'))
+    parser.add_option('-o', '--output', dest='output', type=str, default=DEFAULT_PERFORMANCE_TABLE,
+        help='Output JSON file for the performance table')
+    parser.add_option('', '--headroom', dest='headroom', type=float, default=DEFAULT_HEADROOM,
+        help='Maximum allowed fraction of real time')
+    parser.add_option('', '--max_nbeams', dest='max_nbeams', type=int, default=DEFAULT_MAX_NBEAMS,
+        help='Upper limit for the number of beams searched')
+    parser.add_option('', '--legacy', dest='legacy', action='store_true', default=False,
+        help='Generate the table from the legacy heuristic rather than by measurement')
+    for name in PERFORMANCE_TABLE_AXES:
+        parser.add_option('', '--{}'.format(name), dest=name, type=str,
+            default=",".join([str(value) for value in DEFAULT_AXES[name]]),
+            help='Comma separated grid values for {}'.format(name))
+    parser.add_option('', '--log_level',dest='log_level',type=str,
+        help='Logging level',default="INFO")
+    (opts, args) = parser.parse_args()
+    logging.basicConfig(format="[ %(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s")
+    log.setLevel(opts.log_level.upper())
+    axes = {name: [int(value) for value in getattr(opts, name).split(",")]
+        for name in PERFORMANCE_TABLE_AXES}
+    if opts.legacy:
+        metadata = {
+            "source": "legacy heuristic",
+            "description": ("Seeded from the heuristic capacity model previously hard coded in "
+                "FbfConfigurationManager. Regenerate from measurements with "
+                "mpikat.fbfuse_performance_benchmark.")
+            }
+        capacity = legacy_capacity
+    elif opts.command is None:
+        parser.error("A benchmark command is required unless --legacy is specified")
+    else:
+        metadata = {
+            "source": "measured",
+            "command": opts.command,
+            "headroom": opts.headroom,
+            "host": socket.gethostname(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
+            }
+        capacity = lambda *args: measure_capacity(opts.command, *args,
+            headroom=opts.headroom, max_nbeams=opts.max_nbeams)
+    table = generate_table(axes, capacity, metadata)
+    table.save(opts.output)
+    log.info("Wrote performance table to {}".format(opts.output))
+
+if __name__ == "__main__":
+    main()
@@ -24,16 +24,22 @@ import logging
 import json
 import time
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from tornado.gen import coroutine, Return
+from tornado.ioloop import PeriodicCallback
 from katcp import Sensor, Message, KATCPClientResource
 from katpoint import  Target, Antenna
-from mpikat.fbfuse_beam_manager import BeamManager
+from mpikat.fbfuse_beam_manager import (BeamManager, get_beam_shape, optimal_tiling_epoch,
+    DEFAULT_COVERAGE_THRESHOLD, MOSAIC_TILING, EPOCH_AUTO, DEFAULT_AUTO_EPOCH_DURATION)
+from mpikat.fbfuse_delay_buffer_controller import DEFAULT_UPDATE_RATE
 from mpikat.fbfuse_delay_configuration_server import DelayConfigurationServer
-from mpikat.fbfuse_config import FbfConfigurationManager
-from mpikat.ip_manager import ip_range_from_stream
-from mpikat.utils import parse_csv_antennas, LoggingSensor
+from mpikat.fbfuse_config import (FbfConfigurationManager, OBJECTIVE_NBEAMS, estimate_configurations,
+    split_beams_between_sets, FBF_BEAM_NBITS, FENG_NBITS_PER_SAMPLE)
+from mpikat.ip_manager import ContiguousIpRange, ip_range_from_stream
+from mpikat.utils import parse_csv_antennas, LoggingSensor, next_epoch_boundary
 
-N_FENG_STREAMS_PER_WORKER = 4
+DYNAMIC_TILING_CHECK_PERIOD = 60.0 # seconds
+MAX_OUTPUT_IP_RUNS = 4 # maximum number of non-contiguous runs for coherent beam groups
 
 log = logging.getLogger("mpikat.fbfuse_product_controller")
 
@@ -86,6 +92,8 @@ class FbfProductController(object):
         self._proxy_name = proxy_name
         self._feng_config = feng_config
         self._servers = []
+        self._previous_servers = []
+        self._partition_plan = []
         self._beam_manager = None
         self._delay_config_server = None
         self._ca_client = None
@@ -93,12 +101,20 @@ class FbfProductController(object):
         self._managed_sensors = []
         self._ibc_mcast_group = None
         self._cbc_mcast_groups = None
+        self._ca_beams = []
+        self._ca_tilings = []
+        self._dynamic_tiling_callback = None
+        self._updating_dynamic_tilings = False
+        self._pending_tiling_swaps = set()
+        self._tiling_executor = ThreadPoolExecutor(max_workers=1)
         self._default_sb_config = {
             u'coherent-beams-nbeams':400,
             u'coherent-beams-tscrunch':16,
             u'coherent-beams-fscrunch':1,
             u'coherent-beams-antennas':self._antennas,
             u'coherent-beams-granularity':6,
+            u'coherent-beams-objective':OBJECTIVE_NBEAMS,
+            u'coherent-beams-nbits':FBF_BEAM_NBITS,
             u'incoherent-beam-tscrunch':16,
             u'incoherent-beam-fscrunch':1,
             u'incoherent-beam-antennas':self._antennas,
@@ -246,6 +262,13 @@ class FbfProductController(object):
             initial_status = Sensor.UNKNOWN)
         self.add_sensor(self._cbc_tscrunch_sensor)
 
+        self._cbc_nbits_sensor = Sensor.integer(
+            "coherent-beam-nbits",
+            description = "The number of bits per sample in the coherent beam output",
+            default = FBF_BEAM_NBITS,
+            initial_status = Sensor.UNKNOWN)
+        self.add_sensor(self._cbc_nbits_sensor)
+
         self._cbc_fscrunch_sensor = Sensor.integer(
             "coherent-beam-fscrunch",
             description = "The number frequency channels that will be integrated when producing coherent beams",
@@ -330,6 +353,20 @@ class FbfProductController(object):
             initial_status = Sensor.UNKNOWN)
         self.add_sensor(self._nservers_per_set_sensor)
 
+        self._servers_reused_sensor = Sensor.integer(
+            "servers-reused",
+            description = "The number of servers reused in the same position from the previous schedule block",
+            default = 0,
+            initial_status = Sensor.UNKNOWN)
+        self.add_sensor(self._servers_reused_sensor)
+
+        self._partition_plan_sensor = Sensor.string(
+            "partition-plan",
+            description = "JSON description of the worker set, channels and output groups of each server",
+            default = "",
+            initial_status = Sensor.UNKNOWN)
+        self.add_sensor(self._partition_plan_sensor)
+
         self._delay_config_server_sensor = Sensor.string(
             "delay-config-server",
             description = "The address of the delay configuration server for this product",
@@ -430,6 +467,10 @@ class FbfProductController(object):
         except Exception as error:
             self.log.warning("Received error while attempting capture stop: {}".format(str(error)))
         self._parent._server_pool.deallocate(self._servers)
+        # Remember the servers so that they can be preferred for the next schedule block
+        if self._servers:
+            self._previous_servers = self._servers
+        self._parent._bandwidth_ledger.release(self._product_id)
 
         if self._ibc_mcast_group:
             self._parent._ip_pool.free(self._ibc_mcast_group)
@@ -438,10 +479,13 @@ class FbfProductController(object):
         self._cbc_mcast_groups = None
         self._ibc_mcast_group = None
         self._servers = []
+        self._partition_plan = []
         if self._delay_config_server:
             self._delay_config_server.stop()
             self._delay_config_server = None
         self._beam_manager = None
+        self._stop_dynamic_tiling_updates()
+        self._clear_target_configuration()
 
     def set_error_state(self, message):
         self.reset_sb_configuration()
@@ -474,6 +518,9 @@ class FbfProductController(object):
                  coherent-beams-antennas    - The specific antennas to use for the coherent beamformer
                  coherent-beams-granularity - The number of beams per output mutlicast group
                                               (an integer divisor or multiplier of this number will be used)
+                 coherent-beams-objective   - The configuration ranking objective (see FbfConfigurationManager)
+                 coherent-beams-nbits       - The number of bits per output sample (8, 4 or 2), or "auto" to
+                                              drop to a lower bit depth only if that delivers more beams
                  incoherent-beam-tscrunch   - The number of spectra to integrate in the incoherent beamformer
                  incoherent-beam-fscrunch   - The number of channels to integrate in the incoherent beamformer
                  incoherent-beam-antennas   - The specific antennas to use for the incoherent beamformer
@@ -490,10 +537,8 @@ class FbfProductController(object):
 
         """
         if self._previous_sb_config == config_dict:
-            self.log.info("Configuration is unchanged, proceeding with existing configuration")
-            return
-        else:
-            self._previous_sb_config = config_dict
+            self.log.info("Configuration is unchanged, reconfiguring on the previous servers")
+        self._previous_sb_config = config_dict
         self.reset_sb_configuration()
         self.log.info("Setting schedule block configuration")
         config = deepcopy(self._default_sb_config)
@@ -508,11 +553,12 @@ class FbfProductController(object):
         # first we need to get one ip address for the incoherent beam
         self._ibc_mcast_group = self._parent._ip_pool.allocate(1)
         self._ibc_mcast_group_sensor.set_value(self._ibc_mcast_group.format_katcp())
-        largest_ip_range = self._parent._ip_pool.largest_free_range()
-        nworkers_available = self._parent._server_pool.navailable()
+        largest_ip_range = self._parent._ip_pool.allocatable(MAX_OUTPUT_IP_RUNS)
+        worker_weights = [server.capacity.weight for server in self._parent._server_pool.available()]
         cm = FbfConfigurationManager(len(self._katpoint_antennas),
             self._feng_config['bandwidth'], self._n_channels,
-            nworkers_available, largest_ip_range)
+            len(worker_weights), largest_ip_range, worker_weights=worker_weights,
+            max_output_rate=self._coherent_output_budget(config))
         requested_nantennas = len(parse_csv_antennas(config['coherent-beams-antennas']))
         mcast_config = cm.get_configuration(
             config['coherent-beams-tscrunch'],
@@ -520,7 +566,9 @@ class FbfProductController(object):
             config['coherent-beams-nbeams'],
             requested_nantennas,
             config['bandwidth'],
-            config['coherent-beams-granularity'])
+            config['coherent-beams-granularity'],
+            config['coherent-beams-objective'],
+            nbits=config['coherent-beams-nbits'])
         self._bandwidth_sensor.set_value(config['bandwidth'])
         self._cfreq_sensor.set_value(config['centre-frequency'])
         self._nchans_sensor.set_value(mcast_config['num_chans'])
@@ -529,37 +577,250 @@ class FbfProductController(object):
         self._cbc_ngroups.set_value(mcast_config['num_mcast_groups'])
         self._cbc_nbeams_per_server_set.set_value(mcast_config['num_beams_per_worker_set'])
         self._cbc_tscrunch_sensor.set_value(config['coherent-beams-tscrunch'])
+        self._cbc_nbits_sensor.set_value(mcast_config['nbits'])
         self._cbc_fscrunch_sensor.set_value(config['coherent-beams-fscrunch'])
         self._cbc_antennas_sensor.set_value(config['coherent-beams-antennas'])
         self._ibc_tscrunch_sensor.set_value(config['incoherent-beam-tscrunch'])
         self._ibc_fscrunch_sensor.set_value(config['incoherent-beam-fscrunch'])
         self._ibc_antennas_sensor.set_value(config['incoherent-beam-antennas'])
-        self._servers = self._parent._server_pool.allocate(mcast_config['num_workers_total'])
+        # Previous servers are only reused where their capacity matches the workers that
+        # the configuration was planned for, and keep their positions in the allocation
+        self._servers = self._parent._server_pool.allocate(mcast_config['num_workers_total'],
+            preferred=self._previous_servers)
+        nreused = len([1 for previous, server in zip(self._previous_servers, self._servers)
+            if previous == server])
+        self._servers_reused_sensor.set_value(nreused)
+        if self._previous_servers:
+            self.log.info("Reused {} of {} servers in the same position".format(
+                nreused, len(self._servers)))
         server_str = ",".join(["{s.hostname}:{s.port}".format(s=server) for server in self._servers])
         self._servers_sensor.set_value(server_str)
         self._nserver_sets_sensor.set_value(mcast_config['num_worker_sets'])
         self._nservers_per_set_sensor.set_value(mcast_config['num_workers_per_set'])
-        self._cbc_mcast_groups = self._parent._ip_pool.allocate(mcast_config['num_mcast_groups'])
+        self._cbc_mcast_groups = self._parent._ip_pool.allocate(
+            mcast_config['num_mcast_groups'], MAX_OUTPUT_IP_RUNS)
         self._cbc_mcast_groups_sensor.set_value(self._cbc_mcast_groups.format_katcp())
         return cm
 
+    def estimate_sb_configuration(self, config_dict):
+        """
+        @brief  Estimate the configuration that a schedule block configuration would receive
+
+        @param  config_dict  A dictionary of schedule block parameters as accepted by
+                             set_sb_configuration
+
+        @return A tuple of configuration dictionaries, best first, as returned by
+                FbfConfigurationManager.search_configurations
+
+        @note   No workers or multicast groups are allocated. The estimate is made against
+                the currently free worker and multicast group pools, with one group reserved
+                for the incoherent beam, and the uncommitted output rate budget. Resources held
+                by this product are not counted as free.
+        """
+        config = deepcopy(self._default_sb_config)
+        config.update(config_dict)
+        nips = max(self._parent._ip_pool.allocatable(MAX_OUTPUT_IP_RUNS + 1) - 1, 0)
+        worker_weights = tuple(sorted(server.capacity.weight
+            for server in self._parent._server_pool.available()))
+        budget = self._coherent_output_budget(config, reuse_own=False)
+        requested_nantennas = len(parse_csv_antennas(config['coherent-beams-antennas']))
+        return estimate_configurations(len(self._katpoint_antennas),
+            self._feng_config['bandwidth'], self._n_channels, len(worker_weights), nips,
+            config['coherent-beams-tscrunch'],
+            config['coherent-beams-fscrunch'],
+            config['coherent-beams-nbeams'],
+            requested_nantennas,
+            config['bandwidth'],
+            config['coherent-beams-granularity'],
+            config['coherent-beams-objective'],
+            worker_weights=worker_weights,
+            nbits=config['coherent-beams-nbits'],
+            max_output_rate=budget)
+
+    def _incoherent_beam_rate(self, bandwidth, tscrunch, fscrunch):
+        return bandwidth / tscrunch / fscrunch * FBF_BEAM_NBITS
+
+    def _coherent_output_budget(self, config, reuse_own=True):
+        # The output rate available for coherent beams once the commitments of other
+        # products (and of this product unless reuse_own is set) and the incoherent
+        # beam are accounted for. The incoherent beam is budgeted for the full band.
+        remaining = self._parent._bandwidth_ledger.remaining_output_rate(
+            exclude=self._product_id if reuse_own else None)
+        ibc_rate = self._incoherent_beam_rate(self._feng_config['bandwidth'],
+            config['incoherent-beam-tscrunch'], config['incoherent-beam-fscrunch'])
+        return max(remaining - ibc_rate, 0.0)
+
+    def _commit_bandwidth(self, cm, mcast_to_beam_map):
+        """
+        @brief  Record the output and ingest rates of the partition plan in the master bandwidth ledger
+        """
+        bandwidth = self._nchans_sensor.value() * cm.channel_bandwidth
+        cbc_rate = (bandwidth / self._cbc_tscrunch_sensor.value() / self._cbc_fscrunch_sensor.value()
+            * self._cbc_nbits_sensor.value())
+        ibc_rate = self._incoherent_beam_rate(bandwidth, self._ibc_tscrunch_sensor.value(),
+            self._ibc_fscrunch_sensor.value())
+        group_rates = {group: len(beams) * cbc_rate for group, beams in mcast_to_beam_map.items()}
+        if self._ibc_mcast_group:
+            for ip in self._ibc_mcast_group:
+                group_rates[str(ip)] = ibc_rate
+        worker_rates = {}
+        for entry in self._partition_plan:
+            fraction = entry['nchans'] / float(self._nchans_sensor.value())
+            output = sum(len(beams) * (ibc_rate if group not in mcast_to_beam_map else cbc_rate)
+                for group, beams in entry['mcast_to_beam_map'].items()) * fraction
+            ingest = (entry['nchans'] * cm.channel_bandwidth * len(self._katpoint_antennas)
+                * FENG_NBITS_PER_SAMPLE)
+            worker_rates["{s.hostname}:{s.port}".format(s=entry['server'])] = {
+                'ingest': ingest, 'output': output}
+        self._parent._bandwidth_ledger.commit(self._product_id,
+            sum(group_rates.values()),
+            sum(rates['ingest'] for rates in worker_rates.values()),
+            worker_rates, group_rates)
+
+    def _update_partition_plan_sensor(self):
+        self._partition_plan_sensor.set_value(json.dumps([
+            {key: (str(value) if key == 'server' else value) for key, value in entry.items()}
+            for entry in self._partition_plan]))
+
+    def mcast_allocations(self):
+        """
+        @brief  Get the output multicast allocations held by this product
+
+        @return A list of ContiguousIpRange (or IpRangeList) objects
+        """
+        return [allocation for allocation in (self._ibc_mcast_group, self._cbc_mcast_groups)
+            if allocation]
+
+    def relocate_mcast_groups(self, moves):
+        """
+        @brief  Move the output multicast allocations of an idle product
+
+        @param  moves  A list of (old, new) allocation pairs as returned by
+                       IpPoolManager.plan_compaction. The pool itself must already
+                       have been updated.
+
+        @note   The group sensors, beam mapping, partition plan and bandwidth commitment
+                are rewritten to use the new addresses. The product must be re-prepared
+                before capturing again, so no workers are reconfigured.
+        """
+        if not self.idle:
+            raise FbfProductStateError([self.IDLE], self.state)
+        address_map = {}
+        for old, new in moves:
+            address_map.update({str(old_ip): str(new_ip) for old_ip, new_ip in zip(old, new)})
+            if old == self._ibc_mcast_group:
+                self._ibc_mcast_group = new
+                self._ibc_mcast_group_sensor.set_value(new.format_katcp())
+            elif old == self._cbc_mcast_groups:
+                self._cbc_mcast_groups = new
+                self._cbc_mcast_groups_sensor.set_value(new.format_katcp())
+            else:
+                raise ValueError("{} is not held by this product".format(old.format_katcp()))
+        def remap(mapping):
+            return {address_map.get(group, group): beams for group, beams in mapping.items()}
+        if self._cbc_mcast_groups_mapping_sensor.value():
+            self._cbc_mcast_groups_mapping_sensor.set_value(json.dumps(
+                remap(json.loads(self._cbc_mcast_groups_mapping_sensor.value()))))
+        if self._partition_plan:
+            for entry in self._partition_plan:
+                entry['mcast_to_beam_map'] = remap(entry['mcast_to_beam_map'])
+            self._update_partition_plan_sensor()
+        commitment = self._parent._bandwidth_ledger.product_commitment(self._product_id)
+        if commitment is not None:
+            self._parent._bandwidth_ledger.commit(self._product_id, commitment['output'],
+                commitment['ingest'], commitment['workers'], remap(commitment['groups']))
+        self.log.info("Relocated output multicast groups: {}".format(", ".join(
+            "{} -> {}".format(old.format_katcp(), new.format_katcp()) for old, new in moves)))
+
+    def _clear_target_configuration(self):
+        self._ca_beams = []
+        self._ca_tilings = []
+
+    def _tiling_key(self, tiling_config):
+        return json.dumps(tiling_config, sort_keys=True)
+
+    def apply_target_configuration(self, config_dict):
+        """
+        @brief  Apply a beam position configuration from the configuration authority
+
+        @param  config_dict  A dictionary specifying beam positions, e.g.
+                             @code
+                                   {
+                                   u'beams':['source0,radec,12:00:00,01:00:00'],
+                                   u'tilings':[{u'target':'source1,radec,13:00:00,02:00:00',
+                                                u'nbeams':200,
+                                                u'overlap':0.5,
+                                                u'dynamic':True,
+                                                u'update_period':1800,
+                                                u'method':'hexagonal'},
+                                               {u'target':'source2,radec,14:00:00,03:00:00',
+                                                u'nbeams':100,
+                                                u'epoch':'auto',
+                                                u'duration':3600}]
+                                   }
+                             @endcode
+
+        @detail The configuration is compared against the previously applied configuration.
+                Beams and tilings that are present in both are left untouched (keeping their
+                beam IDs and hence their rows in the delay models), beams and tilings that are
+                no longer requested are released and only new beams and tilings are allocated
+                and generated.
+        """
+        requested_beams = []
+        for target_string in config_dict.get('beams', []):
+            target = Target(target_string)
+            requested_beams.append((target.format_katcp(), target))
+        retained_beams = []
+        for key, beam in self._ca_beams:
+            for ii, (requested_key, _) in enumerate(requested_beams):
+                if requested_key == key:
+                    retained_beams.append((key, beam))
+                    requested_beams.pop(ii)
+                    break
+            else:
+                self.log.debug("Releasing beam {}".format(beam.idx))
+                self._beam_manager.remove_beam(beam)
+        requested_tilings = [(self._tiling_key(tiling), tiling)
+            for tiling in config_dict.get('tilings', [])]
+        retained_tilings = []
+        for key, tiling in self._ca_tilings:
+            for ii, (requested_key, _) in enumerate(requested_tilings):
+                if requested_key == key:
+                    retained_tilings.append((key, tiling))
+                    requested_tilings.pop(ii)
+                    break
+            else:
+                self.log.debug("Releasing tiling on {}".format(tiling.target.name))
+                self._beam_manager.remove_tiling(tiling)
+        self.log.debug("Retaining {} beams and {} tilings, adding {} beams and {} tilings".format(
+            len(retained_beams), len(retained_tilings), len(requested_beams), len(requested_tilings)))
+        self._ca_beams = retained_beams
+        self._ca_tilings = retained_tilings
+        for key, target in requested_beams:
+            self._ca_beams.append((key, self.add_beam(target)))
+        for key, tiling in requested_tilings:
+            target  = Target(tiling['target']) #required
+            freq    = float(tiling.get('reference_frequency', self._cfreq_sensor.value()))
+            nbeams  = int(tiling['nbeams'])
+            overlap = float(tiling.get('overlap', 0.5))
+            epoch   = tiling.get('epoch', time.time())
+            if epoch != EPOCH_AUTO:
+                epoch = float(epoch)
+            duration = float(tiling.get('duration', DEFAULT_AUTO_EPOCH_DURATION))
+            dynamic = bool(tiling.get('dynamic', False))
+            update_period = tiling.get('update_period', None)
+            coverage_threshold = tiling.get('coverage_threshold', DEFAULT_COVERAGE_THRESHOLD)
+            method  = str(tiling.get('method', MOSAIC_TILING))
+            self._ca_tilings.append((key, self.add_tiling(target, nbeams, freq, overlap, epoch,
+                dynamic, update_period, coverage_threshold, method, duration)))
+
     @coroutine
     def get_ca_target_configuration(self, target):
         def ca_target_update_callback(received_timestamp, timestamp, status, value):
-            # TODO, should we really reset all the beams or should we have
-            # a mechanism to only update changed beams
-            config_dict = json.loads(value)
-            self.reset_beams()
-            for target_string in config_dict.get('beams',[]):
-                target = Target(target_string)
-                self.add_beam(target)
-            for tiling in config_dict.get('tilings',[]):
-                target  = Target(tiling['target']) #required
-                freq    = float(tiling.get('reference_frequency', self._cfreq_sensor.value()))
-                nbeams  = int(tiling['nbeams'])
-                overlap = float(tiling.get('overlap', 0.5))
-                epoch   = float(tiling.get('epoch', time.time()))
-                self.add_tiling(target, nbeams, freq, overlap, epoch)
+            try:
+                self.apply_target_configuration(json.loads(value))
+            except Exception as error:
+                self.log.exception("Failed to apply target configuration from CA: {}".format(str(error)))
         yield self._ca_client.until_synced()
         try:
             response = yield self._ca_client.req.target_configuration_start(self._proxy_name, target.format_katcp())
@@ -592,6 +853,52 @@ class FbfProductController(object):
             sensor_name = "{}_beam_position_configuration".format(self._proxy_name)
             self._ca_client.set_sampling_strategy(sensor_name, "none")
 
+    def _make_partition_plan(self, cm, mcast_to_beam_map):
+        """
+        @brief  Assign each allocated server a worker set, a channel range and the beams it forms
+
+        @param  cm                 The FbfConfigurationManager used to configure the schedule block
+
+        @param  mcast_to_beam_map  A dictionary mapping coherent beam multicast groups to lists of beam IDs
+
+        @return A list with one dictionary per prepared server, e.g.
+                @code
+                   {
+                      'server': <FbfWorkerWrapper @ 10.0.0.1:5000>,
+                      'worker_set': 0,
+                      'chan0_idx': 0,
+                      'nchans': 64,
+                      'mcast_to_beam_map': {'239.11.1.1': ['cfbf00000', 'cfbf00001'],
+                                            '239.11.1.0': ['ifbf00000']}
+                   }
+                @endcode
+
+        @note   Every worker set processes the full set of channels. Each set forms an equal
+                share of the beams of every coherent beam multicast group. The incoherent beam
+                is formed by the first worker set. Servers assigned no channels are not included.
+        """
+        nworker_sets = self._nserver_sets_sensor.value()
+        partition = cm.partition_workers([server.capacity.weight for server in self._servers],
+            nworker_sets, self._nchans_sensor.value())
+        set_beam_maps = split_beams_between_sets(mcast_to_beam_map, nworker_sets)
+        if self._ibc_mcast_group:
+            for ip in self._ibc_mcast_group:
+                set_beam_maps[0][str(ip)] = ["ifbf00000"]
+        plan = []
+        for worker_set, assignments in enumerate(partition):
+            for idx, chan0_idx, nchans in assignments:
+                if nchans == 0:
+                    self.log.warning("No channels assigned to {}".format(self._servers[idx]))
+                    continue
+                plan.append({
+                    'server': self._servers[idx],
+                    'worker_set': worker_set,
+                    'chan0_idx': chan0_idx,
+                    'nchans': nchans,
+                    'mcast_to_beam_map': set_beam_maps[worker_set]
+                    })
+        return plan
+
     @coroutine
     def prepare(self, sb_id):
         """
@@ -659,17 +966,13 @@ class FbfProductController(object):
         self._parent.mass_inform(Message.inform('interface-changed'))
 
         #Here we actually start to prepare the remote workers
-        ip_splits = self._streams.split(N_FENG_STREAMS_PER_WORKER)
+        self._partition_plan = self._make_partition_plan(cm, mcast_to_beam_map)
+        self._commit_bandwidth(cm, mcast_to_beam_map)
+        self._update_partition_plan_sensor()
 
         # This is assuming lower sideband and bandwidth is always +ve
         fbottom = self._feng_config['centre-frequency'] - self._feng_config['bandwidth']/2.
 
-        coherent_beam_config = {
-        'tscrunch':self._cbc_tscrunch_sensor.value(),
-        'fscrunch':self._cbc_fscrunch_sensor.value(),
-        'antennas':self._cbc_antennas_sensor.value()
-        }
-
         incoherent_beam_config = {
         'tscrunch':self._ibc_tscrunch_sensor.value(),
         'fscrunch':self._ibc_fscrunch_sensor.value(),
@@ -677,12 +980,24 @@ class FbfProductController(object):
         }
 
         prepare_futures = []
-        for ii, (server, ip_range) in enumerate(zip(self._servers, ip_splits)):
-            chan0_idx = cm.nchans_per_worker * ii
-            chan0_freq =  fbottom + chan0_idx * cm.channel_bandwidth
+        for entry in self._partition_plan:
+            server = entry['server']
+            ip_range = ContiguousIpRange(str(self._streams.base_ip + entry['chan0_idx'] // cm.nchans_per_group),
+                self._streams.port, entry['nchans'] // cm.nchans_per_group)
+            chan0_freq =  fbottom + entry['chan0_idx'] * cm.channel_bandwidth
+            coherent_beam_config = {
+            'tscrunch':self._cbc_tscrunch_sensor.value(),
+            'fscrunch':self._cbc_fscrunch_sensor.value(),
+            'nbits':self._cbc_nbits_sensor.value(),
+            'antennas':self._cbc_antennas_sensor.value(),
+            'worker-set':entry['worker_set'],
+            'nworker-sets':self._nserver_sets_sensor.value()
+            }
+            worker_mcast_to_beam_map = {group: ",".join(beams)
+                for group, beams in entry['mcast_to_beam_map'].items()}
             future = server.prepare(ip_range.format_katcp(), cm.nchans_per_group,
-                        chan0_idx, chan0_freq, cm.channel_bandwidth, mcast_to_beam_map,
-                        self._feng_config['feng-antenna-map'], coherent_beam_config,
+                        entry['chan0_idx'], chan0_freq, cm.channel_bandwidth, worker_mcast_to_beam_map,
+                        self._feng_config, coherent_beam_config,
                         incoherent_beam_config, de_ip, de_port)
             prepare_futures.append(future)
 
@@ -709,6 +1024,7 @@ class FbfProductController(object):
                 and ensure the release of all resource allocations.
         """
         self.reset_sb_configuration()
+        self._tiling_executor.shutdown(wait=False)
         self.teardown_sensors()
 
     def capture_start(self):
@@ -760,7 +1076,26 @@ class FbfProductController(object):
             raise FbfProductStateError(valid_states, self.state)
         return self._beam_manager.add_beam(target)
 
-    def add_tiling(self, target, number_of_beams, reference_frequency, overlap, epoch):
+    def lookup_beams(self, ra, dec, radius):
+        """
+        @brief      Find the beams covering a given sky position
+
+        @param      ra          The right ascension of the search position in degrees
+
+        @param      dec         The declination of the search position in degrees
+
+        @param      radius      The search radius in degrees
+
+        @return     A list of Beam objects sorted by distance from the search position
+        """
+        valid_states = [self.READY, self.CAPTURING, self.STARTING]
+        if not self.state in valid_states:
+            raise FbfProductStateError(valid_states, self.state)
+        return self._beam_manager.lookup(ra, dec, radius)
+
+    def add_tiling(self, target, number_of_beams, reference_frequency, overlap, epoch,
+                   dynamic=False, update_period=None, coverage_threshold=DEFAULT_COVERAGE_THRESHOLD,
+                   method=MOSAIC_TILING, duration=DEFAULT_AUTO_EPOCH_DURATION):
         """
         @brief   Add a tiling to be managed
 
@@ -778,18 +1113,129 @@ class FbfProductController(object):
                                     when values are close to zero. In future this may be define in sigma units or
                                     in multiples of the FWHM of the beam.]
 
+        @param      epoch           The epoch for the tiling pattern as a unix time, or "auto" to choose the
+                                    epoch that maximises the time-averaged coverage over the next 'duration'
+                                    seconds (see optimal_tiling_epoch).
+
+        @param      dynamic         Flag indicating if the tiling should be regenerated as the synthesised
+                                    beam shape evolves over the observation.
+
+        @param      update_period   For dynamic tilings, the maximum time in seconds between regenerations
+
+        @param      coverage_threshold  For dynamic tilings, the fractional beam shape overlap below
+                                        which the tiling will be regenerated
+
+        @param      method          The tiling generator to use, either "mosaic" or "hexagonal"
+
+        @param      duration        The expected duration of the observation in seconds, used only
+                                    when epoch is "auto"
+
         @returns    The created Tiling object
         """
         valid_states = [self.READY, self.CAPTURING, self.STARTING]
         if not self.state in valid_states:
             raise FbfProductStateError(valid_states, self.state)
-        tiling = self._beam_manager.add_tiling(target, number_of_beams, reference_frequency, overlap)
+        if epoch == EPOCH_AUTO:
+            start = time.time()
+            try:
+                epoch = optimal_tiling_epoch(self._katpoint_antennas, reference_frequency,
+                    target, start, start + duration)
+            except Exception as error:
+                self.log.error("Failed to determine optimal tiling epoch with error: {}".format(str(error)))
+                epoch = start + duration / 2.0
+        tiling = self._beam_manager.add_tiling(target, number_of_beams, reference_frequency, overlap,
+            dynamic, update_period, coverage_threshold, method)
         try:
             tiling.generate(self._katpoint_antennas, epoch)
         except Exception as error:
             self.log.error("Failed to generate tiling pattern with error: {}".format(str(error)))
+        if dynamic:
+            self._start_dynamic_tiling_updates()
         return tiling
 
+    def _start_dynamic_tiling_updates(self):
+        if self._dynamic_tiling_callback is None:
+            self.log.debug("Starting dynamic tiling update callback")
+            self._dynamic_tiling_callback = PeriodicCallback(
+                self._update_dynamic_tilings, DYNAMIC_TILING_CHECK_PERIOD * 1000)
+            self._dynamic_tiling_callback.start()
+
+    def _stop_dynamic_tiling_updates(self):
+        if self._dynamic_tiling_callback is not None:
+            self.log.debug("Stopping dynamic tiling update callback")
+            self._dynamic_tiling_callback.stop()
+            self._dynamic_tiling_callback = None
+
+    @coroutine
+    def _update_dynamic_tilings(self):
+        """
+        @brief   Regenerate any dynamic tilings that no longer provide adequate coverage
+
+        @detail  The beam shape check and the tiling generation are performed in a background
+                 thread. New beam positions for a tiling are applied in a single IOLoop callback
+                 half way between two delay model epoch boundaries (see next_epoch_boundary).
+                 Workers receive the positions as one sensor event per beam from the delay
+                 configuration server, so applying them mid-interval leaves half an update
+                 period for all of the events to arrive before the workers next compute
+                 their delay models.
+
+        @note    A check is skipped if the previous one has not finished, and tilings with a
+                 regenerated pattern waiting to be applied are not checked again.
+        """
+        beam_manager = self._beam_manager
+        if beam_manager is None:
+            return
+        if self._updating_dynamic_tilings:
+            self.log.debug("Skipping dynamic tiling check as previous check is still running")
+            return
+        self._updating_dynamic_tilings = True
+        try:
+            yield self._update_dynamic_tilings_once(beam_manager)
+        finally:
+            self._updating_dynamic_tilings = False
+        self._pending_tiling_swaps = set()
+
+    @coroutine
+    def _update_dynamic_tilings_once(self, beam_manager):
+        for tiling in beam_manager.dynamic_tilings:
+            if tiling in self._pending_tiling_swaps:
+                continue
+            now = time.time()
+            # The current tiling must remain valid until the next check
+            check_epoch = now + DYNAMIC_TILING_CHECK_PERIOD
+            try:
+                beam_shape = yield self._tiling_executor.submit(get_beam_shape,
+                    self._katpoint_antennas, tiling.reference_frequency, tiling.target, check_epoch)
+                if not tiling.needs_update(beam_shape, now):
+                    continue
+                self.log.info("Regenerating dynamic tiling on {} (coverage: {})".format(
+                    tiling.target.name, tiling.coverage(beam_shape)))
+                period = tiling.update_period or DYNAMIC_TILING_CHECK_PERIOD
+                epoch = now + period / 2.0
+                beam_shape, coordinates = yield self._tiling_executor.submit(
+                    tiling.compute, self._katpoint_antennas, epoch)
+            except Exception as error:
+                self.log.exception("Failed to regenerate dynamic tiling: {}".format(str(error)))
+                continue
+            self._schedule_dynamic_tiling_swap(beam_manager, tiling, beam_shape, coordinates, epoch)
+
+    def _schedule_dynamic_tiling_swap(self, beam_manager, tiling, beam_shape, coordinates, epoch):
+        # Swap half way between delay model updates (see _update_dynamic_tilings)
+        swap_time = next_epoch_boundary(time.time(), DEFAULT_UPDATE_RATE, DEFAULT_UPDATE_RATE / 2.0)
+        self._pending_tiling_swaps.add(tiling)
+        self._parent.ioloop.call_at(swap_time, lambda: self._swap_dynamic_tiling(
+            beam_manager, tiling, beam_shape, coordinates, epoch))
+        return swap_time
+
+    def _swap_dynamic_tiling(self, beam_manager, tiling, beam_shape, coordinates, epoch):
+        self._pending_tiling_swaps.discard(tiling)
+        # The tiling may have been removed while it was being regenerated
+        if beam_manager is not self._beam_manager or tiling not in beam_manager.dynamic_tilings:
+            self.log.debug("Discarding regenerated tiling for removed tiling")
+            return
+        tiling.apply(beam_shape, coordinates, epoch)
+        self.log.debug("Applied regenerated tiling on {}".format(tiling.target.name))
+
     def reset_beams(self):
         """
         @brief  reset and deallocate all beams and tilings managed by this instance
@@ -799,4 +1245,6 @@ class FbfProductController(object):
         valid_states = [self.READY, self.CAPTURING, self.STARTING]
         if not self.state in valid_states:
             raise FbfProductStateError(valid_states, self.state)
-        self._beam_manager.reset()
\ No newline at end of file
+        self._beam_manager.reset()
+        self._stop_dynamic_tiling_updates()
+        self._clear_target_configuration()
@@ -0,0 +1,208 @@
+"""
+Copyright (c) 2018 Ewan Barr <ebarr@mpifr-bonn.mpg.de>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import logging
+import numpy as np
+from mpikat.utils import angular_separation
+
+log = logging.getLogger("mpikat.fbfuse_source_catalogue")
+
+SPEED_OF_LIGHT = 299792458.0
+MEERKAT_DISH_DIAMETER = 13.5
+MAX_SOURCE_NAME_LENGTH = 32
+CATALOGUE_DTYPE = np.dtype([
+    ("name", "S{}".format(MAX_SOURCE_NAME_LENGTH)),
+    ("ra", "f8"),
+    ("dec", "f8")])
+
+
+class CatalogueError(Exception):
+    pass
+
+
+def primary_beam_radius(frequency, dish_diameter=MEERKAT_DISH_DIAMETER):
+    """
+    @brief  Calculate the approximate radius of the primary beam (half the FWHM)
+
+    @param  frequency      The observing frequency in Hz
+
+    @param  dish_diameter  The dish diameter in metres
+
+    @return The radius in degrees
+    """
+    return np.rad2deg(0.5 * 1.22 * SPEED_OF_LIGHT / frequency / dish_diameter)
+
+
+class SourceCatalogue(object):
+    """Read-only store of source positions supporting fast cone searches
+
+    Sources are kept in a numpy structured array sorted by declination. Stores
+    written with the save method are memory mapped on load, so catalogues of
+    millions of sources can be opened without reading them into memory. A cone
+    search uses a binary search on the declination column to find the band of
+    rows that may intersect the cone, then calculates exact separations for
+    that band only.
+    """
+    def __init__(self, data):
+        """
+        @brief  Create a new catalogue
+
+        @param  data   A numpy array with CATALOGUE_DTYPE sorted by declination
+
+        @note   Use the from_arrays, from_csv or load methods in preference to calling
+                this constructor directly.
+        """
+        if data.dtype != CATALOGUE_DTYPE:
+            raise CatalogueError("Catalogue data has invalid dtype {}".format(data.dtype))
+        self._data = data
+
+    def __len__(self):
+        return self._data.size
+
+    def __repr__(self):
+        return "<{} with {} sources>".format(self.__class__.__name__, len(self))
+
+    @classmethod
+    def from_arrays(cls, names, ra, dec):
+        """
+        @brief  Create a catalogue from arrays of source names and positions
+
+        @param  names  A sequence of source names
+
+        @param  ra     A sequence of right ascensions in degrees
+
+        @param  dec    A sequence of declinations in degrees
+        """
+        data = np.empty(len(names), dtype=CATALOGUE_DTYPE)
+        data["name"] = names
+        data["ra"] = np.mod(ra, 360.0)
+        data["dec"] = dec
+        if np.any(np.abs(data["dec"]) > 90.0):
+            raise CatalogueError("Catalogue contains declinations outside [-90, 90] degrees")
+        return cls(data[np.argsort(data["dec"], kind="mergesort")])
+
+    @classmethod
+    def from_csv(cls, filename):
+        """
+        @brief  Create a catalogue from a CSV file
+
+        @param  filename  The path to a CSV file where each line has the
+                          format "name, ra, dec" with positions in degrees.
+                          Lines starting with '#' are ignored.
+        """
+        log.info("Reading source catalogue from {}".format(filename))
+        data = np.atleast_1d(np.genfromtxt(filename, dtype=CATALOGUE_DTYPE,
+            delimiter=",", comments="#", autostrip=True))
+        return cls.from_arrays(data["name"], data["ra"], data["dec"])
+
+    @classmethod
+    def load(cls, filename):
+        """
+        @brief  Memory map a catalogue store previously written by the save method
+
+        @param  filename  The path to the store (a .npy file)
+        """
+        log.info("Memory mapping source catalogue store {}".format(filename))
+        return cls(np.load(filename, mmap_mode="r"))
+
+    def save(self, filename):
+        """
+        @brief  Write the catalogue to a store that can be memory mapped by the load method
+
+        @param  filename  The path to the store (a .npy file)
+        """
+        np.save(filename, self._data)
+
+    def cone_search(self, ra, dec, radius, max_sources=None):
+        """
+        @brief  Find all sources within a given radius of a sky position
+
+        @param  ra           The right ascension of the search position in degrees
+
+        @param  dec          The declination of the search position in degrees
+
+        @param  radius       The search radius in degrees
+
+        @param  max_sources  (optional) The maximum number of sources to return
+
+        @return A numpy array with CATALOGUE_DTYPE containing the matching sources
+                sorted by separation from the search position (closest first)
+        """
+        dec_column = self._data["dec"]
+        start = np.searchsorted(dec_column, dec - radius, side="left")
+        end = np.searchsorted(dec_column, dec + radius, side="right")
+        band = np.asarray(self._data[start:end])
+        separation = angular_separation(ra, dec, band["ra"], band["dec"])
+        matches = np.nonzero(separation <= radius)[0]
+        matches = matches[np.argsort(separation[matches], kind="mergesort")]
+        if max_sources is not None:
+            matches = matches[:max_sources]
+        return band[matches]
+
+    def targets_within(self, ra, dec, radius, max_sources=None):
+        """
+        @brief  Find all sources within a given radius of a sky position as KATPOINT targets
+
+        @note   Arguments are as for the cone_search method
+
+        @return A list of KATPOINT target strings sorted by separation from the
+                search position (closest first)
+        """
+        targets = []
+        for name, source_ra, source_dec in self.cone_search(ra, dec, radius, max_sources):
+            if isinstance(name, bytes):
+                name = name.decode("ascii")
+            targets.append("{},radec,{:.8f},{:.8f}".format(str(name), source_ra, source_dec))
+        return targets
+
+
+def load_catalogue(filename):
+    """
+    @brief  Load a source catalogue from either a store or a CSV file
+
+    @param  filename  The path to either a catalogue store written by SourceCatalogue.save
+                      (must have a .npy extension) or a CSV file of "name, ra, dec" lines
+
+    @return A SourceCatalogue instance
+    """
+    if filename.endswith(".npy"):
+        return SourceCatalogue.load(filename)
+    else:
+        return SourceCatalogue.from_csv(filename)
+
+
+def main():
+    from optparse import OptionParser
+    usage = "usage: %prog [options] <catalogue csv> <output store>"
+    parser = OptionParser(usage=usage)
+    parser.add_option('', '--log_level',dest='log_level',type=str,
+        help='Logging level',default="INFO")
+    (opts, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Expected a catalogue CSV file and an output store path")
+    logging.basicConfig(format="[ %(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s")
+    log.setLevel(opts.log_level.upper())
+    catalogue = SourceCatalogue.from_csv(args[0])
+    catalogue.save(args[1])
+    log.info("Wrote {} sources to {}".format(len(catalogue), args[1]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Copyright (c) 2018 Ewan Barr <ebarr@mpifr-bonn.mpg.de>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+import logging
+import time
+import mosaic
+from optparse import OptionParser
+from katpoint import Antenna, Target
+from mpikat.fbfuse_beam_manager import get_beam_shape, generate_hexagonal_tiling, tiling_coverage
+from mpikat.utils import Timer
+
+log = logging.getLogger("mpikat.fbfuse_tiling_benchmark")
+
+DEFAULT_TARGET = "benchmark, radec, 12:00:00, -30:00:00"
+
+def benchmark_tiling(antennas, target, reference_frequency, overlap, nbeams, epoch):
+    """
+    @brief   Compare the mosaic and hexagonal tiling generators
+
+    @param   antennas             A list of katpoint.Antenna objects
+
+    @param   target               A KATPOINT target object at the centre of the tiling
+
+    @param   reference_frequency  The frequency at which to calculate the beam shape
+
+    @param   overlap              The power point at which neighbouring beams meet
+
+    @param   nbeams               The number of beams in the tiling
+
+    @param   epoch                The epoch of the tiling (unix time)
+
+    @return  A list of dictionaries (one per generator) containing the generator name,
+             the time taken to generate the tiling and the coverage of the tiling
+    """
+    beam_shape = get_beam_shape(antennas, reference_frequency, target, epoch)
+    results = []
+    timer = Timer()
+    tiling = mosaic.generate_nbeams_tiling(beam_shape, nbeams, overlap)
+    elapsed = timer.elapsed()
+    coordinates = [tiling.coordinates[ii] for ii in range(tiling.beam_num)]
+    results.append({
+        "method": "mosaic",
+        "nbeams": len(coordinates),
+        "time": elapsed,
+        "coverage": tiling_coverage(beam_shape, target, coordinates, overlap)
+        })
+    timer.reset()
+    coordinates = generate_hexagonal_tiling(beam_shape, target, nbeams, overlap)
+    elapsed = timer.elapsed()
+    results.append({
+        "method": "hexagonal",
+        "nbeams": len(coordinates),
+        "time": elapsed,
+        "coverage": tiling_coverage(beam_shape, target, coordinates, overlap)
+        })
+    return results
+
+def main():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-a', '--antennas', dest='antennas', type=str,
+        help='Path to file containing KATPOINT antenna strings (one per line)')
+    parser.add_option('-t', '--target', dest='target', type=str,
+        help='KATPOINT target string for the tiling centre', default=DEFAULT_TARGET)
+    parser.add_option('-f', '--frequency', dest='frequency', type=float,
+        help='Reference frequency in Hz', default=1.4e9)
+    parser.add_option('-o', '--overlap', dest='overlap', type=float,
+        help='Overlap power point of neighbouring beams', default=0.5)
+    parser.add_option('-n', '--nbeams', dest='nbeams', type=str,
+        help='Comma separated list of beam counts to benchmark', default="100,400,1000")
+    parser.add_option('-e', '--epoch', dest='epoch', type=float,
+        help='Epoch of the tiling (unix time, defaults to now)', default=None)
+    parser.add_option('', '--log_level',dest='log_level',type=str,
+        help='Logging level',default="INFO")
+    (opts, args) = parser.parse_args()
+    logging.basicConfig(format="[ %(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s")
+    log.setLevel(opts.log_level.upper())
+    if not opts.antennas:
+        parser.error("An antenna file must be provided")
+    with open(opts.antennas) as f:
+        antennas = [Antenna(line) for line in f.read().strip().splitlines()]
+    target = Target(opts.target)
+    epoch = opts.epoch if opts.epoch is not None else time.time()
+    print("{:>8} {:>10} {:>12} {:>10}".format("nbeams", "method", "time (s)", "coverage"))
+    for nbeams in [int(n) for n in opts.nbeams.split(",")]:
+        for result in benchmark_tiling(antennas, target, opts.frequency, opts.overlap, nbeams, epoch):
+            print("{nbeams:>8d} {method:>10} {time:>12.4f} {coverage:>10.3f}".format(**result))
+
+if __name__ == "__main__":
+    main()
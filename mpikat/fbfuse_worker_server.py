@@ -31,6 +31,7 @@ from katcp import Sensor, AsyncDeviceServer, AsyncReply, KATCPClientResource
 from katcp.kattypes import request, return_reply, Int, Str, Discrete, Float
 from mpikat.ip_manager import ip_range_from_stream
 from mpikat.fbfuse_mkrecv_config import make_mkrecv_header
+from mpikat.fbfuse_config import feng_timestamp_step
 from mpikat.fbfuse_delay_buffer_controller import DelayBufferController
 from mpikat.utils import LoggingSensor, parse_csv_antennas
 
@@ -230,7 +231,8 @@ class FbfWorkerServer(AsyncDeviceServer):
         @param      chan_bw             The channel bandwidth in Hz
 
         @param      mcast_to_beam_map   A JSON mapping between output multicast addresses and beam IDs. This is the sole
-                                        authority for the number of beams that will be produced and their indexes. The map
+                                        authority for the number of beams that will be produced by this worker and their
+                                        indexes. Workers in different worker sets receive different beams. The map
                                         is in the form:
 
                                         @code
@@ -248,19 +250,30 @@ class FbfWorkerServer(AsyncDeviceServer):
                                               'sideband': 'upper',
                                               'feng-antenna-map': {...},
                                               'sync-epoch': 12353524243.0,
-                                              'nchans': 4096
+                                              'nchans': 4096,
+                                              'spectra-per-heap': 256
                                            }
 
+                                        The 'spectra-per-heap' key is optional and defaults to the
+                                        value for the channelisation mode given by 'nchans'.
+
         @param      coherent_beam_config   A JSON object specifying the coherent beam configuration in the form:
 
                                            @code
                                               {
                                                 'tscrunch':16,
                                                 'fscrunch':1,
-                                                'antennas':'m007,m008,m009'
+                                                'nbits':8,
+                                                'antennas':'m007,m008,m009',
+                                                'worker-set':0,
+                                                'nworker-sets':2
                                               }
                                            @endcode
 
+                                           The (optional) worker set keys identify the worker set this
+                                           worker belongs to. The (optional) 'nbits' key gives the number
+                                           of bits per output sample (8, 4 or 2, defaults to 8).
+
         @param      incoherent_beam_config  A JSON object specifying the incoherent beam configuration in the form:
 
                                            @code
@@ -322,10 +335,11 @@ class FbfWorkerServer(AsyncDeviceServer):
             nbits = 8
             tsamp = 1.0 / (feng_config['bandwidth'] / feng_config['nchans'])
             sample_clock = feng_config['bandwidth'] * 2
-            timestamp_step =  feng_config['nchans'] * 2 * 256 # WARNING: This is only valid in 4k mode
+            timestamp_step = feng_timestamp_step(feng_config['nchans'],
+                feng_config.get('spectra-per-heap'))
             frequency_ids = [chan0_idx+nchans_per_group*ii for ii in range(ngroups)] #WARNING: Assumes contigous groups
             mkrecv_config = {
-                'frequency_mhz': (chan0_freq + feng_config['nchans']/2.0 * chan_bw) / 1e6,
+                'frequency_mhz': (chan0_freq + partition_nchans/2.0 * chan_bw) / 1e6,
                 'bandwidth': partition_bandwidth,
                 'tsamp_us': tsamp * 1e6,
                 'bytes_per_second': partition_bandwidth * npol * ndim * nbits,
@@ -360,6 +374,9 @@ class FbfWorkerServer(AsyncDeviceServer):
                         incoherent_beam_group = group
 
             log.debug("Determined coherent beam to multicast mapping: {}".format(coherent_beam_to_group_map))
+            log.info("Forming {} {}-bit coherent beams as worker set {} of {}".format(
+                len(coherent_beam_to_group_map), coherent_beam_config.get('nbits', 8),
+                coherent_beam_config.get('worker-set', 0), coherent_beam_config.get('nworker-sets', 1)))
             if incoherent_beam:
                 log.debug("Incoherent beam will be sent to: {}".format(incoherent_beam_group))
             else:
@@ -540,8 +557,6 @@ def main():
         help='Port number of status server instance',default="INFO")
     parser.add_option('', '--dummy',action="store_true", dest='dummy',
         help='Set status server to dummy')
-    parser.add_option('-n', '--nodes',dest='nodes', type=str, default=None,
-        help='Path to file containing list of available nodes')
     (opts, args) = parser.parse_args()
     FORMAT = "[ %(levelname)s - %(asctime)s - %(filename)s:%(lineno)s] %(message)s"
     logger = logging.getLogger('mpikat.fbfuse_worker_server')
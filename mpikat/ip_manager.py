@@ -20,6 +20,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import logging
+import bisect
 import ipaddress
 
 log = logging.getLogger('mpikat.ip_manager')
@@ -41,9 +42,13 @@ class ContiguousIpRange(object):
 
         @note       This class is intended for managing SPEAD stream IPs, hence the assocated
                     port number and the 'spead://' prefix used in the format_katcp method.
+
+        @note       Only the base address and count are stored. Membership, indexing and
+                    slicing are computed arithmetically and iteration is lazy, so the cost
+                    of a range does not depend on its size.
         """
         self._base_ip = ipaddress.ip_address(unicode(base_ip))
-        self._ips = [self._base_ip+ii for ii in range(count)]
+        self._base = int(self._base_ip)
         self._port = port
         self._count = count
 
@@ -59,14 +64,57 @@ class ContiguousIpRange(object):
     def base_ip(self):
         return self._base_ip
 
+    def _offset(self, ip):
+        return int(ipaddress.ip_address(unicode(ip))) - self._base
+
     def index(self, ip):
-        return self._ips.index(ip)
+        """
+        @brief  Return the position of an IP in the range
+
+        @param  ip  An IP address as a string or ipaddress object
+
+        @note   Raises ValueError if the IP is not in the range (as list.index)
+        """
+        offset = self._offset(ip)
+        if not 0 <= offset < self._count:
+            raise ValueError("{} is not in {}".format(ip, self.format_katcp()))
+        return offset
+
+    def __contains__(self, ip):
+        try:
+            return 0 <= self._offset(ip) < self._count
+        except ValueError:
+            return False
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._count)
+            if step != 1:
+                raise ValueError("Only contiguous slices of a ContiguousIpRange are supported")
+            return ContiguousIpRange(str(self._base_ip + start), self._port, max(stop - start, 0))
+        if key < 0:
+            key += self._count
+        if not 0 <= key < self._count:
+            raise IndexError("ContiguousIpRange index out of range")
+        return self._base_ip + key
+
+    def __eq__(self, other):
+        if not isinstance(other, ContiguousIpRange):
+            return NotImplemented
+        return (self._base, self._count, self._port) == (other._base, other._count, other._port)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
     def __hash__(self):
         return hash(self.format_katcp())
 
     def __iter__(self):
-        return self._ips.__iter__()
+        return (self._base_ip + ii for ii in xrange(self._count))
 
     def __repr__(self):
         return "<{} {}>".format(self.__class__.__name__, self.format_katcp())
@@ -75,13 +123,7 @@ class ContiguousIpRange(object):
         """
         @brief   Split the Ip range into n subsubsets of preferably equal length
         """
-        allocated = 0
-        splits = []
-        while allocated < self._count:
-            available = min(self._count-allocated, n)
-            splits.append(ContiguousIpRange(str(self._base_ip+allocated), self._port, available))
-            allocated+=available
-        return splits
+        return [self[start:start+n] for start in xrange(0, self._count, n)]
 
     def format_katcp(self):
         """
@@ -98,10 +140,21 @@ class IpRangeManager(object):
                 a ContiguousIpRange instance
 
         @param  ip_range   A ContiguousIpRange instance to be managed
+
+        @detail Free space is tracked as a set of maximal free intervals (offset, span)
+                held in two sorted lists, one ordered by offset (for coalescing on free)
+                and one ordered by span (for best-fit allocation). Both allocate and free
+                locate intervals by bisection and the cost does not depend on the number
+                of addresses in the managed range.
         """
         self._ip_range = ip_range
-        self._allocated = [False for _ in ip_range]
+        self._base = int(ip_range.base_ip)
+        self._free_offsets = []   # sorted offsets of free intervals
+        self._free_spans = {}     # offset -> span of free intervals
+        self._free_by_span = []   # sorted (span, offset) tuples of free intervals
         self._allocated_ranges = set()
+        if ip_range.count > 0:
+            self._add_free(0, ip_range.count)
 
     def __repr__(self):
         return "<{} {}>".format(self.__class__.__name__, self._ip_range.format_katcp())
@@ -113,23 +166,37 @@ class IpRangeManager(object):
         """
         return self._ip_range.format_katcp()
 
+    def _add_free(self, offset, span):
+        bisect.insort(self._free_offsets, offset)
+        self._free_spans[offset] = span
+        bisect.insort(self._free_by_span, (span, offset))
+
+    def _remove_free(self, offset):
+        span = self._free_spans.pop(offset)
+        del self._free_offsets[bisect.bisect_left(self._free_offsets, offset)]
+        del self._free_by_span[bisect.bisect_left(self._free_by_span, (span, offset))]
+        return span
+
     def _free_ranges(self):
-        state_ranges = {True:[], False:[]}
-        def find_state_range(idx, state):
-            start_idx = idx
-            while idx < len(self._allocated):
-                if self._allocated[idx] == state:
-                    idx+=1
-                else:
-                    state_ranges[state].append((start_idx, idx-start_idx))
-                    return find_state_range(idx, not state)
-            else:
-                state_ranges[state].append((start_idx, idx-start_idx))
-        find_state_range(0, self._allocated[0])
-        return state_ranges[False]
+        return [(offset, self._free_spans[offset]) for offset in self._free_offsets]
+
+    def _best_fit(self, n):
+        idx = bisect.bisect_left(self._free_by_span, (n, -1))
+        if idx == len(self._free_by_span):
+            return None
+        return self._free_by_span[idx][0]
 
     def largest_free_range(self):
-        return max(self._free_ranges(), key=lambda r: r[1])
+        """
+        @brief      Return the number of IPs in the largest contiguous free range
+        """
+        return self._free_by_span[-1][0] if self._free_by_span else 0
+
+    def nfree(self):
+        """
+        @brief      Return the total number of free IPs
+        """
+        return sum(self._free_spans.values())
 
     def allocate(self, n):
         """
@@ -138,28 +205,53 @@ class IpRangeManager(object):
         @param      n   The number of IPs to allocate
 
         @return     A ContiguousIpRange object describing the allocated range
+
+        @note       The range is taken from the start of the smallest free interval that
+                    can hold it (the lowest such interval if there are several).
         """
         log.debug("Allocating {} contiguous multicast groups".format(n))
-        ranges = self._free_ranges()
-        best_fit = None
-        for start,span in ranges:
-            if span<n:
-                continue
-            elif best_fit is None:
-                best_fit = (start, span)
-            elif (span-n) < (best_fit[1]-n):
-                best_fit = (start, span)
-        if best_fit is None:
+        if n < 1:
+            raise IpRangeAllocationError("Cannot allocate a range of {} addresses".format(n))
+        idx = bisect.bisect_left(self._free_by_span, (n, -1))
+        if idx == len(self._free_by_span):
             raise IpRangeAllocationError("Could not allocate contiguous range of {} addresses".format(n))
-        else:
-            start,span = best_fit
-            for ii in range(n):
-                offset = start+ii
-                self._allocated[offset] = True
-            allocated_range = ContiguousIpRange(str(self._ip_range.base_ip + start), self._ip_range.port, n)
-            self._allocated_ranges.add(allocated_range)
-            log.debug("Allocated range: {}".format(allocated_range.format_katcp()))
-            return allocated_range
+        span, offset = self._free_by_span[idx]
+        self._remove_free(offset)
+        if span > n:
+            self._add_free(offset + n, span - n)
+        allocated_range = self._ip_range[offset:offset + n]
+        self._allocated_ranges.add(allocated_range)
+        log.debug("Allocated range: {}".format(allocated_range.format_katcp()))
+        return allocated_range
+
+    def reserve(self, ip_range):
+        """
+        @brief      Allocate a specific range of contiguous IPs
+
+        @param      ip_range  A ContiguousIpRange object within the managed range
+
+        @return     A ContiguousIpRange object describing the allocated range
+
+        @note       Raises an IpRangeAllocationError if any part of the range is not free.
+        """
+        log.debug("Reserving range: {}".format(ip_range.format_katcp()))
+        offset = int(ip_range.base_ip) - self._base
+        n = ip_range.count
+        idx = bisect.bisect_right(self._free_offsets, offset) - 1
+        if n < 1 or idx < 0 or ip_range.port != self._ip_range.port:
+            raise IpRangeAllocationError("Range {} is not free".format(ip_range.format_katcp()))
+        start = self._free_offsets[idx]
+        span = self._free_spans[start]
+        if offset + n > start + span:
+            raise IpRangeAllocationError("Range {} is not free".format(ip_range.format_katcp()))
+        self._remove_free(start)
+        if offset > start:
+            self._add_free(start, offset - start)
+        if start + span > offset + n:
+            self._add_free(offset + n, start + span - offset - n)
+        allocated_range = self._ip_range[offset:offset + n]
+        self._allocated_ranges.add(allocated_range)
+        return allocated_range
 
     def free(self, ip_range):
         """
@@ -167,11 +259,314 @@ class IpRangeManager(object):
 
         @param      ip_range  A ContiguousIpRange object allocated through a call to the
                               'allocate' method.
+
+        @note       The freed range is merged with any adjacent free intervals.
         """
         log.debug("Freeing range: {}".format(ip_range.format_katcp()))
         self._allocated_ranges.remove(ip_range)
-        for ip in ip_range:
-            self._allocated[self._ip_range.index(ip)] = False
+        offset = int(ip_range.base_ip) - self._base
+        span = ip_range.count
+        idx = bisect.bisect_left(self._free_offsets, offset)
+        if idx < len(self._free_offsets) and self._free_offsets[idx] == offset + span:
+            span += self._remove_free(offset + span)
+        if idx > 0:
+            previous = self._free_offsets[idx - 1]
+            if previous + self._free_spans[previous] == offset:
+                span += self._remove_free(previous)
+                offset = previous
+        self._add_free(offset, span)
+
+
+class IpRangeList(object):
+    def __init__(self, ranges):
+        """
+        @brief      Wrapper for an ordered set of non-contiguous IP ranges
+
+        @param      ranges    A list of ContiguousIpRange instances
+
+        @note       This is returned by IpPoolManager.allocate when a request cannot be
+                    satisfied from a single contiguous run of addresses. It supports the
+                    parts of the ContiguousIpRange interface used by consumers of an
+                    allocation (count, iteration, membership and format_katcp).
+        """
+        self._ranges = list(ranges)
+
+    @property
+    def ranges(self):
+        return list(self._ranges)
+
+    @property
+    def count(self):
+        return sum(ip_range.count for ip_range in self._ranges)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for ip_range in self._ranges:
+            for ip in ip_range:
+                yield ip
+
+    def __contains__(self, ip):
+        return any(ip in ip_range for ip_range in self._ranges)
+
+    def __eq__(self, other):
+        if not isinstance(other, IpRangeList):
+            return NotImplemented
+        return self._ranges == other._ranges
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self.format_katcp())
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.format_katcp())
+
+    def format_katcp(self):
+        """
+        @brief  Return a description of the IP ranges in a KATCP friendly format,
+                e.g. 'spead://239.11.1.150+3:7147,spead://239.11.2.0+1:7148'
+        """
+        return ",".join(ip_range.format_katcp() for ip_range in self._ranges)
+
+
+PLACEMENT_POLICIES = ["best-fit", "first-fit", "spread"]
+
+class IpPoolManager(object):
+    def __init__(self, ip_ranges, policy="best-fit", callback=None):
+        """
+        @brief  Class for managing allocation of sub-ranges from several disjoint
+                ContiguousIpRange instances (each with its own port)
+
+        @param  ip_ranges  A list of ContiguousIpRange instances to be managed
+        @param  policy     The placement policy used to choose between the ranges
+                           (see PLACEMENT_POLICIES):
+                           best-fit:  the smallest free run (in any range) that can hold the request
+                           first-fit: the first range (in the order given) that can hold the request
+                           spread:    the range with the most free addresses that can hold the request
+        @param  callback   (optional) A callable taking no arguments that is called whenever
+                           addresses are allocated or freed
+
+        @note   Ranges may not overlap in address space.
+        """
+        if policy not in PLACEMENT_POLICIES:
+            raise ValueError("Unknown placement policy '{}', expected one of {}".format(
+                policy, PLACEMENT_POLICIES))
+        ip_ranges = sorted(ip_ranges, key=lambda ip_range: int(ip_range.base_ip))
+        for lower, upper in zip(ip_ranges[:-1], ip_ranges[1:]):
+            if int(lower.base_ip) + lower.count > int(upper.base_ip):
+                raise ValueError("IP ranges {} and {} overlap".format(
+                    lower.format_katcp(), upper.format_katcp()))
+        self._managers = [IpRangeManager(ip_range) for ip_range in ip_ranges]
+        self._policy = policy
+        self._callback = callback
+
+    def _notify(self):
+        if self._callback is not None:
+            self._callback()
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.format_katcp())
+
+    @property
+    def ranges(self):
+        return [manager._ip_range for manager in self._managers]
+
+    @property
+    def policy(self):
+        return self._policy
+
+    def format_katcp(self):
+        """
+        @brief      Return a description of all managed (allocated and free) IP ranges in
+                    a KATCP friendly format, e.g. 'spead://239.11.1.0+127:7147,spead://239.11.2.0+63:7148'
+        """
+        return ",".join(manager.format_katcp() for manager in self._managers)
+
+    def largest_free_range(self):
+        """
+        @brief      Return the number of IPs in the largest contiguous free range
+        """
+        return max([manager.largest_free_range() for manager in self._managers] or [0])
+
+    def nfree(self):
+        """
+        @brief      Return the total number of free IPs
+        """
+        return sum(manager.nfree() for manager in self._managers)
+
+    def fragmentation(self):
+        """
+        @brief      Return the fragmentation index of the free IPs
+
+        @detail     The index is 1 - (largest free run / total free IPs). It is 0 when all
+                    free IPs form a single run (or none are free) and approaches 1 as the
+                    free IPs are scattered across many small runs.
+        """
+        nfree = self.nfree()
+        if nfree == 0:
+            return 0.0
+        return 1.0 - self.largest_free_range() / float(nfree)
+
+    def allocatable(self, max_runs=1):
+        """
+        @brief      Return the largest number of IPs that can be allocated in at most
+                    max_runs non-contiguous runs
+        """
+        spans = sorted((span for manager in self._managers
+            for _, span in manager._free_ranges()), reverse=True)
+        return sum(spans[:max_runs])
+
+    def _select(self, n):
+        candidates = [(manager, manager._best_fit(n)) for manager in self._managers]
+        candidates = [(manager, span) for manager, span in candidates if span is not None]
+        if not candidates:
+            return None
+        if self._policy == "first-fit":
+            return candidates[0][0]
+        elif self._policy == "spread":
+            return max(candidates, key=lambda candidate: candidate[0].nfree())[0]
+        else:
+            return min(candidates, key=lambda candidate: candidate[1])[0]
+
+    def allocate(self, n, max_runs=1):
+        """
+        @brief      Allocate n IPs
+
+        @param      n         The number of IPs to allocate
+        @param      max_runs  The maximum number of non-contiguous runs the allocation
+                              may be split across
+
+        @return     A ContiguousIpRange object if the allocation fits in a single run,
+                    otherwise an IpRangeList object describing the allocated runs
+
+        @note       A single run is always preferred. Otherwise the largest free runs are
+                    taken whole until the remainder fits in one run, so that the allocation
+                    is split across as few runs as possible.
+        """
+        log.debug("Allocating {} multicast groups in at most {} runs".format(n, max_runs))
+        if n < 1:
+            raise IpRangeAllocationError("Cannot allocate a range of {} addresses".format(n))
+        allocated = []
+        remaining = n
+        while remaining > 0:
+            manager = self._select(remaining)
+            if manager is not None:
+                allocated.append(manager.allocate(remaining))
+                break
+            largest = max(self._managers, key=lambda manager: manager.largest_free_range())
+            span = largest.largest_free_range()
+            if span == 0 or len(allocated) + 1 >= max_runs:
+                for ip_range in allocated:
+                    self.free(ip_range)
+                raise IpRangeAllocationError(
+                    "Could not allocate {} addresses in at most {} runs".format(n, max_runs))
+            allocated.append(largest.allocate(span))
+            remaining -= span
+        self._notify()
+        if len(allocated) == 1:
+            return allocated[0]
+        allocation = IpRangeList(allocated)
+        log.debug("Allocated runs: {}".format(allocation.format_katcp()))
+        return allocation
+
+    def _manager_for(self, ip_range):
+        for manager in self._managers:
+            if ip_range.port == manager._ip_range.port and ip_range.base_ip in manager._ip_range:
+                return manager
+        raise IpRangeAllocationError("{} is not managed by this pool".format(ip_range.format_katcp()))
+
+    def reserve(self, ip_range):
+        """
+        @brief      Allocate a specific IP range
+
+        @param      ip_range  A ContiguousIpRange or IpRangeList object within the managed ranges
+
+        @return     The allocated ContiguousIpRange or IpRangeList object
+        """
+        if isinstance(ip_range, IpRangeList):
+            reserved = []
+            try:
+                for run in ip_range.ranges:
+                    reserved.append(self._manager_for(run).reserve(run))
+            except IpRangeAllocationError:
+                for run in reserved:
+                    self._manager_for(run).free(run)
+                raise
+            allocation = IpRangeList(reserved)
+        else:
+            allocation = self._manager_for(ip_range).reserve(ip_range)
+        self._notify()
+        return allocation
+
+    def free(self, ip_range):
+        """
+        @brief      Free an allocated IP range
+
+        @param      ip_range  A ContiguousIpRange or IpRangeList object allocated through
+                              a call to the 'allocate' method.
+        """
+        runs = ip_range.ranges if isinstance(ip_range, IpRangeList) else [ip_range]
+        for run in runs:
+            self._manager_for(run).free(run)
+        self._notify()
+
+    def plan_compaction(self, movable):
+        """
+        @brief      Plan the relocation of allocations to coalesce free space
+
+        @param      movable   A list of current allocations (ContiguousIpRange or IpRangeList
+                              objects) that may be moved
+
+        @return     A list of (old, new) allocation pairs for the allocations that would move.
+                    The list is empty if relocation would not increase the largest free run.
+
+        @detail     All other allocations are held in place and the movable allocations are
+                    re-placed, largest first, under the pool's placement policy. Each movable
+                    allocation keeps its size and is split across no more runs than it is now.
+                    The plan is not applied; see apply_compaction.
+        """
+        movable_runs = set()
+        for allocation in movable:
+            runs = allocation.ranges if isinstance(allocation, IpRangeList) else [allocation]
+            movable_runs.update(runs)
+        shadow = IpPoolManager(self.ranges, self._policy)
+        for manager in self._managers:
+            for ip_range in manager._allocated_ranges:
+                if ip_range not in movable_runs:
+                    shadow.reserve(ip_range)
+        plan = []
+        for allocation in sorted(movable, key=lambda allocation: allocation.count, reverse=True):
+            nruns = len(allocation.ranges) if isinstance(allocation, IpRangeList) else 1
+            try:
+                plan.append((allocation, shadow.allocate(allocation.count, nruns)))
+            except IpRangeAllocationError:
+                log.debug("Compaction could not re-place {}".format(allocation.format_katcp()))
+                return []
+        if shadow.largest_free_range() <= self.largest_free_range():
+            return []
+        return [(old, new) for old, new in plan if old != new]
+
+    def apply_compaction(self, plan):
+        """
+        @brief      Apply a plan returned by plan_compaction
+
+        @param      plan   A list of (old, new) allocation pairs
+
+        @note       The plan must be applied before any other allocation is made on the pool.
+        """
+        callback, self._callback = self._callback, None
+        try:
+            for old, _ in plan:
+                self.free(old)
+            for _, new in plan:
+                self.reserve(new)
+        finally:
+            self._callback = callback
+        self._notify()
 
 
 def ip_range_from_stream(stream):
@@ -192,3 +587,16 @@ def ip_range_from_stream(stream):
     except ValueError:
         base_ip, ip_count = ip_range, 1
     return ContiguousIpRange(base_ip, port, ip_count)
+
+
+def ip_ranges_from_streams(streams):
+    """
+    @brief      Generate a list of ContiguousIpRange objects from a comma separated
+                list of KATCP-style stream definitions,
+                e.g. 'spead://239.11.1.0+127:7147,spead://239.11.2.0+63:7148'
+
+    @param      streams  A comma separated string of KATCP streams
+
+    @return     A list of ContiguousIpRange objects
+    """
+    return [ip_range_from_stream(stream.strip()) for stream in streams.split(",") if stream.strip()]
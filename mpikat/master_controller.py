@@ -26,11 +26,14 @@ import time
 from tornado.gen import Return, coroutine
 from tornado.ioloop import PeriodicCallback
 from katcp import Sensor, AsyncDeviceServer
-from katcp.kattypes import request, return_reply, Int, Str
+from katcp.kattypes import request, return_reply, Int, Str, Float, Bool
 from mpikat.katportalclient_wrapper import KatportalClientWrapper
+from mpikat.worker_pool import WorkerCapacity, WorkerTopology
 from mpikat.utils import check_ntp_sync
 
 NTP_CALLBACK_PERIOD = 60 * 5 * 1000 # 5 minutes (in milliseconds)
+CONNECTION_EVICTION_PERIOD = 60 * 1000 # 1 minute (in milliseconds)
+HEALTH_PROBE_PERIOD = 30 * 1000 # 30 seconds (in milliseconds)
 
 class ProductLookupError(Exception):
     pass
@@ -38,6 +41,70 @@ class ProductLookupError(Exception):
 class ProductExistsError(Exception):
     pass
 
+WORKER_SPEC_KEYS = ["hostname", "port", "compute", "nic", "memory", "host", "numa", "switch"]
+
+def parse_worker_spec(spec):
+    """
+    @brief  Validate a worker description
+
+    @param  spec  A dictionary with keys 'hostname' and 'port' and optionally any of
+                  'compute', 'nic', 'memory' (see WorkerCapacity) and 'host', 'numa',
+                  'switch' (see WorkerTopology)
+
+    @return A tuple of (hostname, port, WorkerCapacity, WorkerTopology)
+
+    @note   Raises a ValueError if the description is invalid.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("Worker description must be a JSON object, not {}".format(spec))
+    unknown = set(spec) - set(WORKER_SPEC_KEYS)
+    if unknown:
+        raise ValueError("Unknown worker description keys: {}".format(", ".join(sorted(unknown))))
+    try:
+        hostname = str(spec["hostname"])
+        port = int(spec["port"])
+    except KeyError as error:
+        raise ValueError("Worker description is missing {}".format(error))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid port: {}".format(spec["port"]))
+    capacity = WorkerCapacity(float(spec.get("compute", 1.0)), float(spec.get("nic", 1.0)),
+        float(spec.get("memory", 1.0)))
+    if capacity.weight <= 0.0:
+        raise ValueError("Worker capacities must be positive")
+    topology = WorkerTopology(spec.get("host") or None, int(spec.get("numa", 0)),
+        spec.get("switch") or None)
+    return hostname, port, capacity, topology
+
+def load_node_file(filename):
+    """
+    @brief  Read a list of worker descriptions from a node file
+
+    @param  filename  The path to either a JSON file containing a list of worker
+                      descriptions (see parse_worker_spec) or a text file with one
+                      worker per line in the form "hostname port [key=value ...]",
+                      e.g. "fbfpn00 5100 compute=2.0 numa=1 switch=leaf0". Blank lines
+                      and lines starting with '#' are ignored.
+
+    @return A list of worker description dictionaries
+    """
+    with open(filename, "r") as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    specs = []
+    for line in text.splitlines():
+        fields = line.split("#")[0].split()
+        if not fields:
+            continue
+        if len(fields) < 2:
+            raise ValueError("Invalid node file line: '{}'".format(line))
+        spec = {"hostname": fields[0], "port": fields[1]}
+        for field in fields[2:]:
+            key, _, value = field.partition("=")
+            spec[key] = value
+        specs.append(spec)
+    return specs
+
 # ?halt message means shutdown everything and power off all machines
 log = logging.getLogger("mpikat.master_controller")
 
@@ -63,12 +130,48 @@ class MasterController(AsyncDeviceServer):
         self._products = {}
         self._katportal_wrapper_type = KatportalClientWrapper
         self._server_pool = worker_pool
+        self._health_probe_period = HEALTH_PROBE_PERIOD
+        self._probing = False
 
     def start(self):
         """
         @brief  Start the MasterController server
+
+        @note   Worker health probes are run every _health_probe_period milliseconds
+                (disabled if set to None before start is called).
         """
         super(MasterController,self).start()
+        self._connection_eviction_callback = PeriodicCallback(
+            self._server_pool.evict_idle_connections, CONNECTION_EVICTION_PERIOD)
+        self._connection_eviction_callback.start()
+        if self._health_probe_period:
+            self._health_probe_callback = PeriodicCallback(
+                self.probe_workers, self._health_probe_period)
+            self._health_probe_callback.start()
+
+    @coroutine
+    def probe_workers(self):
+        """
+        @brief  Probe the health of all registered workers and update the health sensors
+
+        @note   A probe round is skipped if the previous one has not finished.
+        """
+        if self._probing:
+            log.debug("Skipping worker health probe as previous probe is still running")
+            return
+        self._probing = True
+        try:
+            yield self._server_pool.probe()
+        except Exception:
+            log.exception("Worker health probe failed")
+        finally:
+            self._probing = False
+        self._update_worker_health_sensors()
+
+    def _update_worker_health_sensors(self):
+        self._workers_healthy_sensor.set_value(self._server_pool.nhealthy())
+        self._workers_excluded_sensor.set_value(self._server_pool.nexcluded())
+        self._worker_latency_sensor.set_value(self._server_pool.max_latency())
 
     def add_sensor(self, sensor):
         log.debug("Adding sensor: {}".format(sensor.name))
@@ -95,6 +198,12 @@ class MasterController(AsyncDeviceServer):
                                     unsyncronised.
 
                 products:   The list of product_ids that controller is currently handling
+
+                workers-healthy:  The number of registered workers that passed their last health probe
+
+                workers-excluded: The number of free workers excluded from allocation by health probes
+
+                worker-latency-max:  The largest worker round trip time seen in the last health probe
         """
         self._device_status = Sensor.discrete(
             "device-status",
@@ -131,6 +240,28 @@ class MasterController(AsyncDeviceServer):
             initial_status=Sensor.UNKNOWN)
         self.add_sensor(self._products_sensor)
 
+        self._workers_healthy_sensor = Sensor.integer(
+            "workers-healthy",
+            description="The number of registered workers that passed their last health probe",
+            default=0,
+            initial_status=Sensor.UNKNOWN)
+        self.add_sensor(self._workers_healthy_sensor)
+
+        self._workers_excluded_sensor = Sensor.integer(
+            "workers-excluded",
+            description="The number of free workers excluded from allocation by health probes",
+            default=0,
+            initial_status=Sensor.UNKNOWN)
+        self.add_sensor(self._workers_excluded_sensor)
+
+        self._worker_latency_sensor = Sensor.float(
+            "worker-latency-max",
+            description="The largest worker round trip time seen in the last health probe",
+            unit="s",
+            default=0.0,
+            initial_status=Sensor.UNKNOWN)
+        self.add_sensor(self._worker_latency_sensor)
+
     def _update_products_sensor(self):
         self._products_sensor.set_value(",".join(self._products.keys()))
 
@@ -140,26 +271,121 @@ class MasterController(AsyncDeviceServer):
         else:
             return self._products[product_id]
 
-    @request(Str(), Int())
+    @request(Str(), Int(), Float(default=1.0), Float(default=1.0), Float(default=1.0),
+        Str(default=""), Int(default=0), Str(default=""))
     @return_reply()
-    def request_register_worker_server(self, req, hostname, port):
+    def request_register_worker_server(self, req, hostname, port, compute=1.0, nic=1.0, memory=1.0,
+            host="", numa=0, switch=""):
         """
         @brief   Register an WorkerWrapper instance
 
         @params hostname The hostname for the worker server
         @params port     The port number that the worker server serves on
+        @params compute  (optional) The compute capacity relative to a reference worker
+        @params nic      (optional) The NIC bandwidth relative to a reference worker
+        @params memory   (optional) The memory capacity relative to a reference worker
+        @params host     (optional) The physical host of the worker (defaults to the hostname)
+        @params numa     (optional) The NUMA node of the worker on its host
+        @params switch   (optional) The leaf switch (or rack) the worker's host is attached to
 
         @detail  Register an WorkerWrapper instance that can be used for FBFUSE
                  computation. FBFUSE has no preference for the order in which control
                  servers are allocated to a subarray. An WorkerWrapper wraps an atomic
                  unit of compute comprised of one CPU, one GPU and one NIC (i.e. one NUMA
-                 node on an FBFUSE compute server).
+                 node on an FBFUSE compute server). Workers with larger capacities are
+                 assigned proportionally more load. Products are packed onto as few
+                 switches and hosts as possible. Re-registering a worker updates its
+                 capacity and topology.
         """
         log.debug("Received request to register worker server at {}:{}".format(
             hostname, port))
-        self._server_pool.add(hostname, port)
+        capacity = WorkerCapacity(compute, nic, memory)
+        if capacity.weight <= 0.0:
+            return ("fail", "Worker capacities must be positive")
+        topology = WorkerTopology(host or None, numa, switch or None)
+        self._server_pool.add(hostname, port, capacity, topology)
         return ("ok",)
 
+    @coroutine
+    def register_workers(self, specs, probe=True):
+        """
+        @brief  Register several workers and (optionally) health check them concurrently
+
+        @param  specs  A list of worker descriptions (see parse_worker_spec)
+        @param  probe  Whether to connect to and probe the registered workers
+
+        @return A list with one result dictionary per description, in order, holding the
+                'hostname' and 'port' (where known) and a 'status' of 'ok', 'excluded'
+                (registered but failed its health check) or 'fail' (not registered),
+                along with the 'latency' of the probe or an 'error' description.
+        """
+        results = []
+        registered = []
+        for spec in specs:
+            try:
+                hostname, port, capacity, topology = parse_worker_spec(spec)
+            except Exception as error:
+                results.append({"spec": spec, "status": "fail", "error": str(error)})
+                continue
+            try:
+                self._server_pool.add(hostname, port, capacity, topology)
+            except Exception as error:
+                log.exception("Failed to register worker server at {}:{}".format(hostname, port))
+                results.append({"hostname": hostname, "port": port, "status": "fail",
+                    "error": str(error)})
+                continue
+            server = self._server_pool.get(hostname, port)
+            registered.append(server)
+            results.append({"hostname": hostname, "port": port, "status": "ok", "server": server})
+        if probe and registered:
+            yield self._server_pool.probe(servers=registered)
+            self._update_worker_health_sensors()
+        for result in results:
+            server = result.pop("server", None)
+            if server is None:
+                continue
+            if probe:
+                result["latency"] = server.latency
+                if not server.healthy:
+                    result["status"] = "excluded"
+                    result["error"] = server.probe_error or "device-status is {}".format(
+                        server.device_status)
+                elif server in self._server_pool.excluded():
+                    result["status"] = "excluded"
+                    result["error"] = "Latency {:.3f} s exceeds the limit".format(server.latency)
+        raise Return(results)
+
+    @request(Str(), Bool(default=True))
+    @return_reply(Int())
+    @coroutine
+    def request_register_worker_servers(self, req, workers_json, probe):
+        """
+        @brief   Register several WorkerWrapper instances at once
+
+        @params workers_json  A JSON list of worker descriptions, each an object with keys
+                              'hostname' and 'port' and, optionally, the capacity ('compute',
+                              'nic', 'memory') and topology ('host', 'numa', 'switch') values
+                              accepted by ?register-worker-server
+        @params probe         (optional) Connect to and health check the registered workers
+                              concurrently (default: true)
+
+        @note    The result for each worker is provided via an #inform as a JSON string with
+                 a 'status' of 'ok', 'excluded' (registered but failed its health check) or
+                 'fail' (not registered).
+
+        @return  katcp reply object [[[ !register-worker-servers ok | (fail [error description]) <number of workers registered> ]]]
+        """
+        try:
+            specs = json.loads(workers_json)
+            if not isinstance(specs, list):
+                raise ValueError("Expected a JSON list of worker descriptions")
+        except Exception as error:
+            raise Return(("fail", str(error)))
+        results = yield self.register_workers(specs, probe)
+        for result in results:
+            req.inform(json.dumps(result))
+        raise Return(("ok", len([result for result in results if result["status"] != "fail"])))
+
     @request(Str(), Int())
     @return_reply()
     def request_deregister_worker_server(self, req, hostname, port):
@@ -193,7 +419,10 @@ class MasterController(AsyncDeviceServer):
             req.inform("{} allocated".format(server))
         for server in self._server_pool.available():
             req.inform("{} free".format(server))
-        return ("ok", len(self._server_pool.used()) + len(self._server_pool.available()))
+        for server in self._server_pool.excluded():
+            req.inform("{} excluded".format(server))
+        return ("ok", len(self._server_pool.used()) + len(self._server_pool.available())
+            + len(self._server_pool.excluded()))
 
     @request()
     @return_reply(Int())
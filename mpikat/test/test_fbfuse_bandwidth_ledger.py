@@ -0,0 +1,57 @@
+"""
+Copyright (c) 2018 Ewan Barr <ebarr@mpifr-bonn.mpg.de>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import unittest
+from mpikat.fbfuse_bandwidth_ledger import FbfBandwidthLedger, BandwidthAllocationError
+
+root_logger = logging.getLogger('')
+root_logger.setLevel(logging.CRITICAL)
+
+class TestFbfBandwidthLedger(unittest.TestCase):
+    def test_commit_release(self):
+        calls = []
+        ledger = FbfBandwidthLedger(100.0e9, lambda: calls.append(1))
+        ledger.commit("a", 60.0e9, 10.0e9,
+            {"10.0.0.1:5000": {"ingest": 10.0e9, "output": 60.0e9}},
+            {"239.11.1.1": 60.0e9})
+        self.assertEqual(ledger.remaining_output_rate(), 40.0e9)
+        self.assertEqual(ledger.remaining_output_rate(exclude="a"), 100.0e9)
+        with self.assertRaises(BandwidthAllocationError):
+            ledger.commit("b", 50.0e9, 10.0e9)
+        ledger.commit("b", 40.0e9, 20.0e9, {"10.0.0.1:5000": {"ingest": 20.0e9, "output": 40.0e9}})
+        self.assertEqual(ledger.committed_output_rate(), 100.0e9)
+        self.assertEqual(ledger.committed_ingest_rate(), 30.0e9)
+        self.assertEqual(ledger.worker_rates("10.0.0.1:5000"), {"ingest": 30.0e9, "output": 100.0e9})
+        self.assertEqual(ledger.group_rate("239.11.1.1"), 60.0e9)
+        # Recommitting replaces the previous commitment of a product
+        ledger.commit("a", 30.0e9, 10.0e9)
+        self.assertEqual(ledger.remaining_output_rate(), 30.0e9)
+        self.assertEqual(ledger.group_rate("239.11.1.1"), 0.0)
+        ledger.release("a")
+        ledger.release("a")
+        self.assertEqual(sorted(ledger.products()), ["b"])
+        self.assertIsNone(ledger.product_commitment("a"))
+        self.assertEqual(len(calls), 4)
+
+if __name__ == '__main__':
+    unittest.main(buffer=True)
@@ -21,6 +21,153 @@ SOFTWARE.
 """
 
 import logging
+import unittest
+import numpy as np
+from collections import namedtuple
+from katpoint import Antenna, Target
+from mpikat.fbfuse_beam_manager import (BeamManager, BeamAllocationError, BeamIndex,
+    DynamicTiling, Tiling, beam_shape_overlap, generate_hexagonal_tiling, tiling_coverage,
+    beam_shape_evolution, optimal_tiling_epoch, pairwise_beam_shape_overlap)
+from mpikat.test.utils import ANTENNAS
 
 root_logger = logging.getLogger('')
-root_logger.setLevel(logging.CRITICAL)
\ No newline at end of file
+root_logger.setLevel(logging.CRITICAL)
+
+KATPOINT_ANTENNAS = [Antenna(ANTENNAS["m%03d"%ii]) for ii in range(16)]
+
+BeamShape = namedtuple("BeamShape", ["axisH", "axisV", "angle"])
+
+class TestBeamManager(unittest.TestCase):
+    def test_remove_beam(self):
+        bm = BeamManager(4, KATPOINT_ANTENNAS)
+        beams = [bm.add_beam(Target('test_target{},radec,12:00:00,01:00:00'.format(ii)))
+            for ii in range(3)]
+        bm.remove_beam(beams[1])
+        self.assertEqual(beams[0].target.name, 'test_target0')
+        self.assertEqual(beams[2].target.name, 'test_target2')
+        self.assertEqual(beams[1].target.name, 'unset')
+        # The lowest free beam ID should be reused first
+        beam = bm.add_beam(Target('test_target3,radec,12:00:00,01:00:00'))
+        self.assertEqual(beam.idx, beams[1].idx)
+        bm.remove_beam(beam)
+        with self.assertRaises(BeamAllocationError):
+            bm.remove_beam(beam)
+
+    def test_remove_tiling(self):
+        bm = BeamManager(8, KATPOINT_ANTENNAS)
+        beam = bm.add_beam(Target('test_target0,radec,12:00:00,01:00:00'))
+        tiling = bm.add_tiling(Target('test_target1,radec,12:00:00,01:00:00'), 4, 1.4e9, 0.5)
+        bm.remove_tiling(tiling)
+        self.assertEqual(beam.target.name, 'test_target0')
+        tiling = bm.add_tiling(Target('test_target1,radec,12:00:00,01:00:00'), 7, 1.4e9, 0.5)
+        self.assertEqual(tiling.nbeams, 7)
+        with self.assertRaises(BeamAllocationError):
+            bm.add_tiling(Target('test_target1,radec,12:00:00,01:00:00'), 1, 1.4e9, 0.5)
+
+    def test_dynamic_tiling_tracking(self):
+        bm = BeamManager(8, KATPOINT_ANTENNAS)
+        target = Target('test_target1,radec,12:00:00,01:00:00')
+        static = bm.add_tiling(target, 2, 1.4e9, 0.5)
+        dynamic = bm.add_tiling(target, 2, 1.4e9, 0.5, dynamic=True, update_period=600)
+        self.assertIsInstance(dynamic, DynamicTiling)
+        self.assertEqual(bm.dynamic_tilings, [dynamic])
+        bm.remove_tiling(dynamic)
+        self.assertEqual(bm.dynamic_tilings, [])
+        bm.remove_tiling(static)
+
+    def test_lookup(self):
+        bm = BeamManager(4, KATPOINT_ANTENNAS)
+        near = bm.add_beam(Target('near,radec,180.0,-30.0'))
+        far = bm.add_beam(Target('far,radec,180.0,-31.0'))
+        self.assertEqual(bm.lookup(180.0, -30.001, 0.01), [near])
+        self.assertEqual(bm.lookup(180.0, -30.4, 0.7), [near, far])
+        bm.remove_beam(near)
+        self.assertEqual(bm.lookup(180.0, -30.0, 0.01), [])
+        # Free beams are not indexed at their default position
+        self.assertEqual(bm.lookup(0.0, 0.0, 1.0), [])
+        bm.reset()
+        self.assertEqual(bm.lookup(180.0, -31.0, 0.01), [])
+
+
+class TestBeamIndex(unittest.TestCase):
+    def test_lookup_against_brute_force(self):
+        index = BeamIndex(cell_size=1.0)
+        ra = [0.1, 359.9, 10.0, 45.0, 0.0, 180.0, 123.0]
+        dec = [0.0, 0.0, 89.9, 89.9, -89.5, 60.0, -30.0]
+        for ii in range(len(ra)):
+            index.update(ii, ra[ii], dec[ii])
+        # Search across the RA wrap and across the pole
+        self.assertEqual(sorted(index.lookup(0.0, 0.0, 0.5)), [0, 1])
+        self.assertEqual(sorted(index.lookup(200.0, 89.95, 0.5)), [2, 3])
+        self.assertEqual(index.lookup(90.0, -90.0, 0.6), [4])
+        self.assertEqual(index.lookup(184.0, 60.0, 1.0), [])
+        self.assertEqual(index.lookup(184.0, 60.0, 2.1), [5])
+        index.update(6, 124.0, -30.0)
+        self.assertEqual(index.lookup(123.0, -30.0, 0.5), [])
+        index.remove(6)
+        self.assertEqual(len(index), 6)
+
+
+class TestDynamicTiling(unittest.TestCase):
+    def test_beam_shape_overlap(self):
+        shape = BeamShape(2.0, 1.0, 0.0)
+        self.assertAlmostEqual(beam_shape_overlap(shape, shape), 1.0)
+        rotated = BeamShape(2.0, 1.0, 90.0)
+        self.assertTrue(beam_shape_overlap(shape, rotated) < 0.5)
+
+    def test_needs_update(self):
+        tiling = DynamicTiling(Target('test_target1,radec,12:00:00,01:00:00'),
+            1.4e9, 0.5, update_period=100.0, coverage_threshold=0.9)
+        shape = BeamShape(2.0, 1.0, 0.0)
+        self.assertTrue(tiling.needs_update(shape, now=0.0))
+        tiling.apply(shape, [], 0.0)
+        self.assertFalse(tiling.needs_update(shape, now=50.0))
+        self.assertTrue(tiling.needs_update(shape, now=100.0))
+        self.assertTrue(tiling.needs_update(BeamShape(2.0, 1.0, 45.0), now=50.0))
+
+
+class TestTilingEpoch(unittest.TestCase):
+    def setUp(self):
+        self.transit = 1530000000.0
+        lst = KATPOINT_ANTENNAS[0].local_sidereal_time(self.transit)
+        self.target = Target('transit,radec,{},-40.0'.format(np.rad2deg(float(lst))))
+
+    def test_beam_shape_evolution(self):
+        epochs = self.transit + np.array([-3600.0, 0.0, 3600.0])
+        shapes, elevation = beam_shape_evolution(KATPOINT_ANTENNAS, 1.4e9, self.target, epochs)
+        self.assertEqual(len(shapes), 3)
+        self.assertEqual(np.argmax(elevation), 1)
+        for shape in shapes:
+            self.assertTrue(shape.axisH >= shape.axisV > 0.0)
+        # The beam shape should be (nearly) symmetric about transit
+        self.assertAlmostEqual(shapes[0].axisH, shapes[2].axisH, delta=0.05 * shapes[0].axisH)
+
+    def test_pairwise_overlap(self):
+        shapes = [BeamShape(2.0, 1.0, 0.0), BeamShape(2.0, 1.0, 90.0), BeamShape(2.0, 1.0, 0.0)]
+        overlap = pairwise_beam_shape_overlap(shapes)
+        self.assertTrue(np.allclose(np.diag(overlap), 1.0))
+        self.assertAlmostEqual(overlap[0, 2], 1.0)
+        self.assertAlmostEqual(overlap[0, 1], beam_shape_overlap(shapes[0], shapes[1], 64), places=4)
+
+    def test_optimal_tiling_epoch(self):
+        epoch = optimal_tiling_epoch(KATPOINT_ANTENNAS, 1.4e9, self.target,
+            self.transit - 7200.0, self.transit + 7200.0, nsamples=33)
+        self.assertTrue(abs(epoch - self.transit) < 900.0)
+
+
+class TestHexagonalTiling(unittest.TestCase):
+    def test_generate(self):
+        target = Target('test_target,radec,123.1,-30.3')
+        shape = BeamShape(0.01, 0.004, 30.0)
+        coordinates = generate_hexagonal_tiling(shape, target, 400, 0.5)
+        self.assertEqual(coordinates.shape, (400, 2))
+        self.assertAlmostEqual(coordinates[0][0], 123.1)
+        self.assertAlmostEqual(coordinates[0][1], -30.3)
+        self.assertTrue(tiling_coverage(shape, target, coordinates, 0.5) > 0.8)
+
+    def test_invalid_method(self):
+        with self.assertRaises(ValueError):
+            Tiling(Target('test_target,radec,123.1,-30.3'), 1.4e9, 0.5, method="unknown")
+
+if __name__ == '__main__':
+    unittest.main(buffer=True)
\ No newline at end of file
@@ -19,9 +19,17 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import os
+import json
+import shutil
+import tempfile
 import unittest
 import mock
-from mpikat.fbfuse_config import FbfConfigurationManager, MIN_NBEAMS, FbfConfigurationError
+from mpikat.fbfuse_config import (FbfConfigurationManager, MIN_NBEAMS, FbfConfigurationError,
+    FbfPerformanceTable, load_default_performance_table, OBJECTIVE_NWORKERS, OBJECTIVE_RESOLUTION,
+    estimate_configurations, feng_timestamp_step, apportion, balanced_worker_sets,
+    MAX_INPUT_RATE_PER_WORKER, FENG_NBITS_PER_SAMPLE, split_beams_between_sets, NBITS_AUTO)
+from mpikat.fbfuse_performance_benchmark import legacy_capacity, generate_table, DEFAULT_AXES
 
 NBEAMS_OVERFLOW_TOLERANCE = 0.05 # 5%
 
@@ -65,6 +73,91 @@ class TestFbfConfigurationManager(unittest.TestCase):
                     for nbeam in nbeams:
                         self._verify_configuration(cm, 16, 1, bandwidth, nbeam, antenna, granularity)
 
+    def test_channel_modes(self):
+        for total_nchans in [1024, 32768]:
+            cm = FbfConfigurationManager(64, 856e6, total_nchans, 64, 128)
+            self.assertEqual(cm.nchans_per_worker, total_nchans // 64)
+            self.assertEqual(cm.nchans_per_group * 4, cm.nchans_per_worker)
+            for bandwidth in [10e6, 856e6]:
+                for nbeam in [40, 2000]:
+                    self._verify_configuration(cm, 16, 1, bandwidth, nbeam, 64, 1)
+        # Beamformer capacity depends on the bandwidth per worker, not the mode
+        capacities = [FbfConfigurationManager(64, 856e6, total_nchans, 64, 128
+            )._max_nbeam_per_worker_by_performance(16, 1, 64) for total_nchans in [1024, 4096, 32768]]
+        self.assertEqual(len(set(capacities)), 1)
+        with self.assertRaises(FbfConfigurationError):
+            FbfConfigurationManager(64, 856e6, 2048, 64, 128)
+
+    def test_non_power_of_two_antennas(self):
+        for nantennas in [4, 16, 64]:
+            cm = FbfConfigurationManager(nantennas, 856e6, 4096, 64, 128)
+            self.assertEqual(cm.nchans_per_worker, 4096 // nantennas)
+        cm = FbfConfigurationManager(40, 856e6, 4096, 64, 128)
+        self.assertEqual(cm.nchans_per_group, 16)
+        self.assertEqual(cm.nchans_per_worker, 96)
+        self.assertTrue(cm.bandwidth_per_worker * 40 * FENG_NBITS_PER_SAMPLE <= MAX_INPUT_RATE_PER_WORKER)
+        config = cm.get_configuration(16, 1, 400, 40)
+        self.assertEqual(config['num_workers_per_set'], 43)
+        partition = cm.partition_workers([1.0] * 43, 1, 4096)
+        self.assertEqual(sum(n for _, _, n in partition[0]), 4096)
+        self.assertTrue(max(n for _, _, n in partition[0]) <= cm.nchans_per_worker)
+
+    def test_fscrunch_partitioning(self):
+        # 1k mode with 64 antennas leaves 4 channels per multicast group
+        cm = FbfConfigurationManager(64, 856e6, 1024, 64, 128)
+        with self.assertRaises(FbfConfigurationError):
+            cm.get_configuration(16, 8, 400, 64)
+        config = cm.get_configuration(16, 8, 400, 64, scrunch_options=[(16, 8), (16, 4)])
+        self.assertEqual(config['fscrunch'], 4)
+
+    def test_timestamp_step(self):
+        self.assertEqual(feng_timestamp_step(4096), 2097152)
+        self.assertEqual(feng_timestamp_step(1024), 524288)
+        self.assertEqual(feng_timestamp_step(32768, 128), 8388608)
+
+    def test_apportion(self):
+        self.assertEqual(apportion(16, [1, 1, 2]), [4, 4, 8])
+        self.assertEqual(apportion(4, [1, 1, 1]), [2, 1, 1])
+        self.assertEqual(sum(apportion(1000, [0.3, 1.7, 2.2, 0.0])), 1000)
+        with self.assertRaises(FbfConfigurationError):
+            apportion(4, [0, 0])
+
+    def test_balanced_worker_sets(self):
+        sets = balanced_worker_sets([1.0, 2.0, 1.0, 2.0, 0.5], 2, 2)
+        self.assertEqual(sorted(sorted(s) for s in sets), [[0, 1], [2, 3]])
+        with self.assertRaises(FbfConfigurationError):
+            balanced_worker_sets([1.0, 1.0], 2, 2)
+
+    def test_split_beams_between_sets(self):
+        mapping = {"239.11.1.1": ["cfbf00000", "cfbf00001", "cfbf00002", "cfbf00003"],
+                   "239.11.1.2": ["cfbf00004"]}
+        maps = split_beams_between_sets(mapping, 2)
+        self.assertEqual(maps[0], {"239.11.1.1": ["cfbf00000", "cfbf00001"],
+                                   "239.11.1.2": ["cfbf00004"]})
+        self.assertEqual(maps[1], {"239.11.1.1": ["cfbf00002", "cfbf00003"]})
+
+    def test_heterogeneous_workers(self):
+        # Four reference workers and four workers with twice the capacity
+        weights = [1.0, 1.0, 1.0, 1.0, 2.0, 2.0, 2.0, 2.0]
+        uniform = FbfConfigurationManager(64, 856e6, 4096, 8, 128)
+        mixed = FbfConfigurationManager(64, 856e6, 4096, 8, 128, worker_weights=weights)
+        nchans = 8 * uniform.nchans_per_worker
+        self.assertTrue(mixed._worker_set_scales(1, 8, nchans)[0] > 1.0)
+        nbeams = lambda cm: cm.get_configuration(16, 1, 100000, 64, 8 * 13.375e6)['num_beams']
+        self.assertTrue(nbeams(mixed) > nbeams(uniform))
+        partition = mixed.partition_workers(weights, 1, nchans)
+        self.assertEqual(len(partition), 1)
+        nchans_by_worker = {idx: n for idx, _, n in partition[0]}
+        self.assertEqual(sum(nchans_by_worker.values()), nchans)
+        self.assertTrue(nchans_by_worker[4] > nchans_by_worker[0])
+        # Channel ranges are contiguous and cover the processed band
+        ranges = sorted((chan0, n) for _, chan0, n in partition[0])
+        self.assertEqual(ranges[0][0], 0)
+        for (chan0, n), (next_chan0, _) in zip(ranges[:-1], ranges[1:]):
+            self.assertEqual(chan0 + n, next_chan0)
+        with self.assertRaises(FbfConfigurationError):
+            FbfConfigurationManager(64, 856e6, 4096, 8, 128, worker_weights=[1.0])
+
     def test_invalid_nantennas(self):
         cm = FbfConfigurationManager(64, 856e6, 4096, 64, 128)
         with self.assertRaises(FbfConfigurationError):
@@ -75,11 +168,112 @@ class TestFbfConfigurationManager(unittest.TestCase):
         with self.assertRaises(FbfConfigurationError):
             self._verify_configuration(cm, 16, 1, 856e6, 400, 32, 1)
 
+    def test_search_configurations(self):
+        cm = FbfConfigurationManager(64, 856e6, 4096, 64, 20)
+        configs = cm.search_configurations(16, 1, 2000, 64, 100e6, 16)
+        self.assertEqual(len(configs), 4)
+        nbeams = [config['num_beams'] for config in configs]
+        self.assertEqual(nbeams, sorted(nbeams, reverse=True))
+        for config in configs:
+            self.assertTrue(config['num_mcast_groups'] <= 20)
+            self.assertEqual(config['num_beams'],
+                config['num_mcast_groups'] * config['num_beams_per_mcast_group'])
+            self.assertEqual(config['num_beams_per_mcast_group'] % config['num_worker_sets'], 0)
+
+    def test_objectives(self):
+        cm = FbfConfigurationManager(64, 856e6, 4096, 64, 128)
+        config = cm.get_configuration(16, 1, 400, 64, 100e6, 1, objective=OBJECTIVE_NWORKERS)
+        self.assertEqual(config['num_worker_sets'], 1)
+        config = cm.get_configuration(16, 1, 400, 64, 856e6, 1, objective=OBJECTIVE_RESOLUTION,
+            scrunch_options=[(16, 1), (1, 2), (4, 1)])
+        self.assertEqual((config['tscrunch'], config['fscrunch']), (1, 2))
+        with self.assertRaises(FbfConfigurationError):
+            cm.get_configuration(16, 1, 400, objective="unknown")
+
+    def test_output_nbits(self):
+        # At tscrunch 4 the number of beams is limited by the output data rate
+        cm = FbfConfigurationManager(16, 856e6, 4096, 64, 128)
+        nbeams = {}
+        for nbits in [8, 4, 2]:
+            config = cm.get_configuration(4, 1, 100000, 16, nbits=nbits)
+            self.assertEqual(config['nbits'], nbits)
+            nbeams[nbits] = config['num_beams']
+        self.assertTrue(nbeams[2] > nbeams[4] > nbeams[8])
+        config = cm.get_configuration(4, 1, 100000, 16, nbits=NBITS_AUTO)
+        self.assertEqual((config['nbits'], config['num_beams']), (2, nbeams[2]))
+        # Full bit depth is kept when it delivers the requested beams
+        config = cm.get_configuration(16, 1, 100, 16, nbits=NBITS_AUTO)
+        self.assertEqual(config['nbits'], 8)
+        with self.assertRaises(FbfConfigurationError):
+            cm.get_configuration(16, 1, 100, 16, nbits=3)
+
+    def test_output_rate_budget(self):
+        full = FbfConfigurationManager(16, 856e6, 4096, 64, 128).get_configuration(4, 1, 100000, 16)
+        cm = FbfConfigurationManager(16, 856e6, 4096, 64, 128, max_output_rate=100e9)
+        config = cm.get_configuration(4, 1, 100000, 16)
+        self.assertTrue(config['num_beams'] < full['num_beams'])
+        self.assertTrue(config['num_beams'] * 856e6 / 4 * 8 <= 100e9)
+        cm = FbfConfigurationManager(16, 856e6, 4096, 64, 128, max_output_rate=0.0)
+        with self.assertRaises(FbfConfigurationError):
+            cm.get_configuration(4, 1, 100, 16)
+
+    def test_estimate_configurations(self):
+        estimate_configurations.cache_clear()
+        configs = estimate_configurations(64, 856e6, 4096, 64, 128, 16, 1, 400, 64, 856e6)
+        cm = FbfConfigurationManager(64, 856e6, 4096, 64, 128)
+        self.assertEqual(list(configs), cm.search_configurations(16, 1, 400, 64, 856e6))
+        self.assertIs(estimate_configurations(64, 856e6, 4096, 64, 128, 16, 1, 400, 64, 856e6), configs)
+        self.assertEqual(estimate_configurations.cache_size(), 1)
+        with self.assertRaises(FbfConfigurationError):
+            estimate_configurations(64, 856e6, 4096, 0, 128, 16, 1, 400, 64, 856e6)
+
     def test_no_remaining_groups(self):
         cm = FbfConfigurationManager(64, 856e6, 4096, 64, 0)
         with self.assertRaises(FbfConfigurationError):
             self._verify_configuration(cm, 16, 1, 856e6, 400, 32, 1)
 
+class TestFbfPerformanceTable(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_default_table_matches_grid_points(self):
+        table = load_default_performance_table()
+        for nantennas in DEFAULT_AXES['nantennas']:
+            for nchans in DEFAULT_AXES['nchans']:
+                self.assertAlmostEqual(table.lookup(nantennas, nchans, 16, 1),
+                    legacy_capacity(nantennas, nchans, 16, 1), places=6)
+
+    def test_interpolation(self):
+        table = load_default_performance_table()
+        # The seed table scales as nchans/nantennas so log-log interpolation is exact
+        self.assertAlmostEqual(table.lookup(13, 256, 16, 1), legacy_capacity(13, 256, 16, 1), places=6)
+        value = table.lookup(4, 64, 3, 1)
+        self.assertTrue(table.lookup(4, 64, 4, 1) < value < table.lookup(4, 64, 2, 1))
+        # Values outside of the grid are clamped
+        self.assertAlmostEqual(table.lookup(1, 256, 16, 1), table.lookup(4, 256, 16, 1))
+
+    def test_save_load(self):
+        axes = {'nantennas': [4, 64], 'nchans': [64], 'tscrunch': [1, 16], 'fscrunch': [1]}
+        table = generate_table(axes, legacy_capacity, {'source': 'test'})
+        filename = os.path.join(self.tempdir, "table.json")
+        table.save(filename)
+        loaded = FbfPerformanceTable.from_file(filename)
+        self.assertEqual(loaded.metadata, {'source': 'test'})
+        self.assertAlmostEqual(loaded.lookup(16, 64, 4, 1), table.lookup(16, 64, 4, 1))
+        cm = FbfConfigurationManager(64, 856e6, 4096, 64, 128, performance_table=loaded)
+        self.assertEqual(cm._max_nbeam_per_worker_by_performance(16, 1, 64), 672)
+
+    def test_version_mismatch(self):
+        filename = os.path.join(self.tempdir, "table.json")
+        with open(filename, "w") as f:
+            json.dump({'version': -1}, f)
+        with self.assertRaises(FbfConfigurationError):
+            FbfPerformanceTable.from_file(filename)
+
+
 if __name__ == "__main__":
     import logging
     logging.basicConfig(level=logging.DEBUG)
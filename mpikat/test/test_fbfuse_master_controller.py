@@ -28,7 +28,11 @@ import time
 import sys
 import importlib
 import re
+import json
 import ipaddress
+import os
+import tempfile
+from collections import namedtuple
 from urllib2 import urlopen, URLError
 from StringIO import StringIO
 from tornado.ioloop import IOLoop
@@ -46,6 +50,10 @@ from mpikat import (
 from mpikat.katportalclient_wrapper import KatportalClientWrapper
 from mpikat.test.utils import MockFbfConfigurationAuthority, AsyncServerTester, MockKatportalClientWrapper
 from mpikat.ip_manager import ContiguousIpRange, ip_range_from_stream
+from mpikat.master_controller import load_node_file, parse_worker_spec
+from mpikat.fbfuse_delay_buffer_controller import DEFAULT_UPDATE_RATE
+
+BeamShape = namedtuple("BeamShape", ["axisH", "axisV", "angle"])
 
 root_logger = logging.getLogger('')
 root_logger.setLevel(logging.CRITICAL)
@@ -90,6 +98,8 @@ class TestFbfMasterController(AsyncServerTester):
         yield self._send_request_expect_fail('set-default-sb-configuration', 'test', '')
         yield self._send_request_expect_fail('add-beam', 'test', '')
         yield self._send_request_expect_fail('add-tiling', 'test', '', 0, 0, 0, 0)
+        yield self._send_request_expect_fail('beam-lookup', 'test', 0, 0, 0)
+        yield self._send_request_expect_fail('estimate-configuration', 'test', '{}')
         yield self._send_request_expect_fail('configure-coherent-beams', 'test', 0, '', 0, 0)
         yield self._send_request_expect_fail('configure-incoherent-beam', 'test', '', 0, 0)
 
@@ -114,14 +124,164 @@ class TestFbfMasterController(AsyncServerTester):
             yield sleep(0.5)
             if product.ready: break
         yield self._check_sensor_value(product_state_sensor, FbfProductController.READY)
+        # Every worker set covers all channels and each coherent beam is formed exactly once
+        _, nsets = yield self._get_sensor_reading("{}.nserver-sets".format(product_name))
+        _, nchans = yield self._get_sensor_reading("{}.nchannels".format(product_name))
+        _, plan = yield self._get_sensor_reading("{}.partition-plan".format(product_name))
+        _, mapping = yield self._get_sensor_reading(
+            "{}.coherent-beam-multicast-group-mapping".format(product_name))
+        plan, mapping = json.loads(plan), json.loads(mapping)
+        self.assertEqual(set(entry['worker_set'] for entry in plan), set(range(nsets)))
+        formed = {}
+        for worker_set in range(nsets):
+            entries = [entry for entry in plan if entry['worker_set'] == worker_set]
+            self.assertEqual(sum(entry['nchans'] for entry in entries), nchans)
+            for group, beams in entries[0]['mcast_to_beam_map'].items():
+                if group in mapping:
+                    formed.setdefault(group, []).extend(beams)
+        self.assertEqual({group: sorted(beams) for group, beams in formed.items()},
+            {group: sorted(beams) for group, beams in mapping.items()})
+        # The product's output is committed in the bandwidth ledger
+        _, output_rate = yield self._get_sensor_reading("output-rate-committed")
+        self.assertTrue(output_rate > 0.0)
+        reply, informs = yield self._send_request_expect_ok('bandwidth-ledger')
+        self.assertEqual(int(reply.arguments[1]), 1)
+        self.assertAlmostEqual(json.loads(informs[0].arguments[0])[product_name]['output'], output_rate)
+        # The incoherent beam group and coherent beam groups are taken from the output pool
+        _, ngroups = yield self._get_sensor_reading("{}.coherent-beam-ngroups".format(product_name))
+        yield self._check_sensor_value("output-ip-free", 128 - 1 - ngroups)
+        yield self._check_sensor_value("output-ip-fragmentation", 0.0)
         yield self._send_request_expect_ok('capture-start', product_name)
         yield self._check_sensor_value(product_state_sensor, FbfProductController.CAPTURING)
         yield self._send_request_expect_ok('capture-stop', product_name)
+        reply, _ = yield self._send_request_expect_ok('compact-ip-pool', True)
+        self.assertEqual(int(reply.arguments[1]), 0)
         yield self._send_request_expect_ok('deconfigure', product_name)
         self.assertEqual(self.server._products, {})
+        yield self._check_sensor_value("output-rate-committed", 0.0)
+        yield self._check_sensor_value("output-ip-free", 128)
         has_sensor = yield self._check_sensor_exists(product_state_sensor)
         self.assertFalse(has_sensor)
 
+    @gen_test
+    def test_compact_ip_pool(self):
+        product_name = 'test_product'
+        proxy_name = 'FBFUSE_test'
+        self._add_n_servers(64)
+        # Leave a hole at the start of the output pool
+        blocker = self.server._ip_pool.allocate(5)
+        yield self._send_request_expect_ok('configure', product_name, self.DEFAULT_ANTENNAS,
+            self.DEFAULT_NCHANS, self.DEFAULT_STREAMS, proxy_name)
+        yield self._send_request_expect_ok('provision-beams', product_name, 'random_schedule_block_id')
+        product = self.server._products[product_name]
+        while True:
+            yield sleep(0.5)
+            if product.ready: break
+        self.server._ip_pool.free(blocker)
+        _, fragmentation = yield self._get_sensor_reading("output-ip-fragmentation")
+        self.assertTrue(fragmentation > 0.0)
+        # Products that are not idle are never moved
+        reply, _ = yield self._send_request_expect_ok('compact-ip-pool')
+        self.assertEqual(int(reply.arguments[1]), 0)
+        yield self._send_request_expect_ok('capture-start', product_name)
+        yield self._send_request_expect_ok('capture-stop', product_name)
+        reply, informs = yield self._send_request_expect_ok('compact-ip-pool', True)
+        self.assertEqual(int(reply.arguments[1]), len(informs))
+        self.assertTrue(len(informs) > 0)
+        yield self._check_sensor_value("output-ip-fragmentation", 0.0)
+        base_ip = self.server._ip_pool.ranges[0].base_ip
+        _, mapping = yield self._get_sensor_reading(
+            "{}.coherent-beam-multicast-group-mapping".format(product_name))
+        groups = [ip for allocation in product.mcast_allocations() for ip in allocation]
+        self.assertEqual(sorted(groups), [base_ip + ii for ii in range(len(groups))])
+        self.assertEqual(set(json.loads(mapping)), set(str(ip) for ip in product._cbc_mcast_groups))
+        commitment = self.server._bandwidth_ledger.product_commitment(product_name)
+        self.assertEqual(set(commitment['groups']), set(str(ip) for ip in groups))
+
+    @gen_test
+    def test_sticky_worker_affinity(self):
+        product_name = 'test_product'
+        proxy_name = 'FBFUSE_test'
+        self._add_n_servers(64)
+        yield self._send_request_expect_ok('configure', product_name, self.DEFAULT_ANTENNAS,
+            self.DEFAULT_NCHANS, self.DEFAULT_STREAMS, proxy_name)
+        product = self.server._products[product_name]
+        plans = []
+        for sb_id in ('sb0', 'sb1'):
+            yield self._send_request_expect_ok('provision-beams', product_name, sb_id)
+            while True:
+                yield sleep(0.5)
+                if product.ready: break
+            _, plan = yield self._get_sensor_reading("{}.partition-plan".format(product_name))
+            plans.append(json.loads(plan))
+            yield self._send_request_expect_ok('capture-start', product_name)
+            yield self._send_request_expect_ok('capture-stop', product_name)
+        # The same servers are reused for the same channels
+        _, nreused = yield self._get_sensor_reading("{}.servers-reused".format(product_name))
+        self.assertEqual(nreused, len(product.servers))
+        key = lambda entry: (entry['server'], entry['worker_set'], entry['chan0_idx'], entry['nchans'])
+        self.assertEqual(sorted(map(key, plans[0])), sorted(map(key, plans[1])))
+
+    @gen_test(timeout=20)
+    def test_dynamic_tiling_updates(self):
+        product_name = 'test_product'
+        proxy_name = 'FBFUSE_test'
+        self._add_n_servers(64)
+        yield self._send_request_expect_ok('configure', product_name, self.DEFAULT_ANTENNAS,
+            self.DEFAULT_NCHANS, self.DEFAULT_STREAMS, proxy_name)
+        yield self._send_request_expect_ok('provision-beams', product_name, 'random_schedule_block_id')
+        product = self.server._products[product_name]
+        while True:
+            yield sleep(0.5)
+            if product.ready: break
+        tiling = product._beam_manager.add_tiling(Target('test_target,radec,12:00:00,-30:00:00'),
+            4, 1.4e9, 0.5, dynamic=True, update_period=600)
+        swaps = []
+        swap = product._swap_dynamic_tiling
+        def record_swap(*args):
+            swaps.append(time.time())
+            swap(*args)
+        product._swap_dynamic_tiling = record_swap
+        beam_shape = BeamShape(0.01, 0.004, 30.0)
+        coordinates = [(180.0, -30.0 + 0.01 * ii) for ii in range(4)]
+        swap_time = product._schedule_dynamic_tiling_swap(product._beam_manager, tiling,
+            beam_shape, coordinates, time.time())
+        # The new positions are applied half way between delay model updates
+        self.assertAlmostEqual(swap_time % DEFAULT_UPDATE_RATE, DEFAULT_UPDATE_RATE / 2.0)
+        self.assertTrue(time.time() < swap_time <= time.time() + DEFAULT_UPDATE_RATE)
+        while not swaps:
+            yield sleep(0.1)
+        self.assertTrue(swaps[0] >= swap_time)
+        self.assertEqual(tiling.beam_shape, beam_shape)
+        # Checks do not overlap when a check takes longer than the check period
+        nchecks = []
+        @coroutine
+        def slow_check(beam_manager):
+            nchecks.append(beam_manager)
+            yield sleep(0.2)
+        product._update_dynamic_tilings_once = slow_check
+        yield [product._update_dynamic_tilings(), product._update_dynamic_tilings()]
+        self.assertEqual(len(nchecks), 1)
+        yield product._update_dynamic_tilings()
+        self.assertEqual(len(nchecks), 2)
+
+    @gen_test
+    def test_estimate_configuration(self):
+        product_name = 'test_product'
+        proxy_name = 'FBFUSE_test'
+        self._add_n_servers(64)
+        yield self._send_request_expect_ok('configure', product_name, self.DEFAULT_ANTENNAS,
+            self.DEFAULT_NCHANS, self.DEFAULT_STREAMS, proxy_name)
+        reply, informs = yield self._send_request_expect_ok('estimate-configuration', product_name,
+            '{"coherent-beams-nbeams":100, "coherent-beams-granularity":1}')
+        config = json.loads(reply.arguments[1])
+        self.assertTrue(16 <= config['num_beams'] <= 100)
+        for inform in informs:
+            self.assertTrue(json.loads(inform.arguments[0])['num_beams'] <= config['num_beams'])
+        # Nothing should have been allocated
+        self.assertEqual(self.server._server_pool.navailable(), 64)
+        yield self._send_request_expect_fail('estimate-configuration', product_name, 'not json')
+
     @gen_test
     def test_configure_same_product(self):
         product_name = 'test_product'
@@ -178,9 +338,30 @@ class TestFbfMasterController(AsyncServerTester):
         self.assertEqual(informs[0].arguments[0], "{} free".format(server))
         #try adding the same server again (should work)
         yield self._send_request_expect_ok('register-worker-server', hostname, port)
+        # re-registering with a capacity vector updates the capacity
+        yield self._send_request_expect_ok('register-worker-server', hostname, port, 2.0, 1.5, 4.0)
+        self.assertEqual(server.capacity.weight, 1.5)
+        yield self._send_request_expect_ok('register-worker-server', hostname, port, 1.0, 1.0, 1.0,
+            'node0', 1, 'switch0')
+        self.assertEqual(server.topology, (u'node0', 1, u'switch0'))
+        self.assertEqual(server.host_label, 'node0')
+        yield self._send_request_expect_fail('register-worker-server', hostname, port, 0.0)
         yield self._send_request_expect_ok('deregister-worker-server', hostname, port)
         self.assertEqual(len(self.server._server_pool.available()), 0)
 
+    @gen_test
+    def test_register_worker_servers(self):
+        workers = [{"hostname": "127.0.0.1", "port": 10000 + ii, "switch": "leaf0"} for ii in range(3)]
+        workers += [{"hostname": "127.0.0.1"}, {"hostname": "127.0.0.1", "port": 10010, "compute": 0.0}]
+        reply, informs = yield self._send_request_expect_ok('register-worker-servers',
+            json.dumps(workers), False)
+        self.assertEqual(int(reply.arguments[1]), 3)
+        results = [json.loads(inform.arguments[0]) for inform in informs]
+        self.assertEqual([result["status"] for result in results], ["ok"] * 3 + ["fail"] * 2)
+        self.assertEqual(self.server._server_pool.navailable(), 3)
+        self.assertEqual(self.server._server_pool.get("127.0.0.1", 10001).topology.switch, "leaf0")
+        yield self._send_request_expect_fail('register-worker-servers', '{"hostname": "127.0.0.1"}')
+
     @gen_test
     def test_deregister_allocated_worker_server(self):
         hostname, port = '127.0.0.1', 60000
@@ -243,13 +424,13 @@ class TestFbfMasterController(AsyncServerTester):
         yield self._check_sensor_value("{}.incoherent-beam-tscrunch".format(product_name), sb_config['incoherent-beam-tscrunch'])
         yield self._check_sensor_value("{}.incoherent-beam-fscrunch".format(product_name), sb_config['incoherent-beam-fscrunch'])
         yield self._check_sensor_value("{}.incoherent-beam-antennas".format(product_name), 'm008')
-        expected_ibc_mcast_group = ContiguousIpRange(str(self.server._ip_pool._ip_range.base_ip),
-            self.server._ip_pool._ip_range.port, 1)
+        expected_ibc_mcast_group = ContiguousIpRange(str(self.server._ip_pool.ranges[0].base_ip),
+            self.server._ip_pool.ranges[0].port, 1)
         yield self._check_sensor_value("{}.incoherent-beam-multicast-group".format(product_name),
             expected_ibc_mcast_group.format_katcp())
         _, ngroups = yield self._get_sensor_reading("{}.coherent-beam-ngroups".format(product_name))
-        expected_cbc_mcast_groups = ContiguousIpRange(str(self.server._ip_pool._ip_range.base_ip+1),
-            self.server._ip_pool._ip_range.port, ngroups)
+        expected_cbc_mcast_groups = ContiguousIpRange(str(self.server._ip_pool.ranges[0].base_ip+1),
+            self.server._ip_pool.ranges[0].port, ngroups)
         yield self._check_sensor_value("{}.coherent-beam-multicast-groups".format(product_name),
             expected_cbc_mcast_groups.format_katcp())
         yield self._send_request_expect_ok('capture-start', product_name)
@@ -308,6 +489,34 @@ class TestFbfMasterController(AsyncServerTester):
         yield self._check_sensor_value('{}.coherent-beam-cfbf00001'.format(product_name),
             Target(targets[1]).format_katcp())
 
+class TestNodeFile(unittest.TestCase):
+    def _write(self, text):
+        handle, filename = tempfile.mkstemp()
+        with os.fdopen(handle, "w") as f:
+            f.write(text)
+        self.addCleanup(os.remove, filename)
+        return filename
+
+    def test_text_node_file(self):
+        filename = self._write("# FBFUSE nodes\n"
+            "fbfpn00 5100 compute=2.0 numa=1 switch=leaf0\n\n"
+            "fbfpn01 5100  # default capacity\n")
+        specs = load_node_file(filename)
+        self.assertEqual(len(specs), 2)
+        hostname, port, capacity, topology = parse_worker_spec(specs[0])
+        self.assertEqual((hostname, port), ("fbfpn00", 5100))
+        self.assertEqual(capacity.compute, 2.0)
+        self.assertEqual(topology, (None, 1, "leaf0"))
+        self.assertEqual(parse_worker_spec(specs[1])[2].weight, 1.0)
+
+    def test_json_node_file(self):
+        filename = self._write(json.dumps([{"hostname": "fbfpn00", "port": 5100, "nic": 0.5}]))
+        self.assertEqual(parse_worker_spec(load_node_file(filename)[0])[2].weight, 0.5)
+        with self.assertRaises(ValueError):
+            parse_worker_spec({"hostname": "fbfpn00", "port": 5100, "gpu": 1})
+        with self.assertRaises(ValueError):
+            parse_worker_spec({"hostname": "fbfpn00", "port": "x"})
+
 
 if __name__ == '__main__':
     unittest.main(buffer=True)
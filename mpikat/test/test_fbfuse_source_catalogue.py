@@ -0,0 +1,87 @@
+"""
+Copyright (c) 2018 Ewan Barr <ebarr@mpifr-bonn.mpg.de>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from katpoint import Target
+from mpikat.fbfuse_source_catalogue import SourceCatalogue, CatalogueError, primary_beam_radius
+from mpikat.utils import angular_separation
+
+root_logger = logging.getLogger('')
+root_logger.setLevel(logging.CRITICAL)
+
+class TestSourceCatalogue(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        nsources = 10000
+        self.ra = rng.uniform(0.0, 360.0, nsources)
+        self.dec = np.rad2deg(np.arcsin(rng.uniform(-1.0, 1.0, nsources)))
+        self.names = ["src{}".format(ii) for ii in range(nsources)]
+        self.catalogue = SourceCatalogue.from_arrays(self.names, self.ra, self.dec)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_cone_search(self):
+        for ra, dec, radius in [(10.0, -30.0, 5.0), (359.0, 0.0, 3.0), (0.0, 88.0, 5.0)]:
+            sources = self.catalogue.cone_search(ra, dec, radius)
+            expected = np.sum(angular_separation(ra, dec, self.ra, self.dec) <= radius)
+            self.assertEqual(len(sources), expected)
+            separation = angular_separation(ra, dec, sources["ra"], sources["dec"])
+            self.assertTrue(np.all(np.diff(separation) >= 0.0))
+        self.assertEqual(len(self.catalogue.cone_search(10.0, -30.0, 5.0, max_sources=2)), 2)
+
+    def test_save_load(self):
+        filename = os.path.join(self.tempdir, "catalogue.npy")
+        self.catalogue.save(filename)
+        loaded = SourceCatalogue.load(filename)
+        self.assertEqual(len(loaded), len(self.catalogue))
+        targets = loaded.targets_within(10.0, -30.0, 5.0)
+        self.assertEqual(len(targets), len(self.catalogue.cone_search(10.0, -30.0, 5.0)))
+        target = Target(targets[0])
+        self.assertTrue(target.name.startswith("src"))
+
+    def test_from_csv(self):
+        filename = os.path.join(self.tempdir, "catalogue.csv")
+        with open(filename, "w") as f:
+            f.write("# name, ra, dec\n")
+            f.write("J0437-4715, 69.3158, -47.2525\n")
+            f.write("J0835-4510, 128.8359, -45.1764\n")
+        catalogue = SourceCatalogue.from_csv(filename)
+        self.assertEqual(catalogue.targets_within(69.3, -47.25, 0.1),
+            ["J0437-4715,radec,69.31580000,-47.25250000"])
+
+    def test_invalid_declination(self):
+        with self.assertRaises(CatalogueError):
+            SourceCatalogue.from_arrays(["bad"], [0.0], [91.0])
+
+    def test_primary_beam_radius(self):
+        # MeerKAT L-band half power radius is roughly half a degree
+        self.assertTrue(0.4 < primary_beam_radius(1.284e9) < 0.7)
+
+if __name__ == '__main__':
+    unittest.main(buffer=True)
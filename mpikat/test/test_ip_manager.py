@@ -0,0 +1,168 @@
+"""
+Copyright (c) 2018 Ewan Barr <ebarr@mpifr-bonn.mpg.de>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import unittest
+from mpikat.ip_manager import (IpRangeManager, IpPoolManager, IpRangeList,
+    IpRangeAllocationError, ContiguousIpRange, ip_range_from_stream, ip_ranges_from_streams)
+
+root_logger = logging.getLogger('')
+root_logger.setLevel(logging.CRITICAL)
+
+class TestContiguousIpRange(unittest.TestCase):
+    def test_arithmetic_access(self):
+        ip_range = ip_range_from_stream("spead://239.11.1.150+15:7147")
+        self.assertEqual(len(ip_range), 16)
+        self.assertEqual(ip_range.index("239.11.1.155"), 5)
+        self.assertEqual(ip_range.index(ip_range[-1]), 15)
+        self.assertTrue("239.11.1.165" in ip_range)
+        self.assertFalse("239.11.1.166" in ip_range)
+        with self.assertRaises(ValueError):
+            ip_range.index("239.11.1.149")
+        with self.assertRaises(IndexError):
+            ip_range[16]
+        self.assertEqual([str(ip) for ip in ip_range[2:4]], ["239.11.1.152", "239.11.1.153"])
+        self.assertEqual(ip_range[2:4], ContiguousIpRange("239.11.1.152", 7147, 2))
+        self.assertEqual([r.count for r in ip_range.split(6)], [6, 6, 4])
+
+    def test_large_range(self):
+        ip_range = ContiguousIpRange("225.0.0.0", 7148, 2**24)
+        self.assertEqual(ip_range.index("225.255.255.255"), 2**24 - 1)
+        self.assertEqual(str(ip_range[2**23]), "225.128.0.0")
+        self.assertEqual(ip_range[2**23:].format_katcp(), "spead://225.128.0.0+8388608:7148")
+
+
+class TestIpRangeManager(unittest.TestCase):
+    def test_allocate_and_free(self):
+        manager = IpRangeManager(ip_range_from_stream("spead://239.11.1.0+15:7147"))
+        a = manager.allocate(4)
+        b = manager.allocate(4)
+        self.assertEqual(str(a.base_ip), "239.11.1.0")
+        self.assertEqual(str(b.base_ip), "239.11.1.4")
+        self.assertEqual(b.port, 7147)
+        self.assertEqual(manager.largest_free_range(), 8)
+        with self.assertRaises(IpRangeAllocationError):
+            manager.allocate(9)
+        manager.free(a)
+        self.assertEqual(manager._free_ranges(), [(0, 4), (8, 8)])
+        # Freeing the middle range coalesces everything back into one interval
+        manager.free(b)
+        self.assertEqual(manager._free_ranges(), [(0, 16)])
+        self.assertEqual(manager.largest_free_range(), 16)
+
+    def test_best_fit(self):
+        manager = IpRangeManager(ip_range_from_stream("spead://239.11.1.0+15:7147"))
+        ranges = [manager.allocate(n) for n in (3, 1, 2, 1, 9)]
+        manager.free(ranges[0])
+        manager.free(ranges[2])
+        # The 2-address hole is preferred over the 3-address hole
+        self.assertEqual(str(manager.allocate(2).base_ip), "239.11.1.4")
+        self.assertEqual(str(manager.allocate(1).base_ip), "239.11.1.0")
+        self.assertEqual(manager.nfree(), 2)
+
+    def test_large_pool(self):
+        manager = IpRangeManager(ContiguousIpRange("239.0.0.0", 7147, 65536))
+        ranges = [manager.allocate(16) for _ in range(4096)]
+        self.assertEqual(manager.largest_free_range(), 0)
+        self.assertEqual(str(ranges[-1].base_ip), "239.0.255.240")
+        for allocated in ranges[::2]:
+            manager.free(allocated)
+        self.assertEqual(len(manager._free_ranges()), 2048)
+        for allocated in ranges[1::2]:
+            manager.free(allocated)
+        self.assertEqual(manager._free_ranges(), [(0, 65536)])
+
+
+class TestIpPoolManager(unittest.TestCase):
+    def setUp(self):
+        self.streams = "spead://239.11.2.0+7:7148,spead://239.11.1.0+3:7147"
+
+    def test_placement_policies(self):
+        pool = IpPoolManager(ip_ranges_from_streams(self.streams))
+        self.assertEqual(pool.format_katcp(), "spead://239.11.1.0+4:7147,spead://239.11.2.0+8:7148")
+        # Best fit prefers the smaller range
+        self.assertEqual(pool.allocate(3).format_katcp(), "spead://239.11.1.0+3:7147")
+        pool = IpPoolManager(ip_ranges_from_streams(self.streams), policy="spread")
+        self.assertEqual(pool.allocate(3).format_katcp(), "spead://239.11.2.0+3:7148")
+        pool = IpPoolManager(ip_ranges_from_streams(self.streams), policy="first-fit")
+        self.assertEqual(pool.allocate(5).format_katcp(), "spead://239.11.2.0+5:7148")
+        with self.assertRaises(ValueError):
+            IpPoolManager(ip_ranges_from_streams(self.streams), policy="unknown")
+        with self.assertRaises(ValueError):
+            IpPoolManager(ip_ranges_from_streams("spead://239.11.1.0+3:7147,spead://239.11.1.2+3:7148"))
+
+    def test_multi_run_allocation(self):
+        pool = IpPoolManager(ip_ranges_from_streams(self.streams))
+        self.assertEqual(pool.allocatable(1), 8)
+        self.assertEqual(pool.allocatable(2), 12)
+        with self.assertRaises(IpRangeAllocationError):
+            pool.allocate(10)
+        self.assertEqual(pool.nfree(), 12)
+        allocation = pool.allocate(10, max_runs=2)
+        self.assertIsInstance(allocation, IpRangeList)
+        self.assertEqual(allocation.format_katcp(),
+            "spead://239.11.2.0+8:7148,spead://239.11.1.0+2:7147")
+        self.assertEqual(allocation.count, 10)
+        self.assertTrue("239.11.1.1" in allocation)
+        self.assertEqual(len(list(allocation)), 10)
+        pool.free(allocation)
+        self.assertEqual(pool.nfree(), 12)
+        self.assertEqual(pool.largest_free_range(), 8)
+        with self.assertRaises(IpRangeAllocationError):
+            pool.free(ContiguousIpRange("239.11.3.0", 7147, 1))
+
+    def test_reserve(self):
+        pool = IpPoolManager(ip_ranges_from_streams(self.streams))
+        reserved = pool.reserve(ContiguousIpRange("239.11.2.2", 7148, 3))
+        self.assertEqual(reserved.format_katcp(), "spead://239.11.2.2+3:7148")
+        self.assertEqual(pool.largest_free_range(), 4)
+        with self.assertRaises(IpRangeAllocationError):
+            pool.reserve(ContiguousIpRange("239.11.2.4", 7148, 2))
+        with self.assertRaises(IpRangeAllocationError):
+            pool.reserve(ContiguousIpRange("239.11.2.0", 7147, 1))
+        pool.free(reserved)
+        self.assertEqual(pool.largest_free_range(), 8)
+
+    def test_fragmentation_and_compaction(self):
+        updates = []
+        pool = IpPoolManager(ip_ranges_from_streams("spead://239.11.1.0+15:7147"),
+            callback=lambda: updates.append(pool.nfree()))
+        self.assertEqual(pool.fragmentation(), 0.0)
+        ranges = [pool.allocate(4) for _ in range(4)]
+        pool.free(ranges[0])
+        pool.free(ranges[2])
+        self.assertEqual(updates, [12, 8, 4, 0, 4, 8])
+        self.assertAlmostEqual(pool.fragmentation(), 0.5)
+        # Only ranges[3] may move, and it fills the hole left by ranges[2]
+        plan = pool.plan_compaction([ranges[3]])
+        self.assertEqual(plan, [(ranges[3], ContiguousIpRange("239.11.1.0", 7147, 4))])
+        self.assertEqual(pool.largest_free_range(), 4)
+        pool.apply_compaction(plan)
+        self.assertEqual(pool.largest_free_range(), 8)
+        self.assertEqual(pool.fragmentation(), 0.0)
+        self.assertEqual(updates[-1], 8)
+        # Nothing to gain from moving an already compact pool
+        self.assertEqual(pool.plan_compaction([ranges[1], plan[0][1]]), [])
+
+
+if __name__ == '__main__':
+    unittest.main(buffer=True)
@@ -0,0 +1,314 @@
+"""
+Copyright (c) 2018 Ewan Barr <ebarr@mpifr-bonn.mpg.de>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import time
+import unittest
+from collections import namedtuple
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+from katcp import Message
+from mpikat.worker_pool import (WorkerPool, WorkerWrapper, WorkerCapacity, WorkerTopology,
+    WorkerAllocationError)
+
+root_logger = logging.getLogger('')
+root_logger.setLevel(logging.CRITICAL)
+
+Response = namedtuple("Response", ["reply", "informs"])
+
+def resolved(result=None, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+class OfflineRequests(object):
+    def __init__(self, client):
+        self._client = client
+
+    def watchdog(self, timeout=None):
+        return resolved(Response(Message.reply("watchdog", "ok"), []))
+
+    def sensor_value(self, name, timeout=None):
+        return resolved(Response(Message.reply("sensor-value", "ok", 1), [Message.inform(
+            "sensor-value", "0.0", 1, name, "nominal", self._client.worker.device_state)]))
+
+class OfflineClient(object):
+    def __init__(self, worker):
+        self.worker = worker
+        self.running = False
+        self.req = OfflineRequests(self)
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def until_synced(self, timeout=None):
+        return resolved(error=None if self.worker.reachable else Exception("Timed out"))
+
+class OfflineProbeClient(object):
+    def __init__(self, worker):
+        self.worker = worker
+        self.running = False
+
+    def set_ioloop(self, ioloop=None):
+        pass
+
+    def start(self):
+        self.running = True
+        self.worker.nprobe_clients += 1
+
+    def stop(self):
+        self.running = False
+
+    def until_protocol(self, timeout=None):
+        return resolved(error=None if self.worker.reachable else Exception("Timed out"))
+
+    def future_request(self, msg, timeout=None):
+        if msg.name == "watchdog":
+            return resolved((Message.reply("watchdog", "ok"), []))
+        return resolved((Message.reply("sensor-value", "ok", 1), [Message.inform(
+            "sensor-value", "0.0", 1, msg.arguments[0], "nominal", self.worker.device_state)]))
+
+class OfflineWorkerWrapper(WorkerWrapper):
+    reachable = True
+    device_state = "ok"
+    nprobe_clients = 0
+
+    def _make_client(self):
+        return OfflineClient(self)
+
+    def _make_probe_client(self):
+        return OfflineProbeClient(self)
+
+class OfflineWorkerPool(WorkerPool):
+    def make_wrapper(self, hostname, port):
+        return OfflineWorkerWrapper(hostname, port)
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        # Two switches: sw0 has two hosts with four workers each, sw1 has
+        # three hosts with two workers each
+        self.pool = OfflineWorkerPool()
+        layout = [("sw0", "node0", 4), ("sw0", "node1", 4),
+                  ("sw1", "node2", 2), ("sw1", "node3", 2), ("sw1", "node4", 2)]
+        for switch, host, nworkers in layout:
+            for numa in range(nworkers):
+                self.pool.add(host, 5000 + numa, topology=WorkerTopology(None, numa % 2, switch))
+
+    def _hosts(self, servers):
+        return set(server.host_label for server in servers)
+
+    def _switches(self, servers):
+        return set(server.topology.switch for server in servers)
+
+    def test_pack_onto_single_host(self):
+        servers = self.pool.allocate(2)
+        # Best fit: a two-worker host rather than splitting a four-worker host
+        self.assertEqual(len(self._hosts(servers)), 1)
+        self.assertEqual(self._switches(servers), set(["sw1"]))
+
+    def test_pack_onto_single_switch(self):
+        servers = self.pool.allocate(8)
+        self.assertEqual(self._hosts(servers), set(["node0", "node1"]))
+        # Neighbouring servers are co-located
+        self.assertEqual([server.host_label for server in servers], ["node0"] * 4 + ["node1"] * 4)
+        servers = self.pool.allocate(5)
+        self.assertEqual(self._switches(servers), set(["sw1"]))
+        self.assertEqual(len(self._hosts(servers)), 3)
+
+    def test_spill_across_switches(self):
+        servers = self.pool.allocate(10)
+        self.assertEqual(self._switches(servers), set(["sw0", "sw1"]))
+        self.assertEqual(len(self._hosts(servers)), 3)
+        with self.assertRaises(WorkerAllocationError):
+            self.pool.allocate(5)
+        self.pool.deallocate(servers)
+        self.assertEqual(self.pool.navailable(), 14)
+
+    def test_priority_and_capacity(self):
+        # The heavy worker is on a four-worker host, which is not the best fit for one worker
+        self.pool.add("node0", 5003, WorkerCapacity(2.0, 2.0, 2.0),
+            WorkerTopology(None, 1, "sw0"))
+        for port in (5000, 5001):
+            self.pool.set_priority("node2", port, 1)
+        servers = self.pool.allocate(1)
+        self.assertEqual((servers[0].host_label, servers[0].port), ("node0", 5003))
+        self.assertEqual(servers[0].capacity.weight, 2.0)
+        self.pool.deallocate(servers)
+        servers = self.pool.allocate(12)
+        self.assertTrue(self.pool.get("node0", 5003) in servers)
+        self.assertFalse(self._hosts(servers) & set(["node2"]))
+        # Lower priority workers are only used once the higher priority ones run out
+        self.assertEqual(self._hosts(self.pool.allocate(2)), set(["node2"]))
+
+    def test_highest_capacity_workers_first(self):
+        # One strong worker on each of eight hosts and eight weak workers on each of two
+        # hosts: packing alone would choose a single weak host
+        pool = OfflineWorkerPool()
+        for ii in range(8):
+            pool.add("strong{}".format(ii), 5000, WorkerCapacity(2.0, 2.0, 2.0))
+        for ii in range(16):
+            pool.add("weak{}".format(ii // 8), 5000 + ii % 8, WorkerCapacity(0.5, 0.5, 0.5))
+        weights = sorted([server.capacity.weight for server in pool.available()], reverse=True)
+        servers = pool.allocate(8)
+        # The allocation matches the highest weights assumed by the configuration planner
+        self.assertEqual([server.capacity.weight for server in servers], weights[:8])
+        servers = pool.allocate(4)
+        self.assertEqual(len(self._hosts(servers)), 1)
+
+    def test_counts(self):
+        self.assertEqual(self.pool.navailable(), 14)
+        servers = self.pool.allocate(3)
+        self.assertEqual((self.pool.navailable(), self.pool.nused()), (11, 3))
+        self.pool.remove("node0", 5000)
+        self.assertEqual(self.pool.navailable() + self.pool.nused(), 13)
+        self.pool.reset()
+        self.assertEqual((self.pool.navailable(), self.pool.nused()), (13, 0))
+        self.assertEqual(len(set(self.pool.available())), 13)
+
+    def test_index_heap_is_bounded(self):
+        # Emptying and refilling a level must not queue it again
+        for _ in range(10):
+            servers = self.pool.allocate(14)
+            self.pool.deallocate(servers[:1])
+            self.pool.deallocate(servers[1:])
+        self.assertEqual(len(self.pool._free._heap), 1)
+
+    def test_preferred_workers(self):
+        first = self.pool.allocate(4)
+        other = self.pool.allocate(6)
+        self.pool.deallocate(first)
+        # The preferred servers are reused in their previous positions
+        self.assertEqual(self.pool.allocate(4, preferred=first), first)
+        self.pool.deallocate(first)
+        self.pool.deallocate(other)
+        # Unavailable preferred servers are replaced in place, so the others keep their positions
+        taken = self.pool.allocate(1, preferred=[first[1]])
+        servers = self.pool.allocate(5, preferred=first)
+        self.assertEqual([servers[0], servers[2], servers[3]], [first[0], first[2], first[3]])
+        self.assertFalse(taken[0] in servers)
+        self.assertFalse(first[1] in servers)
+        self.assertEqual(len(set(servers)), 5)
+
+    def test_preferred_workers_must_match_capacity(self):
+        first = self.pool.allocate(4)
+        self.pool.deallocate(first)
+        # A preferred server that has become weaker than the alternatives is not reused
+        self.pool.add(first[2].hostname, first[2].port, WorkerCapacity(0.5, 1.0, 1.0),
+            first[2].topology)
+        servers = self.pool.allocate(4, preferred=first)
+        self.assertEqual([servers[0], servers[1], servers[3]], [first[0], first[1], first[3]])
+        self.assertFalse(first[2] in servers)
+        self.assertEqual([server.capacity.weight for server in servers], [1.0] * 4)
+
+    def test_lazy_connections(self):
+        self.assertEqual(self.pool.nconnected(), 0)
+        servers = self.pool.allocate(4)
+        self.assertTrue(all(server.connected for server in servers))
+        client = servers[0].client
+        self.assertTrue(client.running)
+        self.assertEqual(self.pool.nconnected(), 4)
+        # Released connections are kept open for reuse
+        self.pool.deallocate(servers)
+        self.assertEqual(self.pool.nconnected(), 4)
+        self.assertEqual(self.pool.evict_idle_connections(), 0)
+        self.assertTrue(self.pool.allocate(4)[0].client is client)
+        self.pool.reset()
+        self.pool._connections.evict_expired(now=time.time() + self.pool._connections.keepalive + 1)
+        self.assertEqual(self.pool.nconnected(), 0)
+        self.assertFalse(client.running)
+
+    def test_bounded_idle_connections(self):
+        pool = OfflineWorkerPool(max_idle_connections=2)
+        for port in range(5000, 5004):
+            pool.add("node0", port)
+        servers = pool.allocate(4)
+        pool.deallocate(servers)
+        self.assertEqual(pool.nconnected(), 2)
+        # The least recently released connections are evicted first
+        self.assertEqual([server.connected for server in servers], [False, False, True, True])
+        pool.remove("node0", servers[3].port)
+        self.assertFalse(servers[3].connected)
+        self.assertEqual(pool.nconnected(), 1)
+
+    def test_large_pool(self):
+        pool = OfflineWorkerPool()
+        for ii in range(4096):
+            pool.add("node{}".format(ii // 4), 5000 + ii % 4,
+                topology=WorkerTopology(None, ii % 2, "sw{}".format(ii // 64)))
+        servers = pool.allocate(64)
+        self.assertEqual(self._switches(servers), set([servers[0].topology.switch]))
+        self.assertEqual(pool.navailable(), 4032)
+
+class TestWorkerHealth(AsyncTestCase):
+    def setUp(self):
+        super(TestWorkerHealth, self).setUp()
+        self.pool = OfflineWorkerPool(max_idle_connections=1)
+        for port in range(5000, 5004):
+            self.pool.add("node0", port)
+        self.servers = dict((server.port, server) for server in self.pool.available())
+
+    @gen_test
+    def test_probe_excludes_unhealthy_workers(self):
+        # Workers are not reported healthy until they have been probed
+        self.assertEqual(self.pool.nhealthy(), 0)
+        allocated = self.pool.allocate(1)[0]
+        self.servers[5001].reachable = False
+        self.servers[5002].device_state = "fail"
+        yield self.pool.probe(max_concurrent=2)
+        self.assertTrue(all(server.last_probe is not None for server in self.servers.values()))
+        self.assertEqual(self.pool.nhealthy(), 2)
+        self.assertEqual(self.pool.nexcluded(), 2)
+        self.assertEqual(self.pool.navailable(), 4 - 1 - 2)
+        # Idle workers are probed without opening pooled connections
+        self.assertEqual(self.pool.nconnected(), 1)
+        self.assertEqual(allocated.nprobe_clients, 0)
+        self.assertEqual(self.servers[5003].nprobe_clients, 1)
+        with self.assertRaises(WorkerAllocationError):
+            self.pool.allocate(2)
+        # Workers that recover are returned to the pool
+        self.servers[5001].reachable = True
+        yield self.pool.probe()
+        self.assertEqual(self.pool.nexcluded(), 1)
+        # Allocated workers that fail are excluded once released
+        allocated.device_state = "fail"
+        yield self.pool.probe()
+        self.pool.deallocate([allocated])
+        self.assertEqual(sorted(server.port for server in self.pool.excluded()),
+            [allocated.port, 5002])
+
+    def test_slow_workers_are_excluded(self):
+        server = self.servers[5003]
+        self.pool.set_health(server, True, self.pool.max_probe_latency * 2, "ok")
+        self.assertEqual(self.pool.excluded(), [server])
+        self.assertEqual(self.pool.max_latency(), self.pool.max_probe_latency * 2)
+        self.pool.set_health(server, True, 0.001, "ok")
+        self.assertEqual(self.pool.nexcluded(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main(buffer=True)
@@ -21,6 +21,10 @@ SOFTWARE.
 """
 import subprocess
 import time
+from collections import OrderedDict
+from functools import wraps
+import numpy as np
+from math import floor
 from katcp import Sensor
 
 class AntennaValidationError(Exception):
@@ -40,6 +44,33 @@ def next_power_of_two(n):
     """
     return 2**(n-1).bit_length()
 
+def next_epoch_boundary(timestamp, period, offset=0.0):
+    """
+    @brief  Return the first multiple of period (in unix time) plus offset strictly after timestamp
+
+    @note   This is used to align delay model updates across processes without the need
+            for explicit synchronisation, and to schedule changes to beam positions away
+            from those updates (see FbfProductController._update_dynamic_tilings).
+    """
+    return (floor((timestamp - offset) / float(period)) + 1) * period + offset
+
+def angular_separation(ra0, dec0, ra, dec):
+    """
+    @brief   Calculate the angular separation between sky positions
+
+    @param   ra0, dec0   A reference position in degrees
+
+    @param   ra, dec     Positions (scalars or arrays) in degrees
+
+    @return  The angular separation(s) in degrees
+    """
+    ra0, dec0 = np.deg2rad(ra0), np.deg2rad(dec0)
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    # Haversine formula, well conditioned for small separations
+    a = (np.sin((dec - dec0) / 2.0)**2
+        + np.cos(dec0) * np.cos(dec) * np.sin((ra - ra0) / 2.0)**2)
+    return np.rad2deg(2.0 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0))))
+
 def parse_csv_antennas(antennas_csv):
     antennas = antennas_csv.split(",")
     nantennas = len(antennas)
@@ -72,6 +103,34 @@ def check_ntp_sync():
                 return True
     return False
 
+def memoize(maxsize=1024):
+    """
+    @brief  Decorator caching the results of a function with hashable arguments
+
+    @param  maxsize  The maximum number of cached results. When full the least
+                     recently used result is discarded.
+
+    @note   Cached results are shared between callers and so must not be modified.
+            Exceptions are not cached.
+    """
+    def decorator(func):
+        cache = OrderedDict()
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            try:
+                result = cache.pop(key)
+            except KeyError:
+                result = func(*args, **kwargs)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[key] = result
+            return result
+        wrapper.cache_clear = cache.clear
+        wrapper.cache_size = lambda: len(cache)
+        return wrapper
+    return decorator
+
 class Timer(object):
     def __init__(self):
         self.reset()
@@ -20,11 +20,21 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import logging
-from threading import Lock
-from katcp import KATCPClientResource
+import heapq
+import time
+from collections import namedtuple, OrderedDict, Counter
+from threading import RLock
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from katcp import KATCPClientResource, AsyncClient, Message
 
 log = logging.getLogger('mpikat.worker_pool')
-lock = Lock()
+
+DEFAULT_MAX_IDLE_CONNECTIONS = 16
+DEFAULT_CONNECTION_KEEPALIVE = 600.0 # seconds
+DEFAULT_PROBE_TIMEOUT = 5.0 # seconds
+DEFAULT_MAX_PROBE_LATENCY = 0.5 # seconds
+DEFAULT_MAX_CONCURRENT_PROBES = 32
 
 class WorkerAllocationError(Exception):
     pass
@@ -32,37 +42,427 @@ class WorkerAllocationError(Exception):
 class WorkerDeallocationError(Exception):
     pass
 
+class WorkerCapacity(namedtuple("WorkerCapacity", ["compute", "nic", "memory"])):
+    """Capacity vector advertised by a worker server.
+
+    Each element is relative to a reference worker (1.0), i.e. the GPU the
+    beamformer performance table was measured on, a 40 GbE NIC and the
+    memory required to buffer a reference worker's share of the band.
+    """
+    __slots__ = ()
+
+    @property
+    def weight(self):
+        """
+        @brief  The share of load the worker can carry relative to a reference worker
+
+        @note   As compute, ingest/egress and buffering requirements all scale with the
+                number of channels a worker processes, the load share is set by the most
+                constrained resource.
+        """
+        return float(min(self))
+
+DEFAULT_WORKER_CAPACITY = WorkerCapacity(1.0, 1.0, 1.0)
+
+class WorkerTopology(namedtuple("WorkerTopology", ["host", "numa", "switch"])):
+    """Location of a worker server in the cluster.
+
+    host is the physical machine (defaults to the worker hostname), numa the
+    NUMA node on that machine and switch the leaf switch (or rack) that the
+    machine's NIC is attached to. Labels of None are treated as unknown.
+    """
+    __slots__ = ()
+
+DEFAULT_WORKER_TOPOLOGY = WorkerTopology(None, 0, None)
+
+def _choose_groups(groups, count):
+    """
+    @brief  Choose the fewest groups that together hold count members
+
+    @param  groups  A list of (label, size) tuples
+
+    @return A list of (label, ntake) tuples
+
+    @detail The largest groups are taken whole until the remainder fits in a single
+            group, which is then chosen best-fit (the smallest group that can hold it),
+            so that large groups are left intact for later allocations.
+    """
+    groups = sorted(groups, key=lambda group: (-group[1], group[0]))
+    chosen = []
+    remaining = count
+    while remaining > 0:
+        fitting = [group for group in groups if group[1] >= remaining]
+        if fitting:
+            chosen.append((fitting[-1][0], remaining))
+            break
+        label, size = groups.pop(0)
+        chosen.append((label, size))
+        remaining -= size
+    return chosen
+
+class _AvailabilityIndex(object):
+    """Incrementally maintained index of free workers.
+
+    Workers are held by level (capacity weight and priority), switch and
+    host, with a count at each level and a heap of the levels present, so
+    that adding and removing a worker is O(log n) and k workers can be taken
+    without scanning the whole pool.
+    """
+    def __init__(self):
+        self._levels = {}       # level -> switch -> host -> set of workers
+        self._switch_counts = {} # level -> switch -> number of workers
+        self._level_counts = {} # level -> number of workers
+        self._heap = []         # heap of levels (may hold stale entries)
+        self._queued = set()    # levels present in the heap
+        self._locations = {}    # worker -> (level, switch, host)
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __contains__(self, server):
+        return server in self._locations
+
+    def __iter__(self):
+        return iter(list(self._locations))
+
+    @staticmethod
+    def _level(server):
+        # Highest capacity weight first, then highest priority (0)
+        return (-server.capacity.weight, server.priority)
+
+    def add(self, server):
+        level, switch, host = location = (self._level(server), server.topology.switch, server.host_label)
+        self._locations[server] = location
+        if level not in self._level_counts:
+            self._level_counts[level] = 0
+            self._levels[level] = {}
+            self._switch_counts[level] = {}
+            if level not in self._queued:
+                self._queued.add(level)
+                heapq.heappush(self._heap, level)
+        self._levels[level].setdefault(switch, {}).setdefault(host, set()).add(server)
+        self._switch_counts[level][switch] = self._switch_counts[level].get(switch, 0) + 1
+        self._level_counts[level] += 1
+
+    def remove(self, server):
+        level, switch, host = self._locations.pop(server)
+        hosts = self._levels[level][switch]
+        hosts[host].remove(server)
+        if not hosts[host]:
+            del hosts[host]
+        self._switch_counts[level][switch] -= 1
+        if not self._switch_counts[level][switch]:
+            del self._switch_counts[level][switch]
+            del self._levels[level][switch]
+        self._level_counts[level] -= 1
+        if not self._level_counts[level]:
+            del self._level_counts[level]
+            del self._levels[level]
+            del self._switch_counts[level]
+
+    def discard(self, server):
+        if server in self._locations:
+            self.remove(server)
+
+    def _first_level(self):
+        while self._heap[0] not in self._level_counts:
+            self._queued.remove(heapq.heappop(self._heap))
+        return self._heap[0]
+
+    def top_weights(self, count):
+        """
+        @brief  Return a Counter of the capacity weights of the count workers that take would return
+        """
+        weights = Counter()
+        for level in sorted(self._level_counts):
+            if count <= 0:
+                break
+            ntake = min(count, self._level_counts[level])
+            weights[-level[0]] += ntake
+            count -= ntake
+        return weights
+
+    def _pack(self, level, count):
+        selected = []
+        for switch, nswitch in _choose_groups(self._switch_counts[level].items(), count):
+            hosts = self._levels[level][switch]
+            for host, nhost in _choose_groups([(host, len(servers))
+                    for host, servers in hosts.items()], nswitch):
+                servers = sorted(hosts[host], key=lambda server: (
+                    server.topology.numa, server.port))
+                selected.extend(servers[:nhost])
+        return selected
+
+    def take(self, count):
+        """
+        @brief  Remove and return count workers
+
+        @detail Workers are taken in order of decreasing capacity weight and then
+                priority (0 being highest priority), so that the workers taken are
+                always the count highest capacity workers that the configuration
+                planner assumes. Within the last level needed, where the workers are
+                interchangeable, they are packed onto the fewest switches and then
+                hosts (see _choose_groups), taking workers on each host in order of
+                NUMA node. Within each level the result is ordered by switch, host and
+                NUMA node so that neighbouring entries are co-located.
+        """
+        selected = []
+        while len(selected) < count:
+            level = self._first_level()
+            servers = self._pack(level, min(count - len(selected), self._level_counts[level]))
+            for server in servers:
+                self.remove(server)
+            selected.extend(servers)
+        return selected
+
+
+class WorkerConnectionPool(object):
+    """Bounded pool of idle worker connections.
+
+    Allocated workers are always connected. When a worker is deallocated its
+    connection is kept open (in least recently used order) so that it can be
+    reused by the next product, until either the pool holds more than
+    max_idle connections or the connection has been idle for longer than
+    keepalive seconds.
+    """
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE_CONNECTIONS, keepalive=DEFAULT_CONNECTION_KEEPALIVE):
+        """
+        @brief  Create a new connection pool
+
+        @param  max_idle   The maximum number of idle connections to keep open
+        @param  keepalive  The time in seconds an idle connection is kept open
+        """
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self._idle = OrderedDict() # worker -> time of release
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self, server):
+        """
+        @brief  Take a worker's connection for use, connecting if necessary
+        """
+        self._idle.pop(server, None)
+        server.connect()
+
+    def release(self, server, now=None):
+        """
+        @brief  Return a worker's connection to the idle pool
+        """
+        if not server.connected:
+            return
+        self._idle.pop(server, None)
+        self._idle[server] = time.time() if now is None else now
+        while len(self._idle) > self.max_idle:
+            evicted, _ = self._idle.popitem(last=False)
+            log.debug("Evicting idle connection to {}".format(evicted))
+            evicted.disconnect()
+
+    def discard(self, server):
+        """
+        @brief  Close a worker's connection and forget it
+        """
+        self._idle.pop(server, None)
+        server.disconnect()
+
+    def evict_expired(self, now=None):
+        """
+        @brief  Close idle connections that have exceeded the keep-alive time
+
+        @return The number of connections closed
+        """
+        now = time.time() if now is None else now
+        expired = [server for server, released in self._idle.items()
+            if now - released > self.keepalive]
+        for server in expired:
+            log.debug("Closing expired idle connection to {}".format(server))
+            self.discard(server)
+        return len(expired)
+
+
 class WorkerPool(object):
     """Wrapper class for managing server
     allocation and deallocation to subarray/products
     """
-    def __init__(self):
+    def __init__(self, max_idle_connections=DEFAULT_MAX_IDLE_CONNECTIONS,
+            connection_keepalive=DEFAULT_CONNECTION_KEEPALIVE):
         """
         @brief   Construct a new instance
+
+        @param   max_idle_connections  The maximum number of connections to unallocated
+                                       workers that are kept open for reuse
+        @param   connection_keepalive  The time in seconds a connection to an unallocated
+                                       worker is kept open
+
+        @note    Free workers are kept in an incrementally maintained index, so that
+                 counts are O(1) and allocating k workers does not scan the pool.
+                 All changes to the pool are made under a per-pool lock.
+
+        @note    Workers are connected when they are allocated, not when they are added.
         """
-        self._servers = set()
+        self._servers = {}
         self._allocated = set()
+        self._free = _AvailabilityIndex()
+        self._connections = WorkerConnectionPool(max_idle_connections, connection_keepalive)
+        self._excluded = set()
+        self.max_probe_latency = DEFAULT_MAX_PROBE_LATENCY
+        self._lock = RLock()
 
     def make_wrapper(self, hostname, port):
         raise NotImplemented
 
-    def add(self, hostname, port):
+    def add(self, hostname, port, capacity=None, topology=None):
         """
         @brief  Add a new FbfWorkerServer to the server pool
 
         @params hostname The hostname for the worker server
         @params port     The port number that the worker server serves on
+        @params capacity (optional) A WorkerCapacity instance describing the worker.
+                         Defaults to DEFAULT_WORKER_CAPACITY.
+        @params topology (optional) A WorkerTopology instance describing the worker's
+                         location. Defaults to DEFAULT_WORKER_TOPOLOGY.
+
+        @note   Adding a worker that is already in the pool updates its capacity and topology.
         """
         log.debug("Adding {}:{} to worker pool".format(hostname, port))
+        if capacity is None:
+            capacity = DEFAULT_WORKER_CAPACITY
+        if topology is None:
+            topology = DEFAULT_WORKER_TOPOLOGY
         wrapper = self.make_wrapper(hostname,port)
-        if not wrapper in self._servers:
-            wrapper.start()
-            log.debug("Adding {} to server set".format(wrapper))
-            self._servers.add(wrapper)
-        else:
-            log.debug("Worker instance {} already exists".format(wrapper))
+        with self._lock:
+            if not wrapper in self._servers:
+                wrapper.capacity = capacity
+                wrapper.topology = topology
+                log.debug("Adding {} to server set".format(wrapper))
+                self._servers[wrapper] = wrapper
+                self._free.add(wrapper)
+            else:
+                log.debug("Worker instance {} already exists".format(wrapper))
+                server = self._servers[wrapper]
+                log.debug("Updating capacity of {} to {} and topology to {}".format(
+                    server, capacity, topology))
+                self._update(server, capacity=capacity, topology=topology)
         log.debug("Added {}:{} to worker pool".format(hostname, port))
 
+    def get(self, hostname, port):
+        """
+        @brief  Return the registered worker at hostname:port (or None)
+        """
+        return self._servers.get(self.make_wrapper(hostname, port))
+
+    def _update(self, server, **attributes):
+        free = server in self._free
+        if free:
+            self._free.remove(server)
+        for key, value in attributes.items():
+            setattr(server, key, value)
+        if free:
+            self._free.add(server)
+
+    def _is_excluded(self, server):
+        return not server.healthy or (server.latency is not None
+            and server.latency > self.max_probe_latency)
+
+    def _make_free(self, server):
+        if self._is_excluded(server):
+            self._excluded.add(server)
+        else:
+            self._free.add(server)
+
+    def set_health(self, server, healthy, latency=None, device_status=None, error=None):
+        """
+        @brief  Record the result of a health probe of a worker
+
+        @param  server         A WorkerWrapper in the pool
+        @param  healthy        Whether the worker responded correctly
+        @param  latency        The round trip time of the probe in seconds
+        @param  device_status  The value of the worker's device-status sensor
+        @param  error          A description of why the probe failed (if it did)
+
+        @note   Free workers that are unhealthy or slower than max_probe_latency are
+                excluded from allocation until a later probe finds them healthy.
+                Allocated workers are excluded once they are deallocated.
+        """
+        with self._lock:
+            server.healthy = healthy
+            server.latency = latency
+            server.device_status = device_status
+            server.probe_error = error
+            server.last_probe = time.time()
+            if server in self._free and self._is_excluded(server):
+                log.warning("Excluding {} from allocation (healthy={}, latency={})".format(
+                    server, healthy, latency))
+                self._free.remove(server)
+                self._excluded.add(server)
+            elif server in self._excluded and not self._is_excluded(server):
+                log.info("Returning {} to allocation".format(server))
+                self._excluded.remove(server)
+                self._free.add(server)
+
+    @coroutine
+    def probe(self, timeout=DEFAULT_PROBE_TIMEOUT, max_concurrent=DEFAULT_MAX_CONCURRENT_PROBES,
+            servers=None):
+        """
+        @brief  Probe the health of registered workers
+
+        @param  timeout         The time in seconds to wait for each worker
+        @param  max_concurrent  The maximum number of workers probed at once
+        @param  servers         (optional) The workers to probe. Defaults to all registered workers.
+
+        @detail Probes do not go through the idle connection pool. Workers without an
+                open connection are probed with a short-lived client (see
+                WorkerWrapper.probe), so probing does not reconnect, resync or evict
+                pooled connections.
+        """
+        if servers is None:
+            servers = list(self._servers.values())
+        for start in range(0, len(servers), max_concurrent):
+            batch = servers[start:start + max_concurrent]
+            futures = [server.probe(timeout) for server in batch]
+            for server, future in zip(batch, futures):
+                try:
+                    latency, device_status = yield future
+                except Exception as error:
+                    log.warning("Health probe of {} failed: {}".format(server, str(error)))
+                    self.set_health(server, False, error=str(error))
+                else:
+                    self.set_health(server, device_status != "fail", latency, device_status)
+
+    def nhealthy(self):
+        """
+        @brief   Return the number of registered workers that passed their last probe
+
+        @note    Workers that have not yet been probed are not counted, although they
+                 remain available for allocation.
+        """
+        return len([server for server in self._servers
+            if server.last_probe is not None and server.healthy])
+
+    def nexcluded(self):
+        """
+        @brief   Return the number of free workers excluded from allocation
+        """
+        return len(self._excluded)
+
+    def max_latency(self):
+        """
+        @brief   Return the largest probe round trip time of the registered workers (or 0)
+        """
+        return max([server.latency for server in self._servers if server.latency is not None] or [0.0])
+
+    def set_priority(self, hostname, port, priority):
+        """
+        @brief  Set the allocation priority of a worker (0 being highest priority)
+
+        @params hostname The hostname for the worker server
+        @params port     The port number that the worker server serves on
+        @params priority The new priority
+        """
+        with self._lock:
+            self._update(self._servers[self.make_wrapper(hostname, port)], priority=priority)
+
     def remove(self, hostname, port):
         """
         @brief  Add a new FbfWorkerServer to the server pool
@@ -72,38 +472,72 @@ class WorkerPool(object):
         """
         log.debug("Removing {}:{} from worker pool".format(hostname, port))
         wrapper = self.make_wrapper(hostname,port)
-        if wrapper in self._allocated:
-            raise WorkerDeallocationError("Cannot remove allocated server from pool")
-        try:
-            self._servers.remove(wrapper)
-        except KeyError:
-            log.warning("Could not find {}:{} in server pool".format(hostname, port))
-        else:
-            log.debug("Removed {}:{} from worker pool".format(hostname, port))
+        with self._lock:
+            if wrapper in self._allocated:
+                raise WorkerDeallocationError("Cannot remove allocated server from pool")
+            try:
+                server = self._servers.pop(wrapper)
+            except KeyError:
+                log.warning("Could not find {}:{} in server pool".format(hostname, port))
+            else:
+                self._free.discard(server)
+                self._excluded.discard(server)
+                self._connections.discard(server)
+                log.debug("Removed {}:{} from worker pool".format(hostname, port))
 
-    def allocate(self, count):
+    def allocate(self, count, preferred=None):
         """
         @brief    Allocate a number of servers from the pool.
 
-        @note     Free servers will be allocated by priority order
-                  with 0 being highest priority
+        @param    count      The number of servers to allocate
+        @param    preferred  (optional) A list of servers to reuse where possible,
+                             e.g. the servers a product held for its previous
+                             schedule block
+
+        @note     Servers are allocated in order of decreasing capacity weight and then
+                  priority, with 0 being highest priority. Among equivalent servers, the
+                  allocation is packed onto the fewest switches and hosts.
 
-        @return   A list of FbfWorkerWrapper objects
+        @note     A free server in preferred is kept at its position in preferred, so that
+                  a product that is reconfigured in a compatible way gets the same servers
+                  in the same positions (and so the same channel ranges) and can reuse their
+                  warm state. Preferred servers are only reused where their capacity weights
+                  match those of the servers that would otherwise be allocated (those the
+                  configuration was planned for). Positions whose preferred server is not
+                  reused are filled as above.
+
+        @return   A list of FbfWorkerWrapper objects, ordered so that
+                  neighbouring servers are co-located
         """
-        with lock:
+        with self._lock:
             log.debug("Request to allocate {} servers".format(count))
-            available_servers = list(self._servers.difference(self._allocated))
-            log.debug("{} servers available".format(len(available_servers)))
-            available_servers.sort(key=lambda server: server.priority, reverse=True)
-            if len(available_servers) < count:
+            log.debug("{} servers available".format(len(self._free)))
+            if len(self._free) < count:
                 raise WorkerAllocationError("Cannot allocate {0} servers, only {1} available".format(
-                    count, len(available_servers)))
-            allocated_servers = []
-            for _ in range(count):
-                server = available_servers.pop()
+                    count, len(self._free)))
+            allocated_servers = [None] * count
+            if preferred:
+                weights = self._free.top_weights(count)
+                for position, server in enumerate(preferred[:count]):
+                    server = self._servers.get(server)
+                    if server is None or server not in self._free:
+                        continue
+                    if not weights[server.capacity.weight]:
+                        log.debug("Not reusing {} as its capacity does not match the "
+                            "allocation".format(server))
+                        continue
+                    weights[server.capacity.weight] -= 1
+                    self._free.remove(server)
+                    allocated_servers[position] = server
+                log.debug("Reusing {} preferred servers".format(
+                    count - allocated_servers.count(None)))
+            gaps = [position for position, server in enumerate(allocated_servers) if server is None]
+            for position, server in zip(gaps, self._free.take(len(gaps))):
+                allocated_servers[position] = server
+            for server in allocated_servers:
                 log.debug("Allocating server: {}".format(server))
-                allocated_servers.append(server)
                 self._allocated.add(server)
+                self._connections.acquire(server)
             return allocated_servers
 
     def deallocate(self, servers):
@@ -112,34 +546,60 @@ class WorkerPool(object):
 
         @param    A list of Node objects
         """
-        for server in servers:
-            log.debug("Deallocating server: {}".format(server))
-            self._allocated.remove(server)
+        with self._lock:
+            for server in servers:
+                log.debug("Deallocating server: {}".format(server))
+                self._allocated.remove(server)
+                self._make_free(self._servers[server])
+                self._connections.release(self._servers[server])
 
     def reset(self):
         """
         @brief   Deallocate all servers
         """
         log.debug("Reseting server pool allocations")
-        self._allocated = set()
+        with self._lock:
+            self.deallocate(list(self._allocated))
 
     def available(self):
         """
         @brief   Return list of available servers
         """
-        return list(self._servers.difference(self._allocated))
+        with self._lock:
+            return list(self._free)
 
     def navailable(self):
-        return len(self.available())
+        return len(self._free)
+
+    def excluded(self):
+        """
+        @brief   Return list of unallocated servers excluded by health probes
+        """
+        with self._lock:
+            return list(self._excluded)
 
     def used(self):
         """
         @brief   Return list of allocated servers
         """
-        return list(self._allocated)
+        with self._lock:
+            return list(self._allocated)
 
     def nused(self):
-        return len(self.used())
+        return len(self._allocated)
+
+    def nconnected(self):
+        """
+        @brief   Return the number of workers with an open connection
+        """
+        return len(self._allocated) + len(self._connections)
+
+    def evict_idle_connections(self):
+        """
+        @brief   Close connections to unallocated workers that have exceeded the keep-alive time
+        """
+        with self._lock:
+            return self._connections.evict_expired()
 
 
 class WorkerWrapper(object):
@@ -152,24 +612,129 @@ class WorkerWrapper(object):
 
         @params hostname The hostname for the worker server
         @params port     The port number that the worker server serves on
+
+        @note   The client is not created until the worker is first connected
+                (see connect), which WorkerPool does on allocation.
         """
-        log.debug("Creating worker client to worker at {}:{}".format(hostname, port))
-        self._client = KATCPClientResource(dict(
-            name="worker-server-client",
-            address=(hostname, port),
-            controlled=True))
+        self._client = None
         self.hostname = hostname
         self.port = port
         self.priority = 0 # Currently no priority mechanism is implemented
-        self._started = False
+        self.capacity = DEFAULT_WORKER_CAPACITY
+        self.topology = DEFAULT_WORKER_TOPOLOGY
+        self.healthy = True # Workers are assumed healthy until probed
+        self.latency = None
+        self.device_status = None
+        self.probe_error = None
+        self.last_probe = None
+
+    @property
+    def host_label(self):
+        """
+        @brief  The physical host of the worker (the topology host label or the hostname)
+        """
+        return self.topology.host or self.hostname
+
+    @property
+    def connected(self):
+        return self._client is not None
+
+    @property
+    def client(self):
+        """
+        @brief  The client to the worker server (connecting if necessary)
+        """
+        self.connect()
+        return self._client
+
+    @property
+    def req(self):
+        return self.client.req
+
+    def _make_client(self):
+        return KATCPClientResource(dict(
+            name="worker-server-client",
+            address=(self.hostname, self.port),
+            controlled=True))
+
+    def _make_probe_client(self):
+        return AsyncClient(self.hostname, self.port, timeout=DEFAULT_PROBE_TIMEOUT)
+
+    def connect(self):
+        """
+        @brief  Create and start the client to the worker server if not already connected
+        """
+        if self._client is None:
+            log.debug("Starting client to worker at {}:{}".format(self.hostname, self.port))
+            client = self._make_client()
+            client.start()
+            self._client = client
 
     def start(self):
         """
         @brief  Start the client to the worker server
         """
-        log.debug("Starting client to worker at {}:{}".format(self.hostname, self.port))
-        self._client.start()
-        self._started = True
+        self.connect()
+
+    @coroutine
+    def probe(self, timeout=DEFAULT_PROBE_TIMEOUT):
+        """
+        @brief  Check that the worker server is responsive
+
+        @param  timeout  The time in seconds to wait for each step of the probe
+
+        @return A tuple of the watchdog round trip time in seconds and the value of
+                the worker's device-status sensor
+
+        @note   Raises an exception if the worker cannot be reached or the requests fail.
+
+        @note   A connected worker is probed through its existing client. Otherwise a
+                plain katcp client is opened for the probe and closed afterwards, without
+                the sensor sync of a full client, and the worker is left unconnected.
+        """
+        if self.connected:
+            client = self._client
+            yield client.until_synced(timeout=timeout)
+            @coroutine
+            def request(name, *args):
+                response = yield getattr(client.req, name.replace("-", "_"))(*args, timeout=timeout)
+                raise Return((response.reply, response.informs))
+            result = yield self._probe_requests(request)
+        else:
+            client = self._make_probe_client()
+            client.set_ioloop(IOLoop.current())
+            client.start()
+            try:
+                yield client.until_protocol(timeout=timeout)
+                result = yield self._probe_requests(lambda name, *args: client.future_request(
+                    Message.request(name, *args), timeout=timeout))
+            finally:
+                client.stop()
+        raise Return(result)
+
+    @coroutine
+    def _probe_requests(self, request):
+        start = time.time()
+        reply, informs = yield request("watchdog")
+        latency = time.time() - start
+        if not reply.reply_ok():
+            raise Exception("Watchdog request failed: {}".format(reply))
+        reply, informs = yield request("sensor-value", "device-status")
+        if not reply.reply_ok() or not informs:
+            raise Exception("Could not read device-status: {}".format(reply))
+        raise Return((latency, informs[0].arguments[-1]))
+
+    def disconnect(self):
+        """
+        @brief  Stop the client to the worker server
+        """
+        client, self._client = self._client, None
+        if client is not None:
+            log.debug("Stopping client to worker at {}:{}".format(self.hostname, self.port))
+            try:
+                client.stop()
+            except Exception as error:
+                log.exception(str(error))
 
     def __repr__(self):
         return "<{} @ {}:{}>".format(self.__class__.__name__, self.hostname, self.port)
@@ -187,9 +752,4 @@ class WorkerWrapper(object):
         return self.__hash__() == hash(other)
 
     def __del__(self):
-        if self._started:
-            try:
-                self._client.stop()
-            except Exception as error:
-                log.exception(str(error))
-
+        self.disconnect()
@@ -8,6 +8,7 @@ setup(name='mpikat',
       author_email='ebarr@mpifr-bonn.mpg.de',
       license='MIT',
       packages=['mpikat'],
+      package_data={'mpikat': ['data/*.json']},
       install_requires=[
           'katpoint',
           'katcp',